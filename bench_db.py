@@ -0,0 +1,78 @@
+"""
+Бенчмарк слоя БД: aiosqlite.connect на каждый вызов (как было) против пула Database.
+Запуск: python bench_db.py [кол-во вызовов]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import aiosqlite
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "bot"))
+
+from database.db import Database
+from database.models import GET_BALANCE, UPDATE_LAST_ACTIVITY
+
+USERS = 100
+
+
+async def per_call_get_balance(db_path: str, user_id: int) -> int:
+    """Старое поведение: новое соединение (и поток) на каждый запрос"""
+    async with aiosqlite.connect(db_path) as conn:
+        async with conn.execute(GET_BALANCE, (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 0
+
+
+async def per_call_touch(db_path: str, user_id: int):
+    async with aiosqlite.connect(db_path) as conn:
+        await conn.execute(UPDATE_LAST_ACTIVITY, (user_id,))
+        await conn.commit()
+
+
+async def measure(name: str, calls: int, make_call, concurrent: bool = True) -> float:
+    start = time.perf_counter()
+    if concurrent:
+        await asyncio.gather(*(make_call(i % USERS) for i in range(calls)))
+    else:
+        # Параллельные записи через отдельные соединения падают с "database is locked",
+        # поэтому запись меряем последовательно, как в одном хэндлере
+        for i in range(calls):
+            await make_call(i % USERS)
+    elapsed = time.perf_counter() - start
+    rate = calls / elapsed
+    print(f"{name:<32} {calls:>6} вызовов за {elapsed:6.2f} c  → {rate:8.0f} вызовов/с")
+    return rate
+
+
+async def main(calls: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        database = Database(db_path=db_path)
+        await database.init_db()
+        for user_id in range(USERS):
+            await database.create_user(user_id, f"user{user_id}")
+
+        print("— чтение (get_balance) —")
+        before = await measure("connect на вызов", calls, lambda u: per_call_get_balance(db_path, u))
+        after = await measure("пул + кэш балансов", calls, database.get_balance)
+        print(f"ускорение: x{after / before:.1f}\n")
+
+        print("— запись (UPDATE last_activity) —")
+        before = await measure("connect на вызов", calls // 4, lambda u: per_call_touch(db_path, u), concurrent=False)
+
+        async def pooled_touch(user_id: int):
+            async with database._write() as conn:
+                await conn.execute(UPDATE_LAST_ACTIVITY, (user_id,))
+                await conn.commit()
+
+        after = await measure("пул Database", calls // 4, pooled_touch, concurrent=False)
+        print(f"ускорение: x{after / before:.1f}\n")
+
+        await database.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
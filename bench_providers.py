@@ -0,0 +1,161 @@
+"""
+Проверка роутера провайдеров генерации на локальных фейковых провайдерах (без сети и Replicate).
+Сценарии:
+- фоллбэк: основной провайдер падает — результат дает запасной;
+- предохранитель: после N ошибок подряд провайдер пропускается до конца паузы;
+- медленный рендер: дольше slow_timeout — фоллбэк, зависший рендер отменяется у провайдера;
+- хеджирование: у основного провайдера «хвост» медленных рендеров, второй подключается после p95 —
+  p99 задержки против того же потока без хеджирования;
+- все провайдеры упали — None, стоимость учитывает все попытки;
+- очередь генераций: задача design доходит до результата через запасной провайдер.
+Запуск: python bench_providers.py [N рендеров для хеджирования]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "bot"))
+
+from services.latency import _nearest_rank
+from services.providers import ImageProvider, ProviderError, ProviderRouter, RenderRequest
+
+REQUEST = RenderRequest("modern living room", "file_id")
+
+
+class FakeProvider(ImageProvider):
+    """Рендер за delay секунд (±20%); fail_rate — доля ошибок, slow_rate — доля рендеров длиной slow_delay"""
+
+    def __init__(self, name: str, delay: float = 0.05, fail_rate: float = 0.0,
+                 slow_rate: float = 0.0, slow_delay: float = 1.0, cost: float = 0.01, seed: int = 1):
+        self.name = name
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.price = cost
+        self.random = random.Random(seed)
+        self.started = 0
+        self.cancelled = 0
+
+    def cost(self, request: RenderRequest) -> float:
+        return self.price
+
+    async def start(self, request, bot):
+        self.started += 1
+        return {"n": self.started, "fail": self.random.random() < self.fail_rate,
+                "slow": self.random.random() < self.slow_rate, "jitter": self.random.uniform(0.8, 1.2)}
+
+    async def result(self, handle):
+        await asyncio.sleep(self.slow_delay if handle["slow"] else self.delay * handle["jitter"])
+        if handle["fail"]:
+            raise ProviderError("fake failure")
+        return f"https://{self.name}.example/{handle['n']}.png"
+
+    async def cancel(self, handle):
+        self.cancelled += 1
+
+
+async def check_fallback():
+    broken = FakeProvider("broken", fail_rate=1.0)
+    spare = FakeProvider("spare")
+    router = ProviderRouter([broken, spare])
+    result = await router.result(await router.start(REQUEST, None))
+    assert result.provider == "spare" and result.url, result
+    assert abs(result.cost - 0.02) < 1e-9, result.cost
+    print(f"Фоллбэк:        {result.url}, стоимость ${result.cost:.2f} (обе попытки)")
+
+
+async def check_circuit_breaker():
+    broken = FakeProvider("broken", fail_rate=1.0)
+    spare = FakeProvider("spare")
+    router = ProviderRouter([broken, spare], failure_threshold=3, cooldown=0.3)
+    for _ in range(5):
+        await router.result(await router.start(REQUEST, None))
+    assert broken.started == 3 and not router.health(broken).available, broken.started
+    await asyncio.sleep(0.3)
+    assert router.health(broken).available
+    await router.result(await router.start(REQUEST, None))
+    assert broken.started == 4 and not router.health(broken).available
+    print(f"Предохранитель: 5 рендеров → у сломанного 3 попытки, после паузы 1 пробная и снова пауза")
+
+
+async def check_slow_timeout():
+    stuck = FakeProvider("stuck", slow_rate=1.0, slow_delay=5.0)
+    spare = FakeProvider("spare")
+    router = ProviderRouter([stuck, spare], slow_timeout=0.2)
+    start = time.perf_counter()
+    result = await router.result(await router.start(REQUEST, None))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0)  # фоновая отмена у провайдера
+    assert result.provider == "spare" and elapsed < 0.5 and stuck.cancelled == 1, (result, elapsed)
+    print(f"Медленный:      результат от spare за {elapsed:.2f} c (slow_timeout 0.2 c), зависший рендер отменен")
+
+
+async def run_stream(hedge: bool, count: int):
+    """count последовательных рендеров; у основного 3% рендеров в 10 раз дольше (p95 остается быстрым)"""
+    primary = FakeProvider("primary", delay=0.05, slow_rate=0.03, slow_delay=0.5, seed=7)
+    backup = FakeProvider("backup", delay=0.06, seed=8)
+    router = ProviderRouter([primary, backup], hedge=hedge, hedge_min_samples=20)
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        result = await router.result(await router.start(REQUEST, None))
+        assert result.url
+        latencies.append(int((time.perf_counter() - start) * 1000))
+    await asyncio.sleep(0)
+    ordered = sorted(latencies)
+    return {p: _nearest_rank(ordered, p) for p in (50, 95, 99)}, router.stats(), primary.started + backup.started
+
+
+async def check_hedging(count: int):
+    plain, _, plain_renders = await run_stream(False, count)
+    hedged, stats, hedged_renders = await run_stream(True, count)
+    print(f"Без хеджа:      p50 {plain[50]} мс, p95 {plain[95]} мс, p99 {plain[99]} мс, рендеров {plain_renders}")
+    print(f"С хеджем:       p50 {hedged[50]} мс, p95 {hedged[95]} мс, p99 {hedged[99]} мс, рендеров {hedged_renders} "
+          f"(хеджей {stats['hedged']}, выиграли {stats['hedge_wins']})")
+    assert hedged[99] < plain[99] / 2, (plain, hedged)
+
+
+async def check_all_failed():
+    router = ProviderRouter([FakeProvider("a", fail_rate=1.0), FakeProvider("b", fail_rate=1.0)])
+    result = await router.result(await router.start(REQUEST, None))
+    assert result.url is None and abs(result.cost - 0.02) < 1e-9, result
+    print(f"Все упали:      url=None, стоимость ${result.cost:.2f}, метрики {router.stats()['fallbacks']} фоллбэк")
+
+
+async def check_scheduler():
+    """Задача design через очередь генераций: основной провайдер падает, результат — от запасного"""
+    from database.db import db
+    from services.generation_queue import generation_scheduler
+    from services.providers import generation_router
+
+    generation_router.providers = [FakeProvider("broken", fail_rate=1.0), FakeProvider("spare", cost=0.004)]
+    db.db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db.analytics_sync = True
+    await db.init_db()
+    await generation_scheduler.start(bot=None)
+    job = await generation_scheduler.submit(1, 1, "design", "file_id", "living_room", "modern")
+    url = await job.future
+    await generation_scheduler.stop()
+    await db.close()
+    assert url and url.startswith("https://spare.") and job.model_id == "spare", (url, job.model_id)
+    assert abs(job.cost - 0.014) < 1e-9, job.cost
+    print(f"Очередь:        {url}, модель {job.model_id}, стоимость ${job.cost:.3f}")
+
+
+async def main(count: int):
+    await check_fallback()
+    await check_circuit_breaker()
+    await check_slow_timeout()
+    await check_hedging(count)
+    await check_all_failed()
+    await check_scheduler()
+    print("OK")
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    asyncio.run(main(int(args[0]) if args else 200))
@@ -0,0 +1,287 @@
+"""
+Нагрузочный тест генерации против локального stub-сервера Replicate.
+Запускает N одновременных генераций и параллельно "нажимает кнопки меню":
+если event loop блокируется рендером, задержка обработки кнопок вырастет до секунд.
+Stub умеет отправлять вебхук о завершении (как Replicate с webhook_events_filter=["completed"]).
+--img2img — image-to-image: каждое "фото" (JPEG 2560x1920, HD-фото из Telegram) скачивается
+из фейкового Telegram, уменьшается и уходит в stub как data URI; без флага — text-to-image.
+--grid — превью-сетка: N стилей одного фото через очередь генераций (лимит 1 задача на пользователя)
+по одному стилю подряд против одной пакетной задачи design_grid.
+--preview — двухфазный рендер: N задач с черновиком, перцентили задержки черновика и финального рендера.
+Время рендера в stub пропорционально числу шагов (25+ шагов — полное время).
+Запуск: python bench_replicate.py [N генераций] [секунд на рендер] [--webhook] [--img2img] [--grid | --preview]
+"""
+import asyncio
+import base64
+import io
+import json
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+STUB_PORT = 8765
+WEBHOOK_PORT = 8766
+WEBHOOK_PATH = "/replicate/webhook"
+WEBHOOK_SECRET = "whsec_" + base64.b64encode(b"bench-webhook-secret").decode()
+os.environ["REPLICATE_API_TOKEN"] = "stub-token"
+os.environ["REPLICATE_API_BASE"] = f"http://127.0.0.1:{STUB_PORT}/v1"
+os.environ["REPLICATE_IMG2IMG"] = "true" if "--img2img" in sys.argv else "false"
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "bot"))
+
+from services.replicate_api import generate_image, replicate_client
+from services.replicate_webhook import sign, start_webhook_server
+
+# Задержка скачивания файла из Telegram (сеть), секунд
+DOWNLOAD_SECONDS = 0.15
+# Столько шагов диффузии рендерится за полное время render_seconds
+FULL_STEPS = 25
+
+
+def make_camera_photo() -> bytes:
+    """JPEG размером с HD-фото Telegram (шум, чтобы не сжимался до пары килобайт)"""
+    from PIL import Image
+    image = Image.frombytes("RGB", (640, 480), random.randbytes(640 * 480 * 3)).resize((2560, 1920))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=92)
+    return output.getvalue()
+
+
+class FakeBot:
+    """Вместо aiogram.Bot: download отдает одно и то же фото с сетевой задержкой"""
+
+    def __init__(self, photo: bytes):
+        self.photo = photo
+        self.downloads = 0
+
+    async def download(self, file_id):
+        await asyncio.sleep(DOWNLOAD_SECONDS)
+        self.downloads += 1
+        return io.BytesIO(self.photo)
+
+
+def make_stub_app(render_seconds: float, counters: dict) -> web.Application:
+    """Минимальный Predictions API: рендер занимает render_seconds"""
+    predictions = {}
+    ids = itertools.count(1)
+    webhook_tasks = set()
+
+    async def send_webhook(url: str, prediction_id: str, model_input: dict, ready_at: float):
+        await asyncio.sleep(max(0.0, ready_at - time.monotonic()))
+        # Как Replicate: тело подписано секретом вебхука
+        body = json.dumps(_state(prediction_id, model_input, ready_at)).encode()
+        webhook_id, timestamp = f"msg_{prediction_id}", str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            "webhook-id": webhook_id,
+            "webhook-timestamp": timestamp,
+            "webhook-signature": f"v1,{sign(WEBHOOK_SECRET, webhook_id, timestamp, body)}",
+        }
+        async with aiohttp.ClientSession() as session:
+            await session.post(url, data=body, headers=headers)
+        counters["webhooks"] += 1
+
+    async def create(request: web.Request):
+        body = await request.json()
+        counters["payload_bytes"] += request.content_length or 0
+        prediction_id = f"p{next(ids)}"
+        model_input = body.get("input", {})
+        steps = model_input.get("num_inference_steps") or model_input.get("steps") or FULL_STEPS
+        ready_at = time.monotonic() + render_seconds * min(1.0, steps / FULL_STEPS)
+        predictions[prediction_id] = ready_at
+        counters["creates"] += 1
+
+        if body.get("webhook"):
+            task = asyncio.create_task(send_webhook(body["webhook"], prediction_id, body.get("input", {}), ready_at))
+            webhook_tasks.add(task)
+            task.add_done_callback(webhook_tasks.discard)
+
+        # Prefer: wait — держим соединение до результата, но не дольше wait секунд
+        wait = 0
+        prefer = request.headers.get("Prefer", "")
+        if prefer.startswith("wait"):
+            wait = float(prefer.split("=")[1]) if "=" in prefer else 60
+        await asyncio.sleep(min(wait, render_seconds))
+        return web.json_response(_state(prediction_id, body.get("input", {}), ready_at))
+
+    async def get(request: web.Request):
+        prediction_id = request.match_info["id"]
+        counters["polls"] += 1
+        return web.json_response(_state(prediction_id, {}, predictions[prediction_id]))
+
+    def _state(prediction_id: str, model_input: dict, ready_at: float) -> dict:
+        done = time.monotonic() >= ready_at
+        return {
+            "id": prediction_id,
+            "input": model_input,
+            "status": "succeeded" if done else "processing",
+            "output": f"https://example.com/{prediction_id}.webp" if done else None,
+            "urls": {"get": f"http://127.0.0.1:{STUB_PORT}/v1/predictions/{prediction_id}"},
+        }
+
+    app = web.Application()
+    app.router.add_post("/v1/models/{owner}/{name}/predictions", create)
+    app.router.add_get("/v1/predictions/{id}", get)
+    return app
+
+
+async def menu_clicks(stop: asyncio.Event, lags: list):
+    """Имитация кнопок меню: каждые 50 мс меряем, насколько опоздал колбэк"""
+    while not stop.is_set():
+        expected = time.perf_counter() + 0.05
+        await asyncio.sleep(0.05)
+        lags.append(time.perf_counter() - expected)
+
+
+async def main(count: int, render_seconds: float, use_webhook: bool, img2img: bool):
+    counters = {"creates": 0, "polls": 0, "webhooks": 0, "payload_bytes": 0}
+    photo = make_camera_photo() if img2img else b""
+    bot = FakeBot(photo)
+    runner = web.AppRunner(make_stub_app(render_seconds, counters))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", STUB_PORT).start()
+
+    webhook_runner = None
+    if use_webhook:
+        replicate_client.webhook_url = f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+        webhook_runner = await start_webhook_server("127.0.0.1", WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+
+    stop = asyncio.Event()
+    lags = []
+    clicker = asyncio.create_task(menu_clicks(stop, lags))
+
+    latencies = []
+
+    async def one() -> str | None:
+        started = time.perf_counter()
+        result = await generate_image("file_id", "living_room", "modern", bot)
+        latencies.append(time.perf_counter() - started)
+        return result
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(count)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await clicker
+
+    await replicate_client.close()
+    if webhook_runner:
+        await webhook_runner.cleanup()
+    await runner.cleanup()
+
+    ok = sum(1 for r in results if r)
+    latencies.sort()
+    print(f"Генераций: {ok}/{count} за {elapsed:.2f} c (рендер {render_seconds} c, "
+          f"лимит параллельности {replicate_client._max_concurrency}, "
+          f"{'image-to-image' if img2img else 'text-to-image'})")
+    print(f"Задержка генерации: p50 {latencies[len(latencies) // 2]:.2f} c, max {latencies[-1]:.2f} c")
+    if img2img:
+        print(f"Фото: {len(photo) // 1024} КиБ, скачиваний {bot.downloads}, "
+              f"тело запроса в среднем {counters['payload_bytes'] // max(1, counters['creates']) // 1024} КиБ")
+    print(f"Задержка кнопок меню: max {max(lags) * 1000:.1f} мс, "
+          f"средняя {sum(lags) / len(lags) * 1000:.1f} мс на {len(lags)} нажатий")
+    print(f"Запросов к API: создание {counters['creates']}, опрос {counters['polls']}, "
+          f"вебхуков {counters['webhooks']} ({'вебхук' if use_webhook else 'опрос с backoff'})")
+    assert max(lags) < 0.5, "event loop блокируется генерацией"
+
+
+async def grid_main(count: int, render_seconds: float, img2img: bool):
+    """N стилей одного фото: N задач design по очереди против одной задачи design_grid"""
+    from database.db import db
+    from services.generation_queue import generation_scheduler, OPERATION_GRID
+
+    counters = {"creates": 0, "polls": 0, "webhooks": 0, "payload_bytes": 0}
+    photo = make_camera_photo() if img2img else b""
+    bot = FakeBot(photo)
+    runner = web.AppRunner(make_stub_app(render_seconds, counters))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", STUB_PORT).start()
+
+    db.db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db.analytics_sync = True
+    await db.init_db()
+    generation_scheduler.per_user_limit = 1
+    await generation_scheduler.start(bot=bot)
+
+    styles = ["modern", "minimalist", "scandinavian", "industrial", "rustic", "japandi", "boho",
+              "mediterranean", "midcentury", "artdeco"][:count]
+
+    start = time.perf_counter()
+    jobs = [await generation_scheduler.submit(1, 1, "design", "file_id", "living_room", style, photo_unique_id="u1")
+            for style in styles]
+    single = await asyncio.gather(*(job.future for job in jobs))
+    single_elapsed = time.perf_counter() - start
+    single_creates, single_downloads = counters["creates"], bot.downloads
+
+    start = time.perf_counter()
+    job = await generation_scheduler.submit(1, 1, OPERATION_GRID, "file_id", "bedroom", ",".join(styles),
+                                            photo_unique_id="u2")
+    grid = await job.future
+    grid_elapsed = time.perf_counter() - start
+
+    await generation_scheduler.stop()
+    await replicate_client.close()
+    await db.close()
+    await runner.cleanup()
+
+    print(f"По одному стилю: {sum(1 for r in single if r)}/{len(styles)} за {single_elapsed:.2f} c, "
+          f"предсказаний {single_creates}, скачиваний фото {single_downloads}")
+    print(f"Превью-сетка:    {sum(1 for r in grid if r)}/{len(styles)} за {grid_elapsed:.2f} c, "
+          f"предсказаний {counters['creates'] - single_creates}, скачиваний фото {bot.downloads - single_downloads}")
+    print(f"Ускорение: {single_elapsed / grid_elapsed:.1f}x (рендер {render_seconds} c, "
+          f"{'image-to-image' if img2img else 'text-to-image'})")
+
+
+async def preview_main(count: int, render_seconds: float, img2img: bool):
+    """N задач design с черновиком от разных пользователей: задержки обеих фаз"""
+    from database.db import db
+    from services.generation_queue import generation_scheduler
+    from services.latency import render_latency
+
+    counters = {"creates": 0, "polls": 0, "webhooks": 0, "payload_bytes": 0}
+    bot = FakeBot(make_camera_photo() if img2img else b"")
+    runner = web.AppRunner(make_stub_app(render_seconds, counters))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", STUB_PORT).start()
+
+    db.db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db.analytics_sync = True
+    await db.init_db()
+    await generation_scheduler.start(bot=bot)
+
+    start = time.perf_counter()
+    jobs = [await generation_scheduler.submit(user_id, user_id, "design", "file_id", "living_room", "modern",
+                                              photo_unique_id=f"u{user_id}", fast_preview=True)
+            for user_id in range(1, count + 1)]
+    results = await asyncio.gather(*(job.future for job in jobs))
+    elapsed = time.perf_counter() - start
+
+    await generation_scheduler.stop()
+    await replicate_client.close()
+    await db.close()
+    await runner.cleanup()
+
+    print(f"Генераций с черновиком: {sum(1 for r in results if r)}/{count} за {elapsed:.2f} c "
+          f"(рендер {render_seconds} c, {'image-to-image' if img2img else 'text-to-image'}), "
+          f"предсказаний {counters['creates']}")
+    for phase, title in (("preview", "Черновик "), ("full", "Финальный")):
+        stats = render_latency.stats(phase)
+        print(f"{title}: p50 {stats['p50']} мс, p90 {stats['p90']} мс, p95 {stats['p95']} мс, "
+              f"p99 {stats['p99']} мс ({stats['count']} замеров)")
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    n = int(args[0]) if len(args) > 0 else 20
+    seconds = float(args[1]) if len(args) > 1 else 2.0
+    if "--grid" in sys.argv:
+        asyncio.run(grid_main(min(n, 10), seconds, "--img2img" in sys.argv))
+    elif "--preview" in sys.argv:
+        asyncio.run(preview_main(n, seconds, "--img2img" in sys.argv))
+    else:
+        asyncio.run(main(n, seconds, "--webhook" in sys.argv, "--img2img" in sys.argv))
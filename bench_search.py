@@ -0,0 +1,108 @@
+"""
+Бенчмарк поиска пользователей (users_fts, FTS5 trigram) на большой таблице users.
+Заполняет временную БД N пользователями (username из случайных слогов, реферальный код,
+Telegram-подобный user_id), затем меряет p50/p95/p99 вызова Database.search_users через пул
+(точный запрос по индексам users + страница users_fts) по типам запросов
+и для сравнения — LIKE '%...%' по users (полный проход таблицы).
+Запросы короче 3 символов trigram-индекс не обслуживает — для них только точное совпадение (SEARCH_USERS_EXACT).
+Запуск: python bench_search.py [N пользователей] [запросов на тип]
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "bot"))
+
+from database.db import Database
+from services.latency import _nearest_rank
+
+SYLLABLES = ["ka", "ri", "mo", "to", "lex", "an", "dr", "ei", "vla", "dim", "ser", "gei", "na", "ta",
+             "sha", "ol", "ga", "pa", "vel", "ny", "ki", "ra", "zo", "iv", "nik", "mi", "ha", "il"]
+
+
+def make_username(rng: random.Random) -> str:
+    name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    return name + (str(rng.randint(1, 9999)) if rng.random() < 0.6 else "")
+
+
+def populate(db_path: str, count: int, rng: random.Random) -> list:
+    """Пользователи одной транзакцией; триггер users_fts_insert индексирует их по ходу"""
+    users = []
+    seen = set()
+    while len(users) < count:
+        user_id = rng.randint(10 ** 8, 8 * 10 ** 9)
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+        users.append((user_id, make_username(rng), f"REF{user_id:09X}"))
+    with sqlite3.connect(db_path) as conn:
+        conn.executemany("INSERT INTO users (user_id, username, referral_code) VALUES (?, ?, ?)", users)
+    return users
+
+
+def percentiles(samples: list) -> str:
+    ordered = sorted(samples)
+    return "  ".join(f"p{p} {_nearest_rank(ordered, p) * 1000:7.3f} мс" for p in (50, 95, 99))
+
+
+def main(count: int, per_kind: int):
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "search.db")
+
+        async def init():
+            database = Database(db_path, readers=1)
+            await database.init_db()
+            await database.close()
+
+        asyncio.run(init())
+        start = time.perf_counter()
+        users = populate(db_path, count, rng)
+        print(f"Пользователей: {count}, заполнение с индексом FTS: {time.perf_counter() - start:.1f} c, "
+              f"БД {os.path.getsize(db_path) / 2 ** 20:.0f} МиБ")
+
+        sample = rng.sample(users, per_kind)
+        kinds = {
+            "username целиком": [u[1] for u in sample],
+            "часть username (5 симв.)": [u[1][1:6] for u in sample],
+            "user_id целиком": [str(u[0]) for u in sample],
+            "часть user_id (6 цифр)": [str(u[0])[2:8] for u in sample],
+            "реферальный код": [u[2] for u in sample],
+            "нет совпадений": [f"zz{rng.randint(0, 10 ** 6)}qq" for _ in sample],
+            "короткий (2 симв., точный)": [u[1][:2] for u in sample],
+        }
+
+        async def through_pool():
+            database = Database(db_path)
+            await database.connect()
+            await database.search_users("warmup")
+            print("\n— Database.search_users (пул aiosqlite, страница 10) —")
+            for kind, queries in kinds.items():
+                samples = []
+                for text in queries:
+                    t = time.perf_counter()
+                    await database.search_users(text)
+                    samples.append(time.perf_counter() - t)
+                print(f"{kind:<28} {percentiles(samples)}")
+            await database.close()
+
+        asyncio.run(through_pool())
+
+        conn = sqlite3.connect(db_path)
+        # Поиск подстроки без индекса: без совпадений — полный проход таблицы (меряем на нескольких запросах)
+        samples = []
+        for text in kinds["нет совпадений"][:5]:
+            t = time.perf_counter()
+            conn.execute("SELECT * FROM users WHERE username LIKE ? LIMIT 11", (f"%{text}%",)).fetchall()
+            samples.append(time.perf_counter() - t)
+        print(f"{'LIKE %...%, нет совпадений':<28} {percentiles(samples)}")
+        conn.close()
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    main(int(args[0]) if args else 1_000_000, int(args[1]) if len(args) > 1 else 200)
@@ -16,6 +16,61 @@ class Config:
     """Configuration class for bot settings"""
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     REPLICATE_API_TOKEN = os.getenv('REPLICATE_API_TOKEN')
+    REPLICATE_API_BASE = os.getenv('REPLICATE_API_BASE', 'https://api.replicate.com/v1')
+    REPLICATE_MAX_CONCURRENCY = int(os.getenv('REPLICATE_MAX_CONCURRENCY', '8'))  # одновременных запросов
+    REPLICATE_TIMEOUT = float(os.getenv('REPLICATE_TIMEOUT', '180'))  # секунд на одно предсказание
+
+    # Вебхук Replicate: публичный URL, по которому Replicate сообщит о завершении предсказания.
+    # Без него результат забирается опросом с растущей паузой.
+    REPLICATE_WEBHOOK_URL = os.getenv('REPLICATE_WEBHOOK_URL')
+    REPLICATE_WEBHOOK_HOST = os.getenv('REPLICATE_WEBHOOK_HOST', '0.0.0.0')
+    REPLICATE_WEBHOOK_PORT = int(os.getenv('REPLICATE_WEBHOOK_PORT', '8081'))
+    REPLICATE_WEBHOOK_PATH = os.getenv('REPLICATE_WEBHOOK_PATH', '/replicate/webhook')
+    REPLICATE_WEBHOOK_SECRET = os.getenv('REPLICATE_WEBHOOK_SECRET')  # whsec_...; без него вебхуки не принимаются
+
+    # Image-to-image: фото пользователя уменьшается в памяти и передается модели (data URI).
+    # REPLICATE_IMG2IMG=false — прежний режим text-to-image без фото
+    REPLICATE_IMG2IMG = os.getenv('REPLICATE_IMG2IMG', 'true').lower() == 'true'
+    IMAGE_INPUT_MAX_SIDE = int(os.getenv('IMAGE_INPUT_MAX_SIDE', '1024'))  # px по длинной стороне
+    IMAGE_INPUT_QUALITY = int(os.getenv('IMAGE_INPUT_QUALITY', '90'))  # качество JPEG
+    # Кэш подготовленных фото (ключ — file_unique_id): одно скачивание на все генерации по фото
+    PHOTO_CACHE_MEMORY_MB = int(os.getenv('PHOTO_CACHE_MEMORY_MB', '64'))
+    PHOTO_CACHE_DIR = os.getenv('PHOTO_CACHE_DIR', 'cache/photos')
+    PHOTO_CACHE_DISK_MB = int(os.getenv('PHOTO_CACHE_DISK_MB', '512'))
+
+    # Очередь генераций
+    GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', '4'))  # одновременных запусков предсказаний
+    GENERATION_MAX_IN_FLIGHT = int(os.getenv('GENERATION_MAX_IN_FLIGHT', '16'))  # предсказаний в рендере
+    GENERATION_PER_USER_LIMIT = int(os.getenv('GENERATION_PER_USER_LIMIT', '1'))  # одновременно на пользователя
+    GENERATION_MAX_QUEUE = int(os.getenv('GENERATION_MAX_QUEUE', '100'))  # задач в ожидании
+    # Превью-сетка: столько стилей рендерится одним пакетом (альбом Telegram — от 2 до 10 фото).
+    # Цена пакета — настройка preview_grid_price в таблице settings
+    PREVIEW_GRID_SIZE = min(10, max(2, int(os.getenv('PREVIEW_GRID_SIZE', '4'))))
+
+    # Провайдеры генерации: порядок = приоритет фоллбэка (replicate, http, local)
+    GENERATION_PROVIDERS = os.getenv('GENERATION_PROVIDERS', 'replicate')
+    GENERATION_HEDGE = os.getenv('GENERATION_HEDGE', 'false').lower() == 'true'  # второй провайдер после p95
+    GENERATION_HEDGE_MIN_SAMPLES = int(os.getenv('GENERATION_HEDGE_MIN_SAMPLES', '20'))  # замеров до хеджирования
+    GENERATION_SLOW_TIMEOUT = float(os.getenv('GENERATION_SLOW_TIMEOUT', '150'))  # секунд до фоллбэка
+    PROVIDER_FAILURE_THRESHOLD = int(os.getenv('PROVIDER_FAILURE_THRESHOLD', '3'))  # ошибок подряд до паузы
+    PROVIDER_COOLDOWN = float(os.getenv('PROVIDER_COOLDOWN', '60'))  # секунд паузы провайдера
+    HTTP_PROVIDER_URL = os.getenv('HTTP_PROVIDER_URL')
+    HTTP_PROVIDER_TOKEN = os.getenv('HTTP_PROVIDER_TOKEN')
+    HTTP_PROVIDER_MODEL = os.getenv('HTTP_PROVIDER_MODEL', 'http')
+    HTTP_PROVIDER_COST = float(os.getenv('HTTP_PROVIDER_COST', '0'))  # $ за изображение
+    LOCAL_DIFFUSERS_MODEL = os.getenv('LOCAL_DIFFUSERS_MODEL', 'stabilityai/sdxl-turbo')  # нужны diffusers и torch
+    LOCAL_RENDER_DIR = os.getenv('LOCAL_RENDER_DIR', 'cache/local_renders')
+
+    # Кэш результатов генерации (повторный стиль на том же фото — без вызова модели)
+    RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', '3000'))  # секунд; выходные файлы Replicate живут час
+    RESULT_CACHE_MEMORY_ENTRIES = int(os.getenv('RESULT_CACHE_MEMORY_ENTRIES', '1000'))
+    RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', 'cache/results')
+    RESULT_CACHE_DISK_ENTRIES = int(os.getenv('RESULT_CACHE_DISK_ENTRIES', '10000'))
+
+    # Хранилище FSM: sqlite (по умолчанию) | redis | memory
+    FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+    FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.5'))  # секунд между сбросами в SQLite
+    REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
     YOOKASSA_SHOP_ID = os.getenv('YOOKASSA_SHOP_ID')
     YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY')
     
@@ -24,6 +79,21 @@ class Config:
 
     # Database settings
     DB_PATH = 'bot.db'
+    DB_READERS = int(os.getenv('DB_READERS', '4'))  # соединений-читателей в пуле
+    BALANCE_CACHE_TTL = float(os.getenv('BALANCE_CACHE_TTL', '60'))  # секунд; кэш обновляется при каждом изменении
+    BALANCE_VERIFY_INTERVAL = float(os.getenv('BALANCE_VERIFY_INTERVAL', '3600'))  # секунд между сверками журнала
+    BALANCE_VERIFY_BATCH = int(os.getenv('BALANCE_VERIFY_BATCH', '500'))  # пользователей за один запрос сверки
+    ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '0.5'))  # секунд между записями активности
+    ACTIVITY_BATCH_SIZE = int(os.getenv('ACTIVITY_BATCH_SIZE', '200'))  # событий, при которых запись идет сразу
+    ANALYTICS_SYNC = os.getenv('ANALYTICS_SYNC', 'false').lower() == 'true'  # писать аналитику без буфера (тесты)
+    DASHBOARD_CACHE_TTL = float(os.getenv('DASHBOARD_CACHE_TTL', '30'))  # секунд жизни снимка статистики админки
+
+    # Профиль SQLite (PRAGMA для каждого соединения)
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))  # байт
+    SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', '-16000'))  # < 0 — в KiB
+    SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))  # мс
 
     # Free generations for new users
     FREE_GENERATIONS = 3
@@ -1,10 +1,34 @@
 # bot/database/db.py
 # --- ОБНОВЛЕН: 2025-12-04 11:36 - Добавлены методы для уведомлений и источников трафика ---
 # Добавлены методы get_user_recent_payments и get_referrer_info для расширенного поиска
+# [2025-12-08] Пул соединений: один писатель + N читателей вместо aiosqlite.connect на каждый вызов
+# [2025-12-08] WAL + настраиваемые PRAGMA (StorageProfile), запись через единую очередь/задачу-писателя
+# [2025-12-08] Миграции схемы (schema_version) применяются в init_db
+# [2025-12-08] Кэш балансов в памяти: write-through из add_tokens/decrease_balance/рефералов, TTL
+# [2025-12-08] Снимок настроек в памяти (DEFAULT_SETTINGS + таблица settings), типизированные геттеры
+# [2025-12-08] Атомарное списание (UPDATE ... WHERE balance >= ? RETURNING) и возврат токенов
+# [2025-12-08] Каждое изменение баланса пишется в balance_ledger в той же транзакции; сверка verify_balances
+# [2025-12-08] log_activity буферизуется и пишется пачками (executemany), last_activity — одно обновление на пользователя
+# [2025-12-08] log_generation пишется через тот же буфер (+ model_id, duration_ms, cost); analytics_sync — запись сразу
+# [2025-12-08] Суточные агрегаты daily_stats обновляются при записи; get_daily_stats — дашборд одним запросом
+# [2025-12-08] get_dashboard_snapshot: снимок метрик дашборда с коротким TTL, параллельные запросы объединяются
+# [2025-12-08] get_users_page: keyset-пагинация по (created_at, user_id) вместо OFFSET + COUNT(*)
+# [2025-12-08] search_users: поиск по индексу users_fts (подстроки, ранжирование, страницы)
+# [2025-12-08] create_generation_job сохраняет photo_unique_id
+# [2025-12-08] log_generation: preview_ms — задержка черновика двухфазного рендера
+# [2025-12-08] get_users_page: курсор — user_id (created_at читается из БД), пользователи без created_at — в конце
+# [2025-12-08] Ошибка записи пачки аналитики: откат транзакции, события и генерации возвращаются в буфер, повтор сброса
+# [2025-12-08] search_users: точные совпадения по индексам users, подстроки — users_fts в порядке индекса без ранжирования
+# [2025-12-08] debit_balance: ошибка БД пробрасывается (None — только «не хватает генераций»)
+# [2025-12-08] Удалены get_total_generations, get_popular_rooms, get_revenue_by_period и др. — дашборд читает daily_stats
 
 import aiosqlite
+import asyncio
 import logging
 import secrets
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timedelta
 
@@ -16,16 +40,28 @@ from database.models import (
     CREATE_GENERATIONS_TABLE, CREATE_USER_ACTIVITY_TABLE,
     CREATE_ADMIN_NOTIFICATIONS_TABLE, CREATE_USER_SOURCES_TABLE,
     DEFAULT_SETTINGS,
+    # Миграции
+    CREATE_SCHEMA_VERSION_TABLE, GET_SCHEMA_VERSION, SET_SCHEMA_VERSION, MIGRATIONS,
     # Пользователи
-    GET_USER, CREATE_USER, UPDATE_BALANCE, DECREASE_BALANCE, GET_BALANCE, UPDATE_LAST_ACTIVITY,
+    GET_USER, CREATE_USER, UPDATE_BALANCE, DEBIT_BALANCE, GET_BALANCE,
+    INSERT_LEDGER_ENTRY, VERIFY_BALANCES_BATCH,
     # Реферальные коды
-    UPDATE_REFERRAL_CODE, GET_USER_BY_REFERRAL_CODE, UPDATE_REFERRED_BY, INCREMENT_REFERRALS_COUNT,
+    UPDATE_REFERRAL_CODE, GET_USER_BY_REFERRAL_CODE,
+    GET_USERS_FIRST_PAGE, GET_USERS_AFTER, GET_USERS_BEFORE, GET_USER_CREATED_AT, GET_USERS_NO_DATE_AFTER,
+    GET_USERS_NO_DATE_BEFORE, GET_USERS_OLDEST, SEARCH_USERS, SEARCH_USERS_EXACT, UPDATE_REFERRED_BY, INCREMENT_REFERRALS_COUNT,
     # Платежи
     CREATE_PAYMENT, GET_PENDING_PAYMENT, UPDATE_PAYMENT_STATUS,
     # Генерации
     CREATE_GENERATION, INCREMENT_TOTAL_GENERATIONS,
+    # Суточные агрегаты
+    ADD_DAILY_STAT, ADD_DAILY_GENERATING_USER, ADD_DAILY_PAYMENT, ADD_DAILY_REVENUE, GET_DAILY_STATS_SUMMARY,
+    # Очередь генераций
+    CREATE_GENERATION_JOB, START_GENERATION_JOB, FINISH_GENERATION_JOB, GET_UNFINISHED_GENERATION_JOBS,
+    SET_GENERATION_JOB_PREDICTION,
+    # Хранилище FSM
+    GET_FSM_RECORD, UPSERT_FSM_RECORD, DELETE_FSM_RECORD,
     # Активность
-    LOG_USER_ACTIVITY,
+    LOG_USER_ACTIVITY, UPDATE_LAST_ACTIVITY_AT,
     # Реферальный баланс
     GET_REFERRAL_BALANCE, ADD_REFERRAL_BALANCE, DECREASE_REFERRAL_BALANCE, UPDATE_TOTAL_PAID,
     # Реферальные начисления
@@ -37,19 +73,228 @@ from database.models import (
     # Реквизиты
     SET_PAYMENT_DETAILS, GET_PAYMENT_DETAILS,
     # Настройки
-    GET_SETTING, SET_SETTING, GET_ALL_SETTINGS
+    SET_SETTING, GET_ALL_SETTINGS
 )
 
 logger = logging.getLogger(__name__)
 
+# Больше любого user_id Telegram: граница «с начала» для выборок по user_id
+MAX_USER_ID = 2 ** 63 - 1
+
+
+@dataclass
+class StorageProfile:
+    """
+    Профиль хранилища SQLite: PRAGMA, применяемые к каждому соединению пула.
+    WAL позволяет читателям работать параллельно с писателем.
+    """
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    mmap_size: int = 256 * 1024 * 1024   # байт
+    cache_size: int = -16000             # отрицательное значение = KiB (≈16 МБ)
+    busy_timeout: int = 5000             # мс
+    temp_store: str = "MEMORY"
+
+    def connection_pragmas(self) -> List[str]:
+        """PRAGMA уровня соединения (journal_mode задается один раз писателем)"""
+        return [
+            f"PRAGMA synchronous = {self.synchronous}",
+            f"PRAGMA mmap_size = {int(self.mmap_size)}",
+            f"PRAGMA cache_size = {int(self.cache_size)}",
+            f"PRAGMA busy_timeout = {int(self.busy_timeout)}",
+            f"PRAGMA temp_store = {self.temp_store}",
+        ]
+
 
 class Database:
-    def __init__(self, db_path: str = "bot.db"):
+    def __init__(self, db_path: str = "bot.db", readers: int = 4, profile: Optional[StorageProfile] = None,
+                 balance_cache_ttl: float = 60, activity_flush_interval: float = 0.5,
+                 activity_batch_size: int = 200, analytics_sync: bool = False,
+                 dashboard_cache_ttl: float = 30):
         self.db_path = db_path
+        self.readers = readers
+        self.profile = profile or StorageProfile()
+
+        # Кэш балансов: user_id -> (expires_at, balance). Обновляется при каждом изменении
+        # баланса через методы Database (write-through); TTL — страховка от внешних правок БД.
+        self.balance_cache_ttl = balance_cache_ttl
+        self._balances: Dict[int, Tuple[float, int]] = {}
+        self._balance_epoch = 0
+        self._balance_metrics = {'hits': 0, 'misses': 0, 'writes': 0}
+
+        # Снимок настроек: DEFAULT_SETTINGS + таблица settings (загружается в init_db, обновляется в set_setting)
+        self._settings: Dict[str, str] = dict(DEFAULT_SETTINGS)
+
+        # Буфер аналитики (активность и генерации): события копятся в памяти и пишутся пачкой
+        # раз в activity_flush_interval секунд или при activity_batch_size событиях — хэндлер
+        # не ждет commit ради аналитики. analytics_sync=True — писать сразу (тесты, отладка).
+        self.activity_flush_interval = activity_flush_interval
+        self.activity_batch_size = activity_batch_size
+        self.analytics_sync = analytics_sync
+        self._activity: List[Tuple[int, str, str]] = []
+        self._generations: List[Tuple[Any, ...]] = []
+        self._generation_counts: Dict[int, int] = {}
+        self._last_activity: Dict[int, str] = {}
+        self._activity_task: Optional[asyncio.Task] = None
+
+        # Снимок дашборда админки: (expires_at, метрики); пока снимок считается, остальные ждут его же
+        self.dashboard_cache_ttl = dashboard_cache_ttl
+        self._dashboard: Optional[Tuple[float, Dict[str, Any]]] = None
+        self._dashboard_loading: Optional[asyncio.Future] = None
+
+        # Пул соединений (открывается в connect/init_db, закрывается в close)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._reader_pool: Optional[asyncio.Queue] = None
+        self._reader_conns: List[aiosqlite.Connection] = []
+        self._connect_lock: Optional[asyncio.Lock] = None
+
+        # Очередь записи: все изменяющие методы проходят через одну задачу-писателя
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+
+    # ===== ПУЛ СОЕДИНЕНИЙ =====
+
+    async def _open_connection(self, readonly: bool = False) -> aiosqlite.Connection:
+        """Открыть долгоживущее соединение (строки доступны и по индексу, и по имени)"""
+        conn = await aiosqlite.connect(self.db_path, timeout=self.profile.busy_timeout / 1000)
+        conn.row_factory = aiosqlite.Row
+        for pragma in self.profile.connection_pragmas():
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    async def connect(self):
+        """
+        Открыть пул: одно соединение-писатель и self.readers соединений-читателей.
+        Повторный вызов ничего не делает.
+        """
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+
+            self._writer = await self._open_connection()
+            async with self._writer.execute(f"PRAGMA journal_mode = {self.profile.journal_mode}") as cursor:
+                journal_mode = (await cursor.fetchone())[0]
+
+            self._reader_pool = asyncio.Queue()
+            for _ in range(max(1, self.readers)):
+                conn = await self._open_connection(readonly=True)
+                self._reader_conns.append(conn)
+                self._reader_pool.put_nowait(conn)
+
+            self._write_queue = asyncio.Queue()
+            self._writer_task = asyncio.create_task(self._writer_loop())
+
+            logger.info(
+                f"Пул БД открыт: 1 писатель + {len(self._reader_conns)} читателей "
+                f"({self.db_path}, journal_mode={journal_mode}, synchronous={self.profile.synchronous})"
+            )
+
+    async def close(self):
+        """Дождаться завершения очереди записи и закрыть все соединения пула"""
+        if self._writer is None:
+            return
+
+        # Сбрасываем накопленную аналитику, пока пул еще открыт (отложенный сброс дожидаемся)
+        while self._analytics_pending() or (self._activity_task and not self._activity_task.done()):
+            if self._activity_task and not self._activity_task.done():
+                await asyncio.gather(self._activity_task, return_exceptions=True)
+            elif not await self.flush_activity():
+                # БД не принимает запись — не зацикливаемся на повторах при остановке
+                logger.error(f"Аналитика не записана при закрытии БД: {self._analytics_pending()} записей")
+                if self._activity_task:
+                    self._activity_task.cancel()
+                break
+
+        # Последний слот в очереди: получим его, только когда все предыдущие записи завершены
+        async with self._write():
+            pass
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+
+        for conn in self._reader_conns:
+            await conn.close()
+        await self._writer.close()
+
+        self._writer = None
+        self._writer_task = None
+        self._write_queue = None
+        self._reader_pool = None
+        self._reader_conns = []
+        logger.info("Пул БД закрыт")
+
+    async def _writer_loop(self):
+        """
+        Единственная задача-писатель.
+        По очереди (FIFO) выдает соединение-писатель запросам из _write_queue
+        и ждет, пока запрос его вернет. Незакоммиченную транзакцию откатывает.
+        """
+        while True:
+            granted, released = await self._write_queue.get()
+            if granted.done():
+                # Запрос отменен, пока стоял в очереди
+                continue
+
+            granted.set_result(self._writer)
+            await released.wait()
+
+            if self._writer.in_transaction:
+                try:
+                    await self._writer.rollback()
+                except Exception as e:
+                    logger.error(f"Ошибка отката транзакции писателя: {e}")
+
+    @asynccontextmanager
+    async def _read(self):
+        """Взять соединение-читатель из пула на время запроса"""
+        if self._writer is None:
+            await self.connect()
+
+        conn = await self._reader_pool.get()
+        try:
+            yield conn
+        finally:
+            self._reader_pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self):
+        """
+        Эксклюзивный доступ к соединению-писателю через очередь записи.
+        Незакоммиченная транзакция (метод упал до commit) откатывается задачей-писателем.
+        """
+        if self._writer is None:
+            await self.connect()
+
+        granted = asyncio.get_running_loop().create_future()
+        released = asyncio.Event()
+        self._write_queue.put_nowait((granted, released))
+
+        try:
+            conn = await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                # Слот уже выдан — возвращаем его, иначе очередь встанет
+                released.set()
+            else:
+                granted.cancel()
+            raise
+
+        try:
+            yield conn
+        finally:
+            released.set()
 
     async def init_db(self):
-        """Инициализация таблиц БД"""
-        async with aiosqlite.connect(self.db_path) as db:
+        """Инициализация пула соединений и таблиц БД"""
+        await self.connect()
+        async with self._write() as db:
             # Создаем все таблицы
             await db.execute(CREATE_USERS_TABLE)
             await db.execute(CREATE_PAYMENTS_TABLE)
@@ -67,13 +312,44 @@ class Database:
                 await db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", (key, value))
 
             await db.commit()
-            logger.info("База данных инициализирована")
+
+            # Применяем недостающие миграции схемы
+            await self._apply_migrations(db)
+
+        await self.reload_settings()
+        logger.info("База данных инициализирована")
+
+    async def _apply_migrations(self, db: aiosqlite.Connection):
+        """
+        Применить миграции из MIGRATIONS, версия которых выше текущей.
+        Каждая миграция выполняется в своей транзакции вместе с записью в schema_version.
+        """
+        await db.execute(CREATE_SCHEMA_VERSION_TABLE)
+        await db.commit()
+
+        async with db.execute(GET_SCHEMA_VERSION) as cursor:
+            current_version = (await cursor.fetchone())[0]
+
+        for version, description, statements in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version <= current_version:
+                continue
+            try:
+                await db.execute("BEGIN")
+                for statement in statements:
+                    await db.execute(statement)
+                await db.execute(SET_SCHEMA_VERSION, (version, description))
+                await db.commit()
+                logger.info(f"Миграция {version} применена: {description}")
+            except Exception as e:
+                await db.rollback()
+                logger.error(f"Ошибка миграции {version} ({description}): {e}")
+                raise
 
     # ===== ПОЛЬЗОВАТЕЛИ =====
 
     async def create_user(self, user_id: int, username: str = None, referrer_code: str = None) -> bool:
         """Создать нового пользователя с реферальным кодом"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 # Проверяем, есть ли уже пользователь
                 async with db.execute(GET_USER, (user_id,)) as cursor:
@@ -85,30 +361,42 @@ class Database:
                 ref_code = secrets.token_urlsafe(8)
 
                 # Получаем начальный бонус
-                initial_balance = int(await self.get_setting('welcome_bonus') or '3')
+                initial_balance = self.setting_int('welcome_bonus')
 
                 # Создаем пользователя
                 await db.execute(CREATE_USER, (user_id, username, initial_balance, ref_code))
+                await db.execute(ADD_DAILY_STAT, ('now', 'new_users', '', 1))
+                if initial_balance:
+                    await db.execute(
+                        INSERT_LEDGER_ENTRY, (user_id, initial_balance, 'welcome_bonus', None, initial_balance)
+                    )
 
                 # Обрабатываем реферальную систему
+                balances = {user_id: initial_balance}
                 if referrer_code:
-                    await self._process_referral(db, user_id, referrer_code)
+                    balances.update(await self._process_referral(db, user_id, referrer_code))
 
                 await db.commit()
+                for uid, balance in balances.items():
+                    self._cache_balance(uid, balance)
                 logger.info(f"Пользователь {user_id} создан с реф. кодом {ref_code}")
                 return True
             except Exception as e:
                 logger.error(f"Ошибка создания пользователя: {e}")
                 return False
 
-    async def _process_referral(self, db: aiosqlite.Connection, user_id: int, referrer_code: str):
-        """Обработка реферальной системы при регистрации"""
+    async def _process_referral(self, db: aiosqlite.Connection, user_id: int, referrer_code: str) -> Dict[int, int]:
+        """
+        Обработка реферальной системы при регистрации.
+        Возвращает новые балансы {user_id: balance} — в кэш они попадают после commit.
+        """
+        balances = {}
         try:
             # Находим реферера
             async with db.execute(GET_USER_BY_REFERRAL_CODE, (referrer_code,)) as cursor:
                 referrer = await cursor.fetchone()
                 if not referrer:
-                    return
+                    return balances
 
             referrer_id = referrer[0]
 
@@ -119,61 +407,168 @@ class Database:
             await db.execute(INCREMENT_REFERRALS_COUNT, (referrer_id,))
 
             # Начисляем бонусы
-            inviter_bonus = int(await self.get_setting('referral_bonus_inviter') or '2')
-            invited_bonus = int(await self.get_setting('referral_bonus_invited') or '2')
+            inviter_bonus = self.setting_int('referral_bonus_inviter')
+            invited_bonus = self.setting_int('referral_bonus_invited')
 
-            await db.execute(UPDATE_BALANCE, (inviter_bonus, referrer_id))
-            await db.execute(UPDATE_BALANCE, (invited_bonus, user_id))
+            for uid, bonus, other_id in ((referrer_id, inviter_bonus, user_id), (user_id, invited_bonus, referrer_id)):
+                balance = await self._change_balance(db, uid, bonus, 'referral_bonus', str(other_id))
+                if balance is not None:
+                    balances[uid] = balance
 
             logger.info(f"Реферал: {referrer_id} пригласил {user_id}")
         except Exception as e:
             logger.error(f"Ошибка обработки реферала: {e}")
+        return balances
 
     async def get_user_data(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получить данные пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(GET_USER, (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
                     return dict(row)
                 return None
 
+    # ===== КЭШ БАЛАНСОВ =====
+
+    def _cache_balance(self, user_id: int, balance: int):
+        """Записать актуальный баланс в кэш (вызывается после commit)"""
+        self._balance_epoch += 1
+        self._balance_metrics['writes'] += 1
+        self._balances[user_id] = (time.monotonic() + self.balance_cache_ttl, balance)
+
+    def invalidate_balance(self, user_id: Optional[int] = None):
+        """Сбросить кэш баланса пользователя (или весь кэш)"""
+        self._balance_epoch += 1
+        if user_id is None:
+            self._balances.clear()
+        else:
+            self._balances.pop(user_id, None)
+
+    def balance_cache_stats(self) -> Dict[str, int]:
+        """Счетчики кэша балансов для админки"""
+        return {**self._balance_metrics, 'size': len(self._balances)}
+
     async def get_balance(self, user_id: int) -> int:
-        """Получить баланс генераций"""
-        async with aiosqlite.connect(self.db_path) as db:
+        """Получить баланс генераций (из кэша, если он свежий)"""
+        cached = self._balances.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            self._balance_metrics['hits'] += 1
+            return cached[1]
+
+        self._balance_metrics['misses'] += 1
+        epoch = self._balance_epoch
+        async with self._read() as db:
             async with db.execute(GET_BALANCE, (user_id,)) as cursor:
                 row = await cursor.fetchone()
-                return row[0] if row else 0
+                balance = row[0] if row else 0
+
+        # Пока шло чтение, баланс могли изменить — тогда прочитанное значение уже не кэшируем
+        if epoch == self._balance_epoch:
+            self._balances[user_id] = (time.monotonic() + self.balance_cache_ttl, balance)
+            if len(self._balances) > 100000:
+                self._prune_balances()
+        return balance
+
+    def _prune_balances(self):
+        now = time.monotonic()
+        for uid in [uid for uid, (expires_at, _) in self._balances.items() if expires_at <= now]:
+            del self._balances[uid]
+
+    async def _change_balance(self, db: aiosqlite.Connection, user_id: int, delta: int, reason: str,
+                              ref_id: Optional[str] = None, require_funds: bool = False) -> Optional[int]:
+        """
+        Изменить users.balance и записать проводку в balance_ledger — в транзакции вызывающего.
+        require_funds — списание только при достаточном балансе.
+        Возвращает новый баланс или None (нет пользователя / не хватает генераций).
+        """
+        if require_funds:
+            query, params = DEBIT_BALANCE, (-delta, user_id, -delta)
+        else:
+            query, params = UPDATE_BALANCE, (delta, user_id)
+
+        async with db.execute(query, params) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
 
-    async def decrease_balance(self, user_id: int) -> bool:
-        """Уменьшить баланс на 1"""
-        async with aiosqlite.connect(self.db_path) as db:
+        await db.execute(INSERT_LEDGER_ENTRY, (user_id, delta, reason, ref_id, row[0]))
+        return row[0]
+
+    async def debit_balance(self, user_id: int, amount: int = 1, reason: str = 'generation',
+                            ref_id: Optional[str] = None) -> Optional[int]:
+        """
+        Атомарно списать amount генераций.
+        Возвращает новый баланс или None, если генераций не хватает (баланс не меняется).
+        Ошибка БД пробрасывается: «не хватает генераций» и «не удалось списать» — разные ответы пользователю.
+        Параллельные списания не уводят баланс в минус: проверка и списание — один UPDATE.
+        """
+        async with self._write() as db:
             try:
-                await db.execute(DECREASE_BALANCE, (user_id,))
+                balance = await self._change_balance(db, user_id, -amount, reason, ref_id, require_funds=True)
                 await db.commit()
-                return True
             except Exception as e:
-                logger.error(f"Ошибка уменьшения баланса: {e}")
-                return False
+                # Транзакцию откатит задача-писатель
+                logger.error(f"Ошибка списания баланса: {e}")
+                raise
 
-    async def add_tokens(self, user_id: int, tokens: int) -> bool:
-        """Добавить генерации"""
-        async with aiosqlite.connect(self.db_path) as db:
+        if balance is None:
+            self.invalidate_balance(user_id)
+            return None
+        self._cache_balance(user_id, balance)
+        return balance
+
+    async def decrease_balance(self, user_id: int) -> bool:
+        """Уменьшить баланс на 1. False — генераций не хватает (ошибка БД — исключение)."""
+        return await self.debit_balance(user_id) is not None
+
+    async def refund_balance(self, user_id: int, amount: int = 1, ref_id: Optional[str] = None) -> bool:
+        """Вернуть списанные генерации (генерация не удалась)"""
+        refunded = await self.add_tokens(user_id, amount, reason='refund', ref_id=ref_id)
+        if refunded:
+            logger.info(f"Возврат {amount} генераций пользователю {user_id}")
+        return refunded
+
+    async def add_tokens(self, user_id: int, tokens: int, reason: str = 'credit',
+                         ref_id: Optional[str] = None) -> bool:
+        """
+        Добавить генерации.
+        reason / ref_id попадают в balance_ledger: 'payment' + ID платежа, 'admin' + ID админа и т.п.
+        """
+        async with self._write() as db:
             try:
-                await db.execute(UPDATE_BALANCE, (tokens, user_id))
+                balance = await self._change_balance(db, user_id, tokens, reason, ref_id)
                 await db.commit()
-                logger.info(f"Добавлено {tokens} генераций пользователю {user_id}")
+                if balance is not None:
+                    self._cache_balance(user_id, balance)
+                logger.info(f"Добавлено {tokens} генераций пользователю {user_id} ({reason})")
                 return True
             except Exception as e:
                 logger.error(f"Ошибка добавления токенов: {e}")
                 return False
 
+    async def verify_balances(self, after_user_id: int = 0,
+                              batch_size: int = 500) -> Tuple[List[Dict[str, int]], Optional[int], int]:
+        """
+        Сверить пачку пользователей (user_id > after_user_id): users.balance против суммы проводок.
+        Возвращает (расхождения, последний проверенный user_id или None, если пользователи кончились,
+        число проверенных).
+        """
+        async with self._read() as db:
+            async with db.execute(VERIFY_BALANCES_BATCH, (after_user_id, batch_size)) as cursor:
+                rows = await cursor.fetchall()
+
+        drifts = [
+            {'user_id': row[0], 'balance': row[1], 'ledger_balance': row[2]}
+            for row in rows if row[1] != row[2]
+        ]
+        return drifts, (rows[-1][0] if rows else None), len(rows)
+
     # ===== ПЛАТЕЖИ =====
 
     async def create_payment(self, payment_id: str, user_id: int, amount: int, tokens: int) -> bool:
         """Создать запись о платеже"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 await db.execute(CREATE_PAYMENT, (user_id, payment_id, amount, tokens, 'pending'))
                 await db.commit()
@@ -184,8 +579,11 @@ class Database:
 
     async def update_payment_status(self, payment_id: str, status: str) -> bool:
         """Обновить статус платежа"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
+                if status == 'succeeded':
+                    await db.execute(ADD_DAILY_PAYMENT, (payment_id,))
+                    await db.execute(ADD_DAILY_REVENUE, (payment_id,))
                 await db.execute(UPDATE_PAYMENT_STATUS, (status, payment_id))
                 await db.commit()
                 return True
@@ -195,8 +593,7 @@ class Database:
 
     async def get_payment(self, payment_id: str) -> Optional[Dict[str, Any]]:
         """Получить информацию о платеже"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute("SELECT * FROM payments WHERE yookassa_payment_id = ?", (payment_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -205,8 +602,7 @@ class Database:
 
     async def get_last_pending_payment(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получить последний ожидающий платеж"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(GET_PENDING_PAYMENT, (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -220,145 +616,218 @@ class Database:
     # ===== ГЕНЕРАЦИИ =====
 
     async def log_generation(self, user_id: int, room_type: str, style_type: str,
-                             operation_type: str = 'design', success: bool = True) -> bool:
+                             operation_type: str = 'design', success: bool = True,
+                             model_id: Optional[str] = None, duration_ms: Optional[int] = None,
+                             cost: Optional[float] = None, preview_ms: Optional[int] = None) -> bool:
         """
-        Залогировать генерацию.
+        Залогировать генерацию (в буфер аналитики; запись в БД — пачкой в фоне).
         Параметры:
         - user_id: ID пользователя
         - room_type: тип комнаты (напр. 'гостиная', 'кухня')
         - style_type: стиль (напр. 'минимализм', 'лофт')
         - operation_type: тип операции ('design' или др.)
         - success: успешность генерации
+        - model_id: модель, которой выполнен рендер
+        - duration_ms: длительность рендера, мс
+        - cost: стоимость рендера у провайдера, $
+        - preview_ms: через сколько мс пользователь увидел черновик (двухфазный рендер)
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        self._generations.append(
+            (user_id, room_type, style_type, operation_type, success, model_id, duration_ms, cost, preview_ms, now)
+        )
+        self._generation_counts[user_id] = self._generation_counts.get(user_id, 0) + 1
+        self._last_activity[user_id] = now
+        logger.info(f"Генерация: user={user_id}, room={room_type}, style={style_type}, {duration_ms} мс")
+        return await self._schedule_analytics_flush()
+
+    # ===== ОЧЕРЕДЬ ГЕНЕРАЦИЙ =====
+
+    async def create_generation_job(self, user_id: int, chat_id: int, operation_type: str, photo_id: str,
+                                    room_type: Optional[str], style_type: Optional[str], priority: int,
+                                    photo_unique_id: Optional[str] = None) -> int:
+        """Сохранить задачу генерации в очередь. Возвращает id задачи (0 при ошибке)."""
+        async with self._write() as db:
             try:
-                # Логируем в таблицу generations
-                await db.execute(CREATE_GENERATION, (user_id, room_type, style_type, operation_type, success))
+                cursor = await db.execute(
+                    CREATE_GENERATION_JOB,
+                    (user_id, chat_id, operation_type, photo_id, photo_unique_id, room_type, style_type, priority)
+                )
+                await db.commit()
+                return cursor.lastrowid
+            except Exception as e:
+                logger.error(f"Ошибка создания задачи генерации: {e}")
+                return 0
 
-                # Увеличиваем счетчик в таблице users
-                await db.execute(INCREMENT_TOTAL_GENERATIONS, (user_id,))
+    async def start_generation_job(self, job_id: int) -> bool:
+        """Отметить задачу как выполняющуюся"""
+        async with self._write() as db:
+            try:
+                await db.execute(START_GENERATION_JOB, (job_id,))
+                await db.commit()
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка старта задачи генерации {job_id}: {e}")
+                return False
 
-                # Обновляем время последней активности
-                await db.execute(UPDATE_LAST_ACTIVITY, (user_id,))
+    async def set_generation_job_prediction(self, job_id: int, prediction_id: str) -> bool:
+        """Запомнить ID предсказания Replicate, чтобы после перезапуска не создавать его повторно"""
+        async with self._write() as db:
+            try:
+                await db.execute(SET_GENERATION_JOB_PREDICTION, (prediction_id, job_id))
+                await db.commit()
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка сохранения предсказания задачи {job_id}: {e}")
+                return False
 
+    async def finish_generation_job(self, job_id: int, status: str,
+                                    result_url: Optional[str] = None, error: Optional[str] = None) -> bool:
+        """Завершить задачу: status = 'done' | 'failed'"""
+        async with self._write() as db:
+            try:
+                await db.execute(FINISH_GENERATION_JOB, (status, result_url, error, job_id))
                 await db.commit()
-                logger.info(f"Генерация: user={user_id}, room={room_type}, style={style_type}")
                 return True
             except Exception as e:
-                logger.error(f"Ошибка логирования генерации: {e}")
+                logger.error(f"Ошибка завершения задачи генерации {job_id}: {e}")
                 return False
 
-    async def get_total_generations(self) -> int:
-        """Общее количество генераций"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT COUNT(*) FROM generations") as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else 0
+    async def get_unfinished_generation_jobs(self) -> List[Dict[str, Any]]:
+        """Задачи, не завершенные до остановки бота (queued/running)"""
+        async with self._read() as db:
+            async with db.execute(GET_UNFINISHED_GENERATION_JOBS) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
 
-    async def get_generations_count(self, days: int = 1) -> int:
-        """Количество генераций за период"""
-        date_threshold = datetime.now() - timedelta(days=days)
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                    "SELECT COUNT(*) FROM generations WHERE created_at >= ?",
-                    (date_threshold.isoformat(),)
-            ) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else 0
+    # ===== ХРАНИЛИЩЕ FSM =====
 
-    async def get_failed_generations_count(self, days: int = 1) -> int:
-        """
-        Количество неудачных генераций за период.
-        Параметры:
-        - days: количество дней назад (1 = за сегодня, 7 = за неделю)
-        """
-        date_threshold = datetime.now() - timedelta(days=days)
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                    "SELECT COUNT(*) FROM generations WHERE success = 0 AND created_at >= ?",
-                    (date_threshold.isoformat(),)
-            ) as cursor:
+    async def get_fsm_record(self, key: str) -> Optional[Tuple[Optional[str], str]]:
+        """(state, data_json) для ключа FSM или None"""
+        async with self._read() as db:
+            async with db.execute(GET_FSM_RECORD, (key,)) as cursor:
                 row = await cursor.fetchone()
-                return row[0] if row else 0
+                return (row[0], row[1]) if row else None
 
-    async def get_conversion_rate(self) -> float:
+    async def save_fsm_records(self, records: List[Tuple[str, Optional[str], str]]) -> bool:
         """
-        Рассчитать конверсию (генераций на пользователя).
-        Возвращает среднее количество генераций на пользователя.
+        Сохранить пачку записей FSM (key, state, data_json) одной транзакцией.
+        Пустые записи (без состояния и данных) удаляются.
         """
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                    "SELECT AVG(total_generations) FROM users WHERE total_generations > 0"
-            ) as cursor:
-                row = await cursor.fetchone()
-                return round(row[0], 2) if row and row[0] else 0.0
-
-    async def get_popular_rooms(self, limit: int = 10) -> List[Dict[str, Any]]:
-        """Получить популярные типы комнат"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                    """
-                    SELECT room_type, COUNT(*) as count
-                    FROM generations
-                    GROUP BY room_type
-                    ORDER BY count DESC
-                    LIMIT ?
-                    """,
-                    (limit,)
-            ) as cursor:
-                rows = await cursor.fetchall()
-                return [{'room_type': row[0], 'count': row[1]} for row in rows]
-
-    async def get_popular_styles(self, limit: int = 10) -> List[Dict[str, Any]]:
-        """Получить популярные стили"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                    """
-                    SELECT style_type, COUNT(*) as count
-                    FROM generations
-                    GROUP BY style_type
-                    ORDER BY count DESC
-                    LIMIT ?
-                    """,
-                    (limit,)
-            ) as cursor:
-                rows = await cursor.fetchall()
-                return [{'style_type': row[0], 'count': row[1]} for row in rows]
+        upserts = [r for r in records if r[1] is not None or r[2] != '{}']
+        deletes = [(r[0],) for r in records if r[1] is None and r[2] == '{}']
+        async with self._write() as db:
+            try:
+                if upserts:
+                    await db.executemany(UPSERT_FSM_RECORD, upserts)
+                if deletes:
+                    await db.executemany(DELETE_FSM_RECORD, deletes)
+                await db.commit()
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка сохранения FSM: {e}")
+                return False
 
     # ===== АКТИВНОСТЬ =====
 
     async def log_activity(self, user_id: int, action_type: str) -> bool:
         """
-        Залогировать активность пользователя.
+        Залогировать активность пользователя (в буфер; запись в БД — пачкой в фоне).
         Параметры:
         - user_id: ID пользователя
         - action_type: тип действия (напр. 'start', 'generation', 'payment', 'referral')
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        # Формат как у CURRENT_TIMESTAMP (UTC), чтобы отложенная запись не отличалась от прямой
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        self._activity.append((user_id, action_type, now))
+        self._last_activity[user_id] = now
+        return await self._schedule_analytics_flush()
+
+    def _analytics_pending(self) -> int:
+        return len(self._activity) + len(self._generations)
+
+    async def _schedule_analytics_flush(self) -> bool:
+        """Запланировать запись буфера аналитики (в синхронном режиме — записать сразу)"""
+        if self.analytics_sync:
+            return await self.flush_activity()
+
+        if self._analytics_pending() >= self.activity_batch_size:
+            if self._activity_task is None or self._activity_task.done():
+                self._activity_task = asyncio.create_task(self.flush_activity())
+        elif self._activity_task is None or self._activity_task.done():
+            self._activity_task = asyncio.create_task(self._delayed_activity_flush())
+        return True
+
+    async def _delayed_activity_flush(self):
+        await asyncio.sleep(self.activity_flush_interval)
+        await self.flush_activity()
+
+    async def flush_activity(self) -> bool:
+        """
+        Записать буфер аналитики одной транзакцией: события активности, генерации,
+        счетчики total_generations и last_activity (по одному обновлению на пользователя)
+        и суточные агрегаты генераций в daily_stats.
+        """
+        if not self._analytics_pending():
+            return True
+
+        events, self._activity = self._activity, []
+        generations, self._generations = self._generations, []
+        counts, self._generation_counts = self._generation_counts, {}
+        last_activity, self._last_activity = self._last_activity, {}
+        async with self._write() as db:
             try:
-                await db.execute(LOG_USER_ACTIVITY, (user_id, action_type))
-                await db.execute(UPDATE_LAST_ACTIVITY, (user_id,))
+                await db.executemany(LOG_USER_ACTIVITY, events)
+                await db.executemany(CREATE_GENERATION, generations)
+                await db.executemany(ADD_DAILY_STAT, self._generation_rollup(generations))
+                await db.executemany(
+                    ADD_DAILY_GENERATING_USER, [(last_activity[user_id], user_id) for user_id in counts]
+                )
+                await db.executemany(
+                    INCREMENT_TOTAL_GENERATIONS, [(count, user_id) for user_id, count in counts.items()]
+                )
+                await db.executemany(
+                    UPDATE_LAST_ACTIVITY_AT, [(ts, user_id) for user_id, ts in last_activity.items()]
+                )
                 await db.commit()
-                return True
             except Exception as e:
-                logger.error(f"Ошибка логирования активности: {e}")
+                logger.error(
+                    f"Ошибка записи аналитики ({len(events)} событий, {len(generations)} генераций): {e}"
+                )
+                try:
+                    await db.rollback()
+                except Exception as rollback_error:
+                    logger.error(f"Ошибка отката записи аналитики: {rollback_error}")
+                # Пачка возвращается в начало буфера и будет записана следующим сбросом
+                self._activity[:0] = events
+                self._generations[:0] = generations
+                for user_id, count in counts.items():
+                    self._generation_counts[user_id] = self._generation_counts.get(user_id, 0) + count
+                self._last_activity = {**last_activity, **self._last_activity}
+                if not self.analytics_sync:
+                    self._activity_task = asyncio.create_task(self._delayed_activity_flush())
                 return False
 
-    async def get_active_users_count(self, days: int = 1) -> int:
-        """
-        Количество активных пользователей за период.
-        Активным считается пользователь, который совершил любое действие.
-        """
-        date_threshold = datetime.now() - timedelta(days=days)
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                    "SELECT COUNT(DISTINCT user_id) FROM user_activity WHERE created_at >= ?",
-                    (date_threshold.isoformat(),)
-            ) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else 0
+        # События, пришедшие во время записи: новый сброс для них никто не запланировал
+        if self.analytics_sync or not self._analytics_pending():
+            return True
+        if self._analytics_pending() >= self.activity_batch_size:
+            return await self.flush_activity()
+        self._activity_task = asyncio.create_task(self._delayed_activity_flush())
+        return True
+
+    @staticmethod
+    def _generation_rollup(generations: List[Tuple[Any, ...]]) -> List[Tuple[str, str, str, int]]:
+        """Строки daily_stats для пачки генераций: (день, metric, dim, количество)"""
+        totals: Dict[Tuple[str, str, str], int] = {}
+        for _, room_type, style_type, _, success, *_, created_at in generations:
+            day = created_at[:10]
+            keys = [(day, 'generations', ''), (day, 'room', room_type), (day, 'style', style_type)]
+            if not success:
+                keys.append((day, 'generations_failed', ''))
+            for key in keys:
+                totals[key] = totals.get(key, 0) + 1
+        return [(*key, count) for key, count in totals.items()]
 
     # ===== УВЕДОМЛЕНИЯ АДМИНОВ (НОВОЕ) =====
 
@@ -372,7 +841,7 @@ class Database:
             FROM admin_notifications
             WHERE admin_id = ?
         """
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self._read() as conn:
             async with conn.execute(query, (admin_id,)) as cursor:
                 row = await cursor.fetchone()
                 if not row:
@@ -403,7 +872,7 @@ class Database:
                 notify_new_payments = excluded.notify_new_payments,
                 notify_critical_errors = excluded.notify_critical_errors
         """
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self._write() as conn:
             await conn.execute(query, (admin_id, notify_new_users, notify_new_payments, notify_critical_errors))
             await conn.commit()
 
@@ -420,7 +889,7 @@ class Database:
             SELECT admin_id FROM admin_notifications
             WHERE {notify_field} = 1
         """
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self._read() as conn:
             async with conn.execute(query) as cursor:
                 rows = await cursor.fetchall()
                 return [r[0] for r in rows]
@@ -433,7 +902,7 @@ class Database:
         """
         query_check = "SELECT 1 FROM user_sources WHERE user_id = ?"
         query_insert = "INSERT INTO user_sources (user_id, source) VALUES (?, ?)"
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self._write() as conn:
             async with conn.execute(query_check, (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -452,7 +921,7 @@ class Database:
             GROUP BY source
             ORDER BY count DESC
         """
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self._read() as conn:
             async with conn.execute(query) as cursor:
                 rows = await cursor.fetchall()
                 return [{"source": r[0], "count": r[1]} for r in rows]
@@ -461,14 +930,14 @@ class Database:
 
     async def get_referral_balance(self, user_id: int) -> int:
         """Получить реферальный баланс (рубли)"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(GET_REFERRAL_BALANCE, (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 return row[0] if row else 0
 
     async def add_referral_balance(self, user_id: int, amount: int) -> bool:
         """Добавить к реферальному балансу"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 await db.execute(ADD_REFERRAL_BALANCE, (amount, amount, user_id))
                 await db.commit()
@@ -479,7 +948,7 @@ class Database:
 
     async def decrease_referral_balance(self, user_id: int, amount: int) -> bool:
         """Уменьшить реферальный баланс"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 await db.execute(DECREASE_REFERRAL_BALANCE, (amount, user_id))
                 await db.commit()
@@ -493,7 +962,7 @@ class Database:
     async def log_referral_earning(self, referrer_id: int, referred_id: int, payment_id: str,
                                    amount: int, commission_percent: int, earnings: int, tokens: int) -> bool:
         """Залогировать заработок реферера"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 await db.execute(CREATE_REFERRAL_EARNING,
                                  (referrer_id, referred_id, payment_id, amount, commission_percent, earnings, tokens))
@@ -505,8 +974,7 @@ class Database:
 
     async def get_user_referral_earnings(self, user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
         """Получить историю заработков"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(GET_USER_REFERRAL_EARNINGS, (user_id, limit)) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
@@ -515,7 +983,7 @@ class Database:
 
     async def log_referral_exchange(self, user_id: int, amount: int, tokens: int, exchange_rate: int) -> bool:
         """Залогировать обмен"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 await db.execute(CREATE_REFERRAL_EXCHANGE, (user_id, amount, tokens, exchange_rate))
                 await db.commit()
@@ -526,8 +994,7 @@ class Database:
 
     async def get_user_exchanges(self, user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
         """Получить историю обменов"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(GET_USER_EXCHANGES, (user_id, limit)) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
@@ -536,7 +1003,7 @@ class Database:
 
     async def create_payout_request(self, user_id: int, amount: int, payment_method: str, payment_details: str) -> int:
         """Создать заявку на выплату"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 cursor = await db.execute(CREATE_PAYOUT_REQUEST, (user_id, amount, payment_method, payment_details))
                 await db.commit()
@@ -547,23 +1014,21 @@ class Database:
 
     async def get_user_payouts(self, user_id: int, limit: int = 20) -> List[Dict[str, Any]]:
         """Получить историю выплат"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(GET_USER_PAYOUTS, (user_id, limit)) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
     async def get_pending_payouts(self) -> List[Dict[str, Any]]:
         """Получить все ожидающие выплаты"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(GET_PENDING_PAYOUTS) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
     async def update_payout_status(self, payout_id: int, status: str, admin_id: int, note: str = None) -> bool:
         """Обновить статус выплаты"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 await db.execute(UPDATE_PAYOUT_STATUS, (status, admin_id, note, payout_id))
                 await db.commit()
@@ -576,7 +1041,7 @@ class Database:
 
     async def set_payment_details(self, user_id: int, method: str, details: str, sbp_bank: str = None) -> bool:
         """Установить реквизиты"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 await db.execute(SET_PAYMENT_DETAILS, (method, details, sbp_bank, user_id))
                 await db.commit()
@@ -587,8 +1052,7 @@ class Database:
 
     async def get_payment_details(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получить реквизиты"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(GET_PAYMENT_DETAILS, (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -597,57 +1061,123 @@ class Database:
 
     # ===== НАСТРОЙКИ =====
 
+    async def reload_settings(self):
+        """Перечитать таблицу settings в снимок (поверх DEFAULT_SETTINGS)"""
+        async with self._read() as db:
+            async with db.execute(GET_ALL_SETTINGS) as cursor:
+                rows = await cursor.fetchall()
+        self._settings = {**DEFAULT_SETTINGS, **{row[0]: row[1] for row in rows}}
+
     async def get_setting(self, key: str) -> Optional[str]:
-        """Получить настройку"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(GET_SETTING, (key,)) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else None
+        """Получить настройку (из снимка в памяти)"""
+        return self._settings.get(key)
+
+    def setting_str(self, key: str, default: str = '') -> str:
+        value = self._settings.get(key)
+        return default if value is None else value
+
+    def setting_int(self, key: str, default: int = 0) -> int:
+        """Числовая настройка; при пустом/битом значении — значение из DEFAULT_SETTINGS или default"""
+        for value in (self._settings.get(key), DEFAULT_SETTINGS.get(key)):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                continue
+        return default
+
+    def setting_bool(self, key: str) -> bool:
+        return str(self._settings.get(key)).strip().lower() in ('1', 'true', 'yes', 'on')
 
     async def set_setting(self, key: str, value: str) -> bool:
         """Установить настройку"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 await db.execute(SET_SETTING, (key, value))
                 await db.commit()
+                self._settings[key] = value
                 return True
             except Exception as e:
                 logger.error(f"Ошибка установки настройки: {e}")
                 return False
 
     # ===== СТАТИСТИКА =====
+    # Метрики дашборда — только из суточных агрегатов daily_stats (get_daily_stats), без COUNT по всей таблице
 
-    async def get_total_users_count(self) -> int:
-        """Общее количество пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute("SELECT COUNT(*) FROM users") as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else 0
+    async def get_dashboard_snapshot(self) -> Dict[str, Any]:
+        """
+        Метрики дашборда админки (см. get_daily_stats) + generated_at.
+        Все метрики считаются одним запросом — это один согласованный снимок БД.
+        Снимок живет dashboard_cache_ttl секунд; если несколько админов обновляют
+        дашборд одновременно, запрос к БД выполняется один раз.
+        """
+        now = time.monotonic()
+        if self._dashboard and self._dashboard[0] > now:
+            return self._dashboard[1]
 
-    async def get_new_users_count(self, days: int = 1) -> int:
-        """Количество новых пользователей за период"""
-        date_threshold = datetime.now() - timedelta(days=days)
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                    "SELECT COUNT(*) FROM users WHERE created_at >= ?",
-                    (date_threshold.isoformat(),)
-            ) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else 0
+        if self._dashboard_loading is None:
+            self._dashboard_loading = asyncio.ensure_future(self._load_dashboard())
+        loading = self._dashboard_loading
+        try:
+            return await asyncio.shield(loading)
+        finally:
+            if loading.done() and self._dashboard_loading is loading:
+                self._dashboard_loading = None
+
+    async def _load_dashboard(self) -> Dict[str, Any]:
+        snapshot = await self.get_daily_stats(top=5)
+        snapshot['generated_at'] = datetime.now()
+        self._dashboard = (time.monotonic() + self.dashboard_cache_ttl, snapshot)
+        return snapshot
+
+    async def get_daily_stats(self, top: int = 5) -> Dict[str, Any]:
+        """
+        Метрики дашборда из суточных агрегатов daily_stats одним запросом.
+        «Сегодня» — текущие сутки UTC, «неделя» — сегодня и 6 предыдущих суток.
+        """
+        today = datetime.utcnow().date()
+        week_start = today - timedelta(days=6)
+        params = (
+            today.isoformat(), week_start.isoformat(),
+            f"{today.isoformat()} 00:00:00", f"{week_start.isoformat()} 00:00:00",
+        )
+        async with self._read() as db:
+            async with db.execute(GET_DAILY_STATS_SUMMARY, params) as cursor:
+                rows = await cursor.fetchall()
 
-    async def get_total_revenue(self) -> int:
-        """Общая выручка"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                    "SELECT SUM(amount) FROM payments WHERE status = 'succeeded'"
-            ) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row and row[0] else 0
+        metrics: Dict[str, Dict[str, int]] = {}
+        rooms: List[Dict[str, Any]] = []
+        styles: List[Dict[str, Any]] = []
+        for metric, dim, total, today_value, week_value in rows:
+            if metric == 'room':
+                rooms.append({'room_type': dim, 'count': total})
+            elif metric == 'style':
+                styles.append({'style_type': dim, 'count': total})
+            else:
+                metrics[metric] = {'total': total or 0, 'today': today_value or 0, 'week': week_value or 0}
+
+        def metric(name: str) -> Dict[str, int]:
+            return metrics.get(name, {'total': 0, 'today': 0, 'week': 0})
+
+        payments = metric('payments')
+        revenue = metric('revenue')
+        generating_users = metric('generating_users')['total']
+        generations = metric('generations')
+        return {
+            'users': metric('new_users'),
+            'active_users': metric('active_users'),
+            'generations': generations,
+            'failed_generations': metric('generations_failed'),
+            'payments': payments,
+            'revenue': revenue,
+            'average_payment': revenue['total'] // payments['total'] if payments['total'] else 0,
+            'conversion_rate': round(generations['total'] / generating_users, 2) if generating_users else 0.0,
+            'popular_rooms': sorted(rooms, key=lambda r: r['count'], reverse=True)[:top],
+            'popular_styles': sorted(styles, key=lambda r: r['count'], reverse=True)[:top],
+        }
 
     async def get_recent_users(self, limit: int = 10) -> List[Dict[str, Any]]:
         """Последние пользователи"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                     "SELECT * FROM users ORDER BY created_at DESC LIMIT ?",
                     (limit,)
@@ -656,97 +1186,91 @@ class Database:
                 return [dict(row) for row in rows]
 
     async def search_user(self, query: str) -> Optional[Dict[str, Any]]:
+        """Лучшее совпадение поиска (см. search_users) или None"""
+        users, _ = await self.search_users(query, limit=1)
+        return users[0] if users else None
+
+    async def search_users(self, query: str, limit: int = 10,
+                           offset: int = 0) -> Tuple[List[Dict[str, Any]], bool]:
         """
-        Поиск пользователя по ID, username или реферальному коду.
-        Возвращает полную информацию о пользователе.
+        Поиск пользователей по подстроке ID, username или реферального кода (индекс users_fts).
+        Точные совпадения идут первыми, остальные — в порядке user_id.
+        Точное совпадение ID или реферального кода (они уникальны) — единственный результат, без подстрок.
+        Запросы короче 3 символов — только точное совпадение.
+        Возвращает ([пользователи], есть_еще).
         """
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-
-            # Пробуем поиск по ID (если запрос - цифры)
-            if query.isdigit():
-                user_id = int(query)
-                async with db.execute(GET_USER, (user_id,)) as cursor:
-                    row = await cursor.fetchone()
-                    if row:
-                        return dict(row)
-
-            # Поиск по username (убираем @ если есть)
-            username_query = query.replace('@', '')
-            async with db.execute(
-                    "SELECT * FROM users WHERE username = ? OR username = ?",
-                    (username_query, f"@{username_query}")
-            ) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return dict(row)
-
-            # Поиск по реферальному коду
-            async with db.execute(GET_USER_BY_REFERRAL_CODE, (query,)) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return dict(row)
-
-            return None
-
-    async def get_all_users_paginated(self, page: int = 1, per_page: int = 10) -> Tuple[List[Dict[str, Any]], int]:
+        text = query.strip().lstrip('@')
+        if not text:
+            return [], False
+
+        user_id = int(text) if text.isdigit() else -1
+        wanted = offset + limit + 1
+        async with self._read() as db:
+            async with db.execute(SEARCH_USERS_EXACT, (user_id, text, f"@{text}", text, wanted, 0)) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+
+            unique_hit = any(row['user_id'] == user_id or row['referral_code'] == text for row in rows)
+            if len(text) >= 3 and not unique_hit:
+                # Запрос — одна фраза: кавычки внутри экранируются удвоением
+                phrase = '"' + text.replace('"', '""') + '"'
+                found = {row['user_id'] for row in rows}
+                async with db.execute(SEARCH_USERS, (phrase, wanted + len(found))) as cursor:
+                    rows += [dict(row) for row in await cursor.fetchall() if row['user_id'] not in found]
+
+        rows = rows[offset:offset + limit + 1]
+        return rows[:limit], len(rows) > limit
+
+    async def get_users_page(self, cursor: Optional[int] = None, backward: bool = False,
+                             per_page: int = 10) -> Tuple[List[Dict[str, Any]], bool, bool]:
         """
-        Получить всех пользователей с пагинацией.
-        Возвращает ([пользователи], всего_страниц)
+        Страница пользователей (новые сверху), keyset-пагинация по (created_at, user_id).
+        - cursor: user_id последней строки предыдущей страницы
+          (при backward=True — первой строки следующей); None — первая страница
+        Возвращает ([пользователи], есть_предыдущая, есть_следующая).
         """
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-
-            # Подсчитываем общее количество
-            async with db.execute("SELECT COUNT(*) FROM users") as cursor:
-                total = (await cursor.fetchone())[0]
-
-            total_pages = (total + per_page - 1) // per_page
-            offset = (page - 1) * per_page
-
-            # Получаем пользователей для страницы
-            async with db.execute(
-                    "SELECT * FROM users ORDER BY created_at DESC LIMIT ? OFFSET ?",
-                    (per_page, offset)
-            ) as cursor:
-                rows = await cursor.fetchall()
-                users = [dict(row) for row in rows]
-
-            return users, total_pages
-
-    async def get_revenue_by_period(self, days: int = 1) -> int:
-        """Выручка за период"""
-        date_threshold = datetime.now() - timedelta(days=days)
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                    "SELECT SUM(amount) FROM payments WHERE status = 'succeeded' AND created_at >= ?",
-                    (date_threshold.isoformat(),)
-            ) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row and row[0] else 0
-
-    async def get_successful_payments_count(self) -> int:
-        """Количество успешных платежей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                    "SELECT COUNT(*) FROM payments WHERE status = 'succeeded'"
-            ) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else 0
-
-    async def get_average_payment(self) -> int:
-        """Средний чек"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                    "SELECT AVG(amount) FROM payments WHERE status = 'succeeded'"
-            ) as cursor:
-                row = await cursor.fetchone()
-                return int(row[0]) if row and row[0] else 0
+        limit = per_page + 1
+        async with self._read() as db:
+            async def fetch(query: str, params: tuple) -> List[Dict[str, Any]]:
+                async with db.execute(query, params) as rows_cursor:
+                    return [dict(row) for row in await rows_cursor.fetchall()]
+
+            created_at = None
+            if cursor is not None:
+                async with db.execute(GET_USER_CREATED_AT, (cursor,)) as rows_cursor:
+                    row = await rows_cursor.fetchone()
+                if row is None:
+                    # Пользователя-курсора уже нет — начинаем сначала
+                    cursor, backward = None, False
+                else:
+                    created_at = row[0]
+
+            if cursor is None:
+                rows = await fetch(GET_USERS_FIRST_PAGE, (limit,))
+            elif not backward:
+                rows = []
+                if created_at is not None:
+                    rows = await fetch(GET_USERS_AFTER, (created_at, cursor, limit))
+                # После пользователей с датой идут пользователи без нее
+                if len(rows) < limit:
+                    after_id = cursor if created_at is None else MAX_USER_ID
+                    rows += await fetch(GET_USERS_NO_DATE_AFTER, (after_id, limit - len(rows)))
+            elif created_at is None:
+                rows = await fetch(GET_USERS_NO_DATE_BEFORE, (cursor, limit))
+                if len(rows) < limit:
+                    rows += await fetch(GET_USERS_OLDEST, (limit - len(rows),))
+            else:
+                rows = await fetch(GET_USERS_BEFORE, (created_at, cursor, limit))
+
+        # Лишняя строка только показывает, что дальше есть еще страница
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backward:
+            return rows[::-1], has_more, True
+        return rows, cursor is not None, has_more
 
     async def get_all_payments(self, limit: int = 20) -> List[Dict[str, Any]]:
         """Получить все платежи"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                     """
                     SELECT p.*, u.username 
@@ -768,7 +1292,7 @@ class Database:
             'total_amount': общая сумма
         }
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(
                     """
                     SELECT COUNT(*) as count, COALESCE(SUM(amount), 0) as total
@@ -785,8 +1309,7 @@ class Database:
 
     async def get_user_recent_payments(self, user_id: int, limit: int = 5) -> List[Dict[str, Any]]:
         """Получить последние платежи пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(
                     """
                     SELECT amount, tokens, created_at as payment_date, status
@@ -802,9 +1325,7 @@ class Database:
 
     async def get_referrer_info(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получить информацию о рефере (кто пригласил)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-
+        async with self._read() as db:
             async with db.execute("SELECT referred_by FROM users WHERE user_id = ?", (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 if not row or not row['referred_by']:
@@ -894,7 +1415,7 @@ class Database:
             error_message,
         )
 
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             try:
                 await db.execute(query, params)
                 await db.commit()
@@ -925,7 +1446,7 @@ class Database:
             ORDER BY id DESC
             LIMIT 1
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute(query, (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row and row[0]:
@@ -953,8 +1474,7 @@ class Database:
             ORDER BY id DESC
             LIMIT 1
         """
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(query, (user_id, session_type)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -979,8 +1499,7 @@ class Database:
             ORDER BY created_at DESC, id DESC
             LIMIT ?
         """
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._read() as db:
             async with db.execute(query, (user_id, limit)) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(r) for r in rows]
@@ -0,0 +1,154 @@
+# bot/database/fsm_storage.py
+# --- СОЗДАН: 2025-12-08 - Персистентное хранилище FSM (SQLite через Database, опционально Redis) ---
+# [2025-12-08] Зависимость Redis — в requirements-redis.txt, понятная ошибка без пакета
+# [2025-12-08] Ключи, которые сейчас пишутся в БД, не вытесняются; неудачный сброс возвращает их в очередь
+"""
+Хранилища FSM для aiogram.
+
+SQLiteStorage хранит состояние и данные диалога в таблице fsm_storage той же БД,
+через пул соединений Database. Хэндлеры вызывают state.update_data по нескольку раз
+за апдейт — чтобы это не превращалось в запись на каждый вызов, записи копятся
+в памяти и сбрасываются одной транзакцией раз в flush_interval секунд (и при close).
+Чтение идет из памяти; с диска ключ загружается один раз.
+
+SQLite-хранилище рассчитано на один процесс бота. Для нескольких экземпляров
+используйте Redis (FSM_STORAGE=redis, пакет redis — pip install -r requirements-redis.txt).
+"""
+
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, Optional, Set
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from database.db import Database
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, database: Database, flush_interval: float = 0.5, max_entries: int = 10000,
+                 key_builder: Optional[KeyBuilder] = None):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+        # key -> [state, data]; грязные ключи ждут сброса в БД
+        self._cache: "OrderedDict[str, List[Any]]" = OrderedDict()
+        self._dirty: Set[str] = set()
+        # Ключи, записываемые сейчас (сброс ждет БД): их нельзя вытеснять — при ошибке они снова станут грязными
+        self._flushing: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _entry(self, key: StorageKey) -> tuple[str, List[Any]]:
+        """Запись ключа из памяти (при первом обращении — из БД)"""
+        k = self.key_builder.build(key)
+        entry = self._cache.get(k)
+        if entry is not None:
+            self._cache.move_to_end(k)
+            return k, entry
+
+        row = await self.database.get_fsm_record(k)
+        loaded = [row[0], json.loads(row[1])] if row else [None, {}]
+        # Пока шло чтение, ключ мог загрузить (и изменить) другой апдейт
+        entry = self._cache.setdefault(k, loaded)
+        self._evict()
+        return k, entry
+
+    def _evict(self):
+        """Вытеснить самые старые чистые записи сверх max_entries (не грязные и не записываемые сейчас)"""
+        if len(self._cache) <= self.max_entries:
+            return
+        for k in list(self._cache):
+            if len(self._cache) <= self.max_entries:
+                break
+            if k not in self._dirty and k not in self._flushing:
+                del self._cache[k]
+
+    def _mark_dirty(self, k: str):
+        self._dirty.add(k)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Записать накопленные изменения одной транзакцией"""
+        if not self._dirty:
+            return
+
+        keys, self._dirty = self._dirty, set()
+        records = [
+            (k, self._cache[k][0], json.dumps(self._cache[k][1], ensure_ascii=False))
+            for k in keys if k in self._cache
+        ]
+        flushing = {record[0] for record in records}
+        self._flushing |= flushing
+        try:
+            saved = await self.database.save_fsm_records(records)
+        finally:
+            self._flushing -= flushing
+        if not saved:
+            # Не получилось — попробуем при следующем сбросе (записи все еще в памяти: их не вытесняли)
+            self._dirty |= flushing
+
+    # ===== BaseStorage =====
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._mark_dirty(k)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k, entry = await self._entry(key)
+        entry[1] = dict(data)
+        self._mark_dirty(k)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, entry = await self._entry(key)
+        return entry[1].copy()
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        k, entry = await self._entry(key)
+        entry[1].update(data)
+        self._mark_dirty(k)
+        return entry[1].copy()
+
+    async def close(self) -> None:
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+
+def create_fsm_storage(kind: str, database: Database, redis_url: Optional[str] = None,
+                       flush_interval: float = 0.5) -> BaseStorage:
+    """
+    Хранилище FSM по имени из конфига:
+    - sqlite — таблица fsm_storage (по умолчанию);
+    - redis  — aiogram RedisStorage (для нескольких экземпляров бота);
+    - memory — MemoryStorage (данные теряются при перезапуске).
+    """
+    if kind == 'redis':
+        # Требует пакет redis (requirements-redis.txt) — импортируем только когда он действительно нужен
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise RuntimeError("FSM_STORAGE=redis: установите pip install -r requirements-redis.txt") from e
+        return RedisStorage.from_url(
+            redis_url,
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        )
+    if kind == 'memory':
+        return MemoryStorage()
+    return SQLiteStorage(database, flush_interval=flush_interval)
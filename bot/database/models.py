@@ -1,5 +1,15 @@
 # bot/database/models.py
 # --- ОБНОВЛЕН: 2025-12-04 11:35 - Добавлены таблицы admin_notifications и user_sources ---
+# [2025-12-08] Версионированные миграции схемы (schema_version) и вторичные индексы
+# [2025-12-08] generations: model_id, duration_ms, cost; запись генераций пачками
+# [2025-12-08] Суточные агрегаты daily_stats для дашборда админки
+# [2025-12-08] Keyset-пагинация списка пользователей
+# [2025-12-08] Полнотекстовый поиск пользователей users_fts (FTS5, trigram) с триггерами синхронизации
+# [2025-12-08] generation_jobs.photo_unique_id — ключ кэша фото (миграция 9)
+# [2025-12-08] Настройка preview_grid_price — цена превью-сетки стилей в генерациях
+# [2025-12-08] generations.preview_ms (миграция 10) и настройка fast_preview — двухфазный рендер
+# [2025-12-08] Миграция 11: generating_users пересчитан по дню первой генерации; у active_users нет total
+# [2025-12-08] Курсор списка пользователей — user_id; пользователи без created_at — в конце списка
 """SQL queries for database initialization"""
 
 # ===== СУЩЕСТВУЮЩИЕ ТАБЛИЦЫ =====
@@ -154,6 +164,211 @@ CREATE TABLE IF NOT EXISTS settings (
 )
 """
 
+# ===== МИГРАЦИИ СХЕМЫ =====
+
+CREATE_SCHEMA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+GET_SCHEMA_VERSION = "SELECT COALESCE(MAX(version), 0) FROM schema_version"
+SET_SCHEMA_VERSION = "INSERT INTO schema_version (version, description) VALUES (?, ?)"
+
+# Упорядоченный список миграций: (версия, описание, [SQL]).
+# Новые шаги добавляются ТОЛЬКО в конец, уже примененные не меняются.
+MIGRATIONS = [
+    (1, "Вторичные индексы для статистики и выборок", [
+        # Пользователи: новые за период, последние, поиск, конверсия
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+        "CREATE INDEX IF NOT EXISTS idx_users_total_generations ON users (total_generations)",
+        # Платежи: ожидающий платеж пользователя, выручка за период, история
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_status_created ON payments (user_id, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments (status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_created_at ON payments (created_at)",
+        # Генерации: количество за период, неудачные, популярные комнаты/стили
+        "CREATE INDEX IF NOT EXISTS idx_generations_created_at ON generations (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_generations_success_created ON generations (success, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_generations_room_type ON generations (room_type)",
+        "CREATE INDEX IF NOT EXISTS idx_generations_style_type ON generations (style_type)",
+        # Активность: активные за период и история пользователя
+        "CREATE INDEX IF NOT EXISTS idx_user_activity_created_user ON user_activity (created_at, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_user_activity_user_created ON user_activity (user_id, created_at)",
+        # Реферальная система
+        "CREATE INDEX IF NOT EXISTS idx_referral_earnings_referrer_created ON referral_earnings (referrer_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_referral_exchanges_user_created ON referral_exchanges (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_referral_payouts_user_requested ON referral_payouts (user_id, requested_at)",
+        "CREATE INDEX IF NOT EXISTS idx_referral_payouts_status_requested ON referral_payouts (status, requested_at)",
+        # Источники трафика
+        "CREATE INDEX IF NOT EXISTS idx_user_sources_source ON user_sources (source)",
+    ]),
+    (2, "Очередь задач генерации generation_jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            operation_type TEXT NOT NULL DEFAULT 'design',
+            photo_id TEXT NOT NULL,
+            room_type TEXT,
+            style_type TEXT,
+            priority INTEGER NOT NULL DEFAULT 1,
+            status TEXT NOT NULL DEFAULT 'queued',
+            result_url TEXT,
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            started_at DATETIME,
+            finished_at DATETIME,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs (status, priority, id)",
+    ]),
+    (3, "ID предсказания Replicate в generation_jobs (дожидаемся его после перезапуска)", [
+        "ALTER TABLE generation_jobs ADD COLUMN prediction_id TEXT",
+    ]),
+    (4, "Хранилище FSM (состояние и данные диалогов переживают перезапуск)", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (5, "Журнал проводок по балансу balance_ledger (users.balance — материализованная сумма)", [
+        """
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            delta INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            ref_id TEXT,
+            balance_after INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+        # Покрывающий индекс для SUM(delta) по пользователю (сверка балансов)
+        "CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger (user_id, delta)",
+        # Входящие остатки: до журнала история не велась
+        """
+        INSERT INTO balance_ledger (user_id, delta, reason, balance_after)
+        SELECT user_id, balance, 'opening', balance FROM users WHERE balance != 0
+        """,
+    ]),
+    (6, "generations: модель, длительность рендера и стоимость (аналитика производительности)", [
+        "ALTER TABLE generations ADD COLUMN model_id TEXT",
+        "ALTER TABLE generations ADD COLUMN duration_ms INTEGER",
+        "ALTER TABLE generations ADD COLUMN cost REAL",
+    ]),
+    (7, "Суточные агрегаты daily_stats для дашборда (заполняются из истории)", [
+        """
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            dim TEXT NOT NULL DEFAULT '',
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric, dim)
+        )
+        """,
+        # Активные за период = пользователи, чья последняя активность попала в период
+        "CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users (last_activity)",
+        # Строки без даты или с нераспознаваемой датой в суточные агрегаты не попадают (day NOT NULL)
+        """
+        INSERT INTO daily_stats (day, metric, dim, value)
+        SELECT date(created_at), 'new_users', '', COUNT(*) FROM users
+        WHERE date(created_at) IS NOT NULL GROUP BY 1
+        """,
+        """
+        INSERT INTO daily_stats (day, metric, dim, value)
+        SELECT date(created_at), 'generating_users', '', COUNT(*) FROM users
+        WHERE total_generations > 0 AND date(created_at) IS NOT NULL GROUP BY 1
+        """,
+        """
+        INSERT INTO daily_stats (day, metric, dim, value)
+        SELECT date(created_at), 'generations', '', COUNT(*) FROM generations
+        WHERE date(created_at) IS NOT NULL GROUP BY 1
+        """,
+        """
+        INSERT INTO daily_stats (day, metric, dim, value)
+        SELECT date(created_at), 'generations_failed', '', COUNT(*) FROM generations
+        WHERE success = 0 AND date(created_at) IS NOT NULL GROUP BY 1
+        """,
+        """
+        INSERT INTO daily_stats (day, metric, dim, value)
+        SELECT date(created_at), 'room', room_type, COUNT(*) FROM generations
+        WHERE date(created_at) IS NOT NULL GROUP BY 1, 3
+        """,
+        """
+        INSERT INTO daily_stats (day, metric, dim, value)
+        SELECT date(created_at), 'style', style_type, COUNT(*) FROM generations
+        WHERE date(created_at) IS NOT NULL GROUP BY 1, 3
+        """,
+        """
+        INSERT INTO daily_stats (day, metric, dim, value)
+        SELECT date(created_at), 'payments', '', COUNT(*) FROM payments
+        WHERE status = 'succeeded' AND date(created_at) IS NOT NULL GROUP BY 1
+        """,
+        """
+        INSERT INTO daily_stats (day, metric, dim, value)
+        SELECT date(created_at), 'revenue', '', SUM(amount) FROM payments
+        WHERE status = 'succeeded' AND date(created_at) IS NOT NULL GROUP BY 1
+        """,
+    ]),
+    (8, "Поиск пользователей users_fts (FTS5, trigram: подстроки ID, username, реферального кода)", [
+        # Внешний контент: текст хранится только в users, в users_fts — лишь индекс
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            user_id, username, referral_code,
+            content='users', content_rowid='user_id', tokenize='trigram'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, user_id, username, referral_code)
+            VALUES (new.user_id, new.user_id, new.username, new.referral_code);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, user_id, username, referral_code)
+            VALUES ('delete', old.user_id, old.user_id, old.username, old.referral_code);
+        END
+        """,
+        # Только при смене индексируемых полей: изменения баланса и счетчиков индекс не трогают
+        """
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, referral_code ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, user_id, username, referral_code)
+            VALUES ('delete', old.user_id, old.user_id, old.username, old.referral_code);
+            INSERT INTO users_fts (rowid, user_id, username, referral_code)
+            VALUES (new.user_id, new.user_id, new.username, new.referral_code);
+        END
+        """,
+        "INSERT INTO users_fts (users_fts) VALUES ('rebuild')",
+    ]),
+    (9, "generation_jobs.photo_unique_id (ключ кэша фото для image-to-image)", [
+        "ALTER TABLE generation_jobs ADD COLUMN photo_unique_id TEXT",
+    ]),
+    (10, "generations.preview_ms (задержка черновика двухфазного рендера)", [
+        "ALTER TABLE generations ADD COLUMN preview_ms INTEGER",
+    ]),
+    (11, "daily_stats.generating_users — по дню первой генерации (как при записи), а не дню регистрации", [
+        "DELETE FROM daily_stats WHERE metric = 'generating_users'",
+        """
+        INSERT INTO daily_stats (day, metric, dim, value)
+        SELECT first_day, 'generating_users', '', COUNT(*)
+        FROM (SELECT date(MIN(created_at)) AS first_day FROM generations
+              WHERE date(created_at) IS NOT NULL GROUP BY user_id)
+        GROUP BY first_day
+        """,
+    ]),
+]
+
 # ===== ДЕФОЛТНЫЕ НАСТРОЙКИ =====
 
 DEFAULT_SETTINGS = {
@@ -164,6 +379,10 @@ DEFAULT_SETTINGS = {
     'referral_commission_percent': '10',
     'referral_min_payout': '500',
     'referral_exchange_rate': '29',
+    'preview_grid_price': '3',  # генераций за превью-сетку (PREVIEW_GRID_SIZE стилей; часть стилей из кэша — доля цены)
+    # Двухфазный рендер (черновик, затем финальный): 'all', пусто (выключен)
+    # или ключи комнат/стилей через запятую, например 'living_room,modern'
+    'fast_preview': '',
 }
 
 # ===== SQL QUERIES ДЛЯ CRUD ОПЕРАЦИЙ =====
@@ -171,14 +390,68 @@ DEFAULT_SETTINGS = {
 # --- Пользователи ---
 GET_USER = "SELECT * FROM users WHERE user_id = ?"
 CREATE_USER = "INSERT INTO users (user_id, username, balance, referral_code) VALUES (?, ?, ?, ?)"
-UPDATE_BALANCE = "UPDATE users SET balance = balance + ? WHERE user_id = ?"
-DECREASE_BALANCE = "UPDATE users SET balance = balance - 1 WHERE user_id = ?"
+UPDATE_BALANCE = "UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance"
+# Списание только при достаточном балансе: проверка и списание — один атомарный запрос
+DEBIT_BALANCE = "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ? RETURNING balance"
 GET_BALANCE = "SELECT balance FROM users WHERE user_id = ?"
+
+# --- Журнал баланса ---
+INSERT_LEDGER_ENTRY = """
+INSERT INTO balance_ledger (user_id, delta, reason, ref_id, balance_after) VALUES (?, ?, ?, ?, ?)
+"""
+# Сверка пачкой по user_id: материализованный баланс против суммы проводок
+VERIFY_BALANCES_BATCH = """
+SELECT u.user_id, u.balance,
+       COALESCE((SELECT SUM(l.delta) FROM balance_ledger l WHERE l.user_id = u.user_id), 0) AS ledger_balance
+FROM users u
+WHERE u.user_id > ?
+ORDER BY u.user_id
+LIMIT ?
+"""
 UPDATE_LAST_ACTIVITY = "UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE user_id = ?"
 
 # --- Реферальные коды ---
 UPDATE_REFERRAL_CODE = "UPDATE users SET referral_code = ? WHERE user_id = ?"
 GET_USER_BY_REFERRAL_CODE = "SELECT * FROM users WHERE referral_code = ?"
+
+# --- Поиск пользователей ---
+# Подстроки — страница users_fts в порядке индекса (по user_id): без сортировки по rank LIMIT
+# останавливает чтение на первых совпадениях, а не ранжирует их все.
+# Параметры: (фраза MATCH, limit)
+SEARCH_USERS = """
+SELECT u.* FROM users_fts f JOIN users u ON u.user_id = f.rowid
+WHERE users_fts MATCH ?
+ORDER BY f.rowid
+LIMIT ?
+"""
+# Точные совпадения по индексам users (первичный ключ, idx_users_username, UNIQUE referral_code).
+# Запросы короче 3 символов trigram-индексом не ищутся — только этим запросом
+SEARCH_USERS_EXACT = """
+SELECT * FROM users
+WHERE user_id = ? OR username = ? OR username = ? OR referral_code = ?
+LIMIT ? OFFSET ?
+"""
+
+# --- Список пользователей (keyset-пагинация по (created_at, user_id), новые сверху) ---
+# Индекс idx_users_created_at хранит и rowid (= user_id), поэтому страница — поиск по индексу без OFFSET.
+# Курсор — user_id крайней строки; его created_at берется из БД как есть (без разбора формата).
+# Пользователи без created_at идут в конце списка (NULL в DESC — последние), между собой — по user_id.
+GET_USERS_FIRST_PAGE = "SELECT * FROM users ORDER BY created_at DESC, user_id DESC LIMIT ?"
+GET_USER_CREATED_AT = "SELECT created_at FROM users WHERE user_id = ?"
+GET_USERS_AFTER = """
+SELECT * FROM users WHERE (created_at, user_id) < (?, ?)
+ORDER BY created_at DESC, user_id DESC LIMIT ?
+"""
+GET_USERS_BEFORE = """
+SELECT * FROM users WHERE (created_at, user_id) > (?, ?)
+ORDER BY created_at ASC, user_id ASC LIMIT ?
+"""
+GET_USERS_NO_DATE_AFTER = "SELECT * FROM users WHERE created_at IS NULL AND user_id < ? ORDER BY user_id DESC LIMIT ?"
+GET_USERS_NO_DATE_BEFORE = "SELECT * FROM users WHERE created_at IS NULL AND user_id > ? ORDER BY user_id ASC LIMIT ?"
+# Самые старые пользователи с датой — продолжение «назад» из хвоста без created_at
+GET_USERS_OLDEST = """
+SELECT * FROM users WHERE created_at IS NOT NULL ORDER BY created_at ASC, user_id ASC LIMIT ?
+"""
 UPDATE_REFERRED_BY = "UPDATE users SET referred_by = ? WHERE user_id = ?"
 INCREMENT_REFERRALS_COUNT = "UPDATE users SET referrals_count = referrals_count + 1 WHERE user_id = ?"
 
@@ -200,15 +473,89 @@ WHERE yookassa_payment_id = ?
 
 # --- Генерации ---
 CREATE_GENERATION = """
-INSERT INTO generations (user_id, room_type, style_type, operation_type, success)
-VALUES (?, ?, ?, ?, ?)
+INSERT INTO generations (user_id, room_type, style_type, operation_type, success,
+                         model_id, duration_ms, cost, preview_ms, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+# Для пачки генераций: счетчик увеличивается сразу на число генераций пользователя в пачке
+INCREMENT_TOTAL_GENERATIONS = "UPDATE users SET total_generations = total_generations + ? WHERE user_id = ?"
+
+# --- Очередь генераций ---
+CREATE_GENERATION_JOB = """
+INSERT INTO generation_jobs (user_id, chat_id, operation_type, photo_id, photo_unique_id,
+                             room_type, style_type, priority)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+START_GENERATION_JOB = """
+UPDATE generation_jobs SET status = 'running', started_at = CURRENT_TIMESTAMP WHERE id = ?
+"""
+FINISH_GENERATION_JOB = """
+UPDATE generation_jobs
+SET status = ?, result_url = ?, error = ?, finished_at = CURRENT_TIMESTAMP
+WHERE id = ?
+"""
+SET_GENERATION_JOB_PREDICTION = """
+UPDATE generation_jobs SET prediction_id = ? WHERE id = ?
+"""
+GET_UNFINISHED_GENERATION_JOBS = """
+SELECT * FROM generation_jobs
+WHERE status IN ('queued', 'running')
+ORDER BY priority ASC, id ASC
 """
-INCREMENT_TOTAL_GENERATIONS = "UPDATE users SET total_generations = total_generations + 1 WHERE user_id = ?"
+
+# --- Хранилище FSM ---
+GET_FSM_RECORD = "SELECT state, data FROM fsm_storage WHERE key = ?"
+UPSERT_FSM_RECORD = """
+INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = CURRENT_TIMESTAMP
+"""
+DELETE_FSM_RECORD = "DELETE FROM fsm_storage WHERE key = ?"
 
 # --- Активность ---
 LOG_USER_ACTIVITY = """
-INSERT INTO user_activity (user_id, action_type)
-VALUES (?, ?)
+INSERT INTO user_activity (user_id, action_type, created_at)
+VALUES (?, ?, ?)
+"""
+# Для пачки событий: время последней активности берется из буфера, а не CURRENT_TIMESTAMP
+UPDATE_LAST_ACTIVITY_AT = "UPDATE users SET last_activity = ? WHERE user_id = ?"
+
+# --- Суточные агрегаты (daily_stats) ---
+# Параметры: (время или дата события, metric, dim, value) — день берется из времени события
+ADD_DAILY_STAT = """
+INSERT INTO daily_stats (day, metric, dim, value) VALUES (date(?), ?, ?, ?)
+ON CONFLICT(day, metric, dim) DO UPDATE SET value = value + excluded.value
+"""
+# Первая генерация пользователя (для конверсии); выполняется до увеличения total_generations
+ADD_DAILY_GENERATING_USER = """
+INSERT INTO daily_stats (day, metric, dim, value)
+SELECT date(?), 'generating_users', '', 1 FROM users WHERE user_id = ? AND total_generations = 0
+ON CONFLICT(day, metric, dim) DO UPDATE SET value = value + 1
+"""
+# Успешный платеж учитывается один раз — при переходе в статус succeeded (до UPDATE_PAYMENT_STATUS)
+ADD_DAILY_PAYMENT = """
+INSERT INTO daily_stats (day, metric, dim, value)
+SELECT date('now'), 'payments', '', 1 FROM payments WHERE yookassa_payment_id = ? AND status != 'succeeded'
+ON CONFLICT(day, metric, dim) DO UPDATE SET value = value + 1
+"""
+ADD_DAILY_REVENUE = """
+INSERT INTO daily_stats (day, metric, dim, value)
+SELECT date('now'), 'revenue', '', amount FROM payments WHERE yookassa_payment_id = ? AND status != 'succeeded'
+ON CONFLICT(day, metric, dim) DO UPDATE SET value = value + excluded.value
+"""
+# Все метрики дашборда одним запросом: итог, за сегодня и за неделю (параметры: день начала
+# сегодня, день начала недели). Активные — по users.last_activity (время начала сегодня/недели);
+# итога за все время у активных нет (last_activity хранит только последний визит) — total = NULL.
+GET_DAILY_STATS_SUMMARY = """
+SELECT metric, dim, SUM(value) AS total,
+       SUM(CASE WHEN day >= ? THEN value ELSE 0 END) AS today,
+       SUM(CASE WHEN day >= ? THEN value ELSE 0 END) AS week
+FROM daily_stats
+GROUP BY metric, dim
+UNION ALL
+SELECT 'active_users', '', NULL,
+       SUM(CASE WHEN last_activity >= ? THEN 1 ELSE 0 END),
+       COUNT(*)
+FROM users WHERE last_activity >= ?
 """
 
 # --- Реферальный баланс ---
@@ -1,7 +1,15 @@
 # bot/handlers/admin.py
 # --- ОБНОВЛЕН: 2025-12-04 12:25 - Добавлен счетчик неудачных генераций ---
+# [2025-12-08] Детальная статистика читается из суточных агрегатов daily_stats (один запрос)
+# [2025-12-08] Панель и статистика используют общий снимок db.get_dashboard_snapshot (кэш с TTL)
+# [2025-12-08] Список пользователей листается по курсору (keyset), всего страниц — из снимка дашборда
+# [2025-12-08] Поиск по подстроке (users_fts): несколько результатов — списком со страницами, карточка по кнопке
+# [2025-12-08] Перцентили задержки рендера (черновик / финальный результат)
+# [2025-12-08] Здоровье провайдеров генерации, фоллбэки и хеджирование
+# [2025-12-08] Курсор страницы пользователей — user_id, callback_data проверяется до запроса
 
 import logging
+import re
 from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery
@@ -13,14 +21,22 @@ from states.fsm import AdminStates
 from keyboards.admin_kb import (
     get_admin_main_menu,
     get_back_to_admin_menu,
-    get_users_list_keyboard
+    get_users_list_keyboard, get_search_results_keyboard
 )
 
 from handlers import payment
+from services.result_cache import result_cache
+from services.delivery import result_delivery
+from services.balance_verifier import balance_verifier
+from services.latency import render_latency
+from services.providers import generation_router
 
 logger = logging.getLogger(__name__)
 router = Router()
 
+# callback_data страницы пользователей: admin_users_{next|prev}_{страница}_{user_id}
+USERS_PAGE_DATA = re.compile(r"admin_users_(next|prev)_(\d{1,6})_(-?\d{1,20})")
+
 
 # ===== ПРОВЕРКА АДМИНА =====
 def is_admin(user_id: int, admins: list[int]) -> bool:
@@ -59,12 +75,13 @@ async def show_admin_panel(callback: CallbackQuery, state: FSMContext, admins: l
     logger.warning(
         f"🔍 [ADMIN PANEL] STEP 2 - AFTER set_state(None): menu_message_id={data_after.get('menu_message_id')}")
 
-    # Получаем статистику
-    total_users = await db.get_total_users_count()
-    total_revenue = await db.get_total_revenue()
-    new_today = await db.get_new_users_count(days=1)
-    successful_payments = await db.get_successful_payments_count()
-    failed_today = await db.get_failed_generations_count(days=1)
+    # Получаем статистику (общий снимок с детальной статистикой)
+    snapshot = await db.get_dashboard_snapshot()
+    total_users = snapshot['users']['total']
+    total_revenue = snapshot['revenue']['total']
+    new_today = snapshot['users']['today']
+    successful_payments = snapshot['payments']['total']
+    failed_today = snapshot['failed_generations']['today']
 
     # Формируем текст
     admin_text = (
@@ -116,6 +133,16 @@ async def back_to_admin_main(callback: CallbackQuery, state: FSMContext, admins:
 
 
 # ===== ДЕТАЛЬНАЯ СТАТИСТИКА =====
+def latency_line(stats: dict) -> str:
+    """p50 / p95 / p99 в секундах и число замеров"""
+    if not stats['count']:
+        return "нет данных"
+    return (
+        f"p50 **{stats['p50'] / 1000:.1f} c**, p95 **{stats['p95'] / 1000:.1f} c**, "
+        f"p99 {stats['p99'] / 1000:.1f} c ({stats['count']})"
+    )
+
+
 @router.callback_query(F.data == "admin_stats")
 async def show_admin_stats(callback: CallbackQuery, admins: list[int]):
     """Показать детальную статистику системы"""
@@ -125,31 +152,67 @@ async def show_admin_stats(callback: CallbackQuery, admins: list[int]):
         await callback.answer("❌ У вас нет прав администратора.", show_alert=True)
         return
 
+    # Все счетчики — из снимка дашборда (daily_stats одним запросом, кэш на несколько секунд)
+    daily = await db.get_dashboard_snapshot()
+
     # ПОЛЬЗОВАТЕЛИ
-    total_users = await db.get_total_users_count()
-    new_today = await db.get_new_users_count(days=1)
-    new_week = await db.get_new_users_count(days=7)
-    active_today = await db.get_active_users_count(days=1)
-    active_week = await db.get_active_users_count(days=7)
+    total_users = daily['users']['total']
+    new_today = daily['users']['today']
+    new_week = daily['users']['week']
+    active_today = daily['active_users']['today']
+    active_week = daily['active_users']['week']
 
     # ГЕНЕРАЦИИ
-    total_generations = await db.get_total_generations()
-    generations_today = await db.get_generations_count(days=1)
-    generations_week = await db.get_generations_count(days=7)
-    failed_today = await db.get_failed_generations_count(days=1)
-    failed_week = await db.get_failed_generations_count(days=7)
-    conversion_rate = await db.get_conversion_rate()
+    total_generations = daily['generations']['total']
+    generations_today = daily['generations']['today']
+    generations_week = daily['generations']['week']
+    failed_today = daily['failed_generations']['today']
+    failed_week = daily['failed_generations']['week']
+    conversion_rate = daily['conversion_rate']
 
     # ФИНАНСЫ
-    total_revenue = await db.get_total_revenue()
-    revenue_today = await db.get_revenue_by_period(days=1)
-    revenue_week = await db.get_revenue_by_period(days=7)
-    successful_payments = await db.get_successful_payments_count()
-    average_payment = await db.get_average_payment()
+    total_revenue = daily['revenue']['total']
+    revenue_today = daily['revenue']['today']
+    revenue_week = daily['revenue']['week']
+    successful_payments = daily['payments']['total']
+    average_payment = daily['average_payment']
+
+    # КЭШ РЕЗУЛЬТАТОВ
+    cache_stats = result_cache.stats()
+    delivery_stats = result_delivery.stats()
+    balance_stats = db.balance_cache_stats()
+
+    # ЗАДЕРЖКА РЕНДЕРА (последние замеры с момента запуска бота)
+    latency_text = "\n".join(
+        f"• {title}: {latency_line(render_latency.stats(phase))}"
+        for phase, title in (('preview', 'Черновик'), ('full', 'Финальный'))
+    )
+
+    # ПРОВАЙДЕРЫ ГЕНЕРАЦИИ
+    router_stats = generation_router.stats()
+    providers_text = "\n".join(
+        f"• {'🟢' if p['available'] else '🔴'} {p['name']}: успешно **{p['successes']}**, ошибок **{p['failures']}**"
+        + (f", p95 {p['p95'] / 1000:.1f} c" if p['p95'] is not None else "")
+        for p in router_stats['providers']
+    )
+    providers_text += (
+        f"\n• Фоллбэков: **{router_stats['fallbacks']}**, "
+        f"хеджирований: **{router_stats['hedged']}** (выиграли {router_stats['hedge_wins']})"
+    )
+
+    # СВЕРКА БАЛАНСОВ С ЖУРНАЛОМ
+    report = balance_verifier.last_report
+    if report:
+        ledger_text = (
+            f"• Последняя сверка: {report['finished_at'].strftime('%d.%m.%Y %H:%M')}, "
+            f"проверено **{report['checked']}**, расхождений **{report['drift']}**"
+        )
+    else:
+        ledger_text = "• Сверка еще не выполнялась"
 
     # ПОПУЛЯРНЫЕ КОМНАТЫ И СТИЛИ
-    popular_rooms = await db.get_popular_rooms(limit=5)
-    popular_styles = await db.get_popular_styles(limit=5)
+    popular_rooms = daily['popular_rooms']
+    popular_styles = daily['popular_styles']
 
     # Формируем списки с экранированием спецсимволов
     if popular_rooms:
@@ -176,7 +239,8 @@ async def show_admin_stats(callback: CallbackQuery, admins: list[int]):
         styles_text = "  • Данных пока нет"
 
     stats_text = (
-        "📊 **ДЕТАЛЬНАЯ СТАТИСТИКА СИСТЕМЫ**\n\n"
+        "📊 **ДЕТАЛЬНАЯ СТАТИСТИКА СИСТЕМЫ**\n"
+        f"🕒 Данные на {daily['generated_at'].strftime('%H:%M:%S')}\n\n"
         "👥 **Пользователи:**\n"
         f"• Всего: **{total_users}**\n"
         f"• Новых за сегодня: **{new_today}**\n"
@@ -196,6 +260,19 @@ async def show_admin_stats(callback: CallbackQuery, admins: list[int]):
         f"• Выручка за неделю: **{revenue_week} руб.**\n"
         f"• Успешных платежей: **{successful_payments}**\n"
         f"• Средний чек: **{average_payment} руб.**\n\n"
+        "♻️ **Кэш результатов:**\n"
+        f"• Попаданий: **{cache_stats['hits']}** (память {cache_stats['hits_memory']}, диск {cache_stats['hits_disk']})\n"
+        f"• Промахов: **{cache_stats['misses']}**\n"
+        f"• Доля попаданий: **{cache_stats['hit_rate']}%**\n"
+        f"• Записей в памяти: **{cache_stats['memory_entries']}**\n"
+        f"• Отправок по file\\_id: **{delivery_stats['reused']}** (загрузок: {delivery_stats['uploads']})\n"
+        f"• Кэш балансов: попаданий **{balance_stats['hits']}**, промахов **{balance_stats['misses']}**\n\n"
+        "⏱ **Время рендера:**\n"
+        f"{latency_text}\n\n"
+        "🔌 **Провайдеры:**\n"
+        f"{providers_text}\n\n"
+        "📒 **Журнал баланса:**\n"
+        f"{ledger_text}\n\n"
         "🏠 **Популярные комнаты:**\n"
         f"{rooms_text}\n\n"
         "🎨 **Популярные стили:**\n"
@@ -221,22 +298,35 @@ async def show_all_users(callback: CallbackQuery, admins: list[int]):
     await show_users_page(callback, page=1, admins=admins)
 
 
-@router.callback_query(F.data.startswith("admin_users_page_"))
+@router.callback_query(F.data.startswith("admin_users_next_") | F.data.startswith("admin_users_prev_"))
 async def show_users_page_handler(callback: CallbackQuery, admins: list[int]):
-    """Обработчик пагинации пользователей"""
+    """Обработчик пагинации пользователей: admin_users_{next|prev}_{страница}_{user_id}"""
     user_id = callback.from_user.id
 
     if not is_admin(user_id, admins):
         await callback.answer("❌ У вас нет прав администратора.", show_alert=True)
         return
 
-    # Извлекаем номер страницы
-    page = int(callback.data.split("_")[-1])
-    await show_users_page(callback, page=page, admins=admins)
+    # Извлекаем направление, номер страницы и курсор
+    match = USERS_PAGE_DATA.fullmatch(callback.data)
+    if not match:
+        # Кнопка из старого сообщения (другой формат курсора) — показываем список сначала
+        await show_users_page(callback, page=1, admins=admins)
+        return
 
+    direction, page, cursor_user_id = match.groups()
+    await show_users_page(
+        callback,
+        page=max(1, int(page)),
+        admins=admins,
+        cursor=int(cursor_user_id),
+        backward=direction == "prev"
+    )
 
-async def show_users_page(callback: CallbackQuery, page: int, admins: list[int]):
-    """Показать конкретную страницу пользователей"""
+
+async def show_users_page(callback: CallbackQuery, page: int, admins: list[int],
+                          cursor: int | None = None, backward: bool = False):
+    """Показать страницу пользователей (cursor — граница соседней страницы, см. db.get_users_page)"""
     user_id = callback.from_user.id
 
     if not is_admin(user_id, admins):
@@ -244,12 +334,19 @@ async def show_users_page(callback: CallbackQuery, page: int, admins: list[int])
         return
 
     # Получаем пользователей для страницы
-    users, total_pages = await db.get_all_users_paginated(page=page, per_page=10)
+    per_page = 10
+    users, has_prev, has_next = await db.get_users_page(cursor, backward=backward, per_page=per_page)
 
     if not users:
         await callback.answer("📭 Пользователей нет.", show_alert=True)
         return
 
+    # Всего страниц — по кэшированному числу пользователей (без COUNT(*) на каждую страницу)
+    snapshot = await db.get_dashboard_snapshot()
+    total_pages = max((snapshot['users']['total'] + per_page - 1) // per_page, page + has_next)
+    if not has_next:
+        total_pages = page
+
     # Формируем текст
     users_text = f"👥 **СПИСОК ПОЛЬЗОВАТЕЛЕЙ** (стр. {page}/{total_pages})\n\n"
     for idx, user in enumerate(users, start=1):
@@ -266,7 +363,7 @@ async def show_users_page(callback: CallbackQuery, page: int, admins: list[int])
     try:
         await callback.message.edit_text(
             text=users_text,
-            reply_markup=get_users_list_keyboard(page, total_pages),
+            reply_markup=get_users_list_keyboard(page, total_pages, users[0], users[-1], has_prev, has_next),
             parse_mode="Markdown"
         )
     except Exception as e:
@@ -294,6 +391,7 @@ async def start_find_user(callback: CallbackQuery, state: FSMContext, admins: li
         "• `ID пользователя` (например: `123456789`)\n"
         "• `@username` (например: `@ivan_petrov`)\n"
         "• `Реферальный код` (например: `abc123xyz`)\n\n"
+        "Можно часть ID, username или кода (от 3 символов).\n\n"
         "⚠️ Для отмены нажмите кнопку ниже."
     )
 
@@ -309,6 +407,10 @@ async def start_find_user(callback: CallbackQuery, state: FSMContext, admins: li
     await callback.answer()
 
 
+# Результатов поиска на странице
+SEARCH_PAGE_SIZE = 10
+
+
 @router.message(AdminStates.waiting_for_search)
 async def process_search_query(message: Message, state: FSMContext, admins: list[int]):
     """Обработка поискового запроса"""
@@ -321,9 +423,9 @@ async def process_search_query(message: Message, state: FSMContext, admins: list
     query = message.text.strip()
 
     # Выполняем поиск
-    user_data = await db.search_user(query)
+    users, has_more = await db.search_users(query, limit=SEARCH_PAGE_SIZE)
 
-    if not user_data:
+    if not users:
         await message.answer(
             "❌ **Пользователь не найден!**\n\n"
             "Попробуйте другой запрос.",
@@ -334,6 +436,94 @@ async def process_search_query(message: Message, state: FSMContext, admins: list
     # Очищаем состояние
     await state.clear()
 
+    # Единственное совпадение — сразу карточка
+    if len(users) == 1 and not has_more:
+        await message.answer(
+            text=await build_user_card(users[0]),
+            reply_markup=get_back_to_admin_menu(),
+            parse_mode="Markdown"
+        )
+        return
+
+    # Запрос может не влезть в callback_data — для страниц храним его в данных FSM
+    await state.update_data(admin_search_query=query)
+    await message.answer(
+        text=search_results_text(query, users, page=1),
+        reply_markup=get_search_results_keyboard(users, 1, has_prev=False, has_next=has_more),
+        parse_mode="Markdown"
+    )
+
+
+@router.callback_query(F.data.startswith("admin_search_page_"))
+async def show_search_page(callback: CallbackQuery, state: FSMContext, admins: list[int]):
+    """Страница результатов поиска: admin_search_page_{страница}"""
+    if not is_admin(callback.from_user.id, admins):
+        await callback.answer("❌ У вас нет прав администратора.", show_alert=True)
+        return
+
+    query = (await state.get_data()).get('admin_search_query')
+    if not query:
+        await callback.answer("Поиск устарел, повторите запрос.", show_alert=True)
+        return
+
+    page = int(callback.data.split("_")[-1])
+    users, has_more = await db.search_users(
+        query, limit=SEARCH_PAGE_SIZE, offset=(page - 1) * SEARCH_PAGE_SIZE
+    )
+    if not users:
+        await callback.answer("📭 Больше результатов нет.", show_alert=True)
+        return
+
+    try:
+        await callback.message.edit_text(
+            text=search_results_text(query, users, page),
+            reply_markup=get_search_results_keyboard(users, page, has_prev=page > 1, has_next=has_more),
+            parse_mode="Markdown"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка показа результатов поиска: {e}")
+
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("admin_user_"))
+async def show_user_card(callback: CallbackQuery, admins: list[int]):
+    """Карточка пользователя: admin_user_{user_id}"""
+    if not is_admin(callback.from_user.id, admins):
+        await callback.answer("❌ У вас нет прав администратора.", show_alert=True)
+        return
+
+    user_data = await db.get_user_data(int(callback.data.split("_")[-1]))
+    if not user_data:
+        await callback.answer("❌ Пользователь не найден!", show_alert=True)
+        return
+
+    try:
+        await callback.message.edit_text(
+            text=await build_user_card(user_data),
+            reply_markup=get_back_to_admin_menu(),
+            parse_mode="Markdown"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка показа карточки пользователя: {e}")
+
+    await callback.answer()
+
+
+def search_results_text(query: str, users: list[dict], page: int) -> str:
+    """Список результатов поиска (Markdown)"""
+    query_clean = query.replace('_', '\\_').replace('*', '\\*').replace('[', '\\[').replace(']', '\\]').replace('`', '\\`')
+    text = f"🔍 **РЕЗУЛЬТАТЫ ПОИСКА** «{query_clean}» (стр. {page})\n\n"
+    for idx, user in enumerate(users, start=(page - 1) * SEARCH_PAGE_SIZE + 1):
+        # Экранируем username
+        username_clean = (user['username'] or "Без username").replace('@', '').replace('_', '\\_').replace(
+            '*', '\\*').replace('[', '\\[').replace(']', '\\]').replace('`', '\\`')
+        text += f"{idx}. ID: `{user['user_id']}` | {username_clean} | 💰 {user['balance']}\n"
+    return text + "\nВыберите пользователя:"
+
+
+async def build_user_card(user_data: dict) -> str:
+    """Карточка пользователя для админа (Markdown)"""
     # Получаем данные пользователя
     found_user_id = user_data['user_id']
     username = user_data['username'] or "Не указан"
@@ -342,7 +532,7 @@ async def process_search_query(message: Message, state: FSMContext, admins: list
     referral_balance = user_data['referral_balance']
     referral_code = user_data['referral_code']
     referrals_count = user_data['referrals_count']
-    reg_date = user_data['reg_date']
+    reg_date = user_data.get('reg_date') or user_data.get('created_at')
     total_generations = user_data.get('total_generations', 0)
 
     # Получаем статистику платежей
@@ -402,12 +592,7 @@ async def process_search_query(message: Message, state: FSMContext, admins: list
         f"• `/add_tokens {found_user_id} <кол-во>` - добавить токены\n"
         f"• `/balance {found_user_id}` - проверить баланс"
     )
-
-    await message.answer(
-        text=result_text,
-        reply_markup=get_back_to_admin_menu(),
-        parse_mode="Markdown"
-    )
+    return result_text
 
 
 # ===== ИСТОРИЯ ПЛАТЕЖЕЙ =====
@@ -487,7 +672,7 @@ async def cmd_add_tokens(message: Message, admins: list[int]):
             await message.answer("❌ Количество токенов должно быть больше 0!")
             return
 
-        await db.add_tokens(target_user_id, tokens_to_add)
+        await db.add_tokens(target_user_id, tokens_to_add, reason='admin', ref_id=str(message.from_user.id))
         new_balance = await db.get_balance(target_user_id)
 
         await message.answer(
@@ -1,5 +1,17 @@
 # creation.py
 # --- ОБНОВЛЕН: 2025-12-06 (фиксы разметки Markdown/HTML, безопасные подписи) ---
+# [2025-12-08] Генерации идут через очередь generation_scheduler (позиция в очереди в сообщении о прогрессе)
+# [2025-12-08] Кэш результатов: повтор того же стиля на том же фото — без генерации и без списания
+# [2025-12-08] Результаты отправляются через result_delivery (повторно — по Telegram file_id)
+# [2025-12-08] FSM буферизуется на апдейт; перед ожиданием генерации буфер сбрасывается (flush_state)
+# [2025-12-08] Атомарное списание перед постановкой в очередь, возврат токена при неудаче
+# [2025-12-08] log_generation получает модель, длительность и стоимость рендера из задачи
+# [2025-12-08] В задачу передается photo_unique_id — фото скачивается один раз на все генерации
+# [2025-12-08] Превью-сетка: несколько стилей одним пакетом, альбомом, по цене пакета
+# [2025-12-08] Двухфазный рендер (настройка fast_preview): черновик, затем финальный результат в том же сообщении
+# [2025-12-08] Кэш результатов: ищется по модели основного провайдера; результат фоллбэка/хеджа на другой модели не кэшируется
+# [2025-12-08] Превью-сетка: списывается доля цены за стили без кэша (grid_charge), возврат — от списанного
+# [2025-12-08] charge_user: ошибка списания — предупреждение, а не экран «нет генераций»
 
 import asyncio
 import logging
@@ -8,9 +20,10 @@ import html
 from aiogram import Router, F
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
-from aiogram.types import CallbackQuery, Message, URLInputFile
+from aiogram.types import CallbackQuery, Message
 from aiogram.exceptions import TelegramBadRequest
 
+from config import config
 # Импортируем свои модули
 from database.db import db
 from keyboards.inline import (
@@ -21,10 +34,19 @@ from keyboards.inline import (
     get_profile_keyboard,
     get_main_menu_keyboard,
     get_clear_space_confirm_keyboard,
-    get_upload_photo_keyboard
+    get_upload_photo_keyboard,
+    get_preview_grid_keyboard,
+    STYLE_TYPES
 )
 
-from services.replicate_api import generate_image_auto, clear_space_image
+from services.generation_queue import (
+    generation_scheduler, GenerationJob, GenerationQueueFull, PRIORITY_USER, OPERATION_GRID
+)
+from services.providers import generation_router
+from services.replicate_api import design_cache_key, clear_space_cache_key
+from services.result_cache import result_cache
+from services.delivery import result_delivery, sent_file_id
+from middlewares.fsm_buffer import flush_state
 from states.fsm import CreationStates
 from utils.texts import (
     CHOOSE_STYLE_TEXT,
@@ -33,7 +55,12 @@ from utils.texts import (
     TOO_MANY_PHOTOS_TEXT,
     UPLOAD_PHOTO_TEXT,
     PROFILE_TEXT,
-    MAIN_MENU_TEXT
+    MAIN_MENU_TEXT,
+    GENERATION_QUEUE_TEXT,
+    GENERATION_QUEUE_FULL_TEXT,
+    DEBIT_ERROR_TEXT,
+    PREVIEW_GRID_PROGRESS_TEXT,
+    PREVIEW_GRID_DONE_TEXT
 )
 from utils.helpers import add_balance_to_text
 
@@ -83,6 +110,256 @@ async def show_single_menu(
     return menu.message_id
 
 
+async def show_generation_progress(callback: CallbackQuery, state: FSMContext, job: GenerationJob, text: str):
+    """
+    Сообщение о прогрессе генерации.
+    Если задача ждет в очереди — показывает позицию, а когда воркер берет задачу,
+    заменяет текст на обычный текст прогресса.
+    """
+    position = generation_scheduler.position(job)
+    if not position or job.started:
+        progress_msg_id = await show_single_menu(callback.message, state, text, None, show_balance=False)
+        # Дальше долгое ожидание генерации — сохраняем FSM (ID меню) сразу, а не в конце апдейта
+        await flush_state(state)
+        return progress_msg_id
+
+    progress_msg_id = await show_single_menu(
+        callback.message,
+        state,
+        GENERATION_QUEUE_TEXT.format(position=position),
+        None,
+        show_balance=False
+    )
+
+    async def on_start():
+        try:
+            await callback.message.bot.edit_message_text(
+                chat_id=callback.message.chat.id,
+                message_id=progress_msg_id,
+                text=text
+            )
+        except Exception as e:
+            logger.debug(f"Не удалось обновить сообщение о прогрессе: {e}")
+
+    if job.started:
+        await on_start()
+    else:
+        job.on_start = on_start
+    await flush_state(state)
+    return progress_msg_id
+
+
+async def send_cached_result(callback: CallbackQuery, cache_key: str | None, caption: str,
+                             parse_mode: str | None = None) -> bool:
+    """
+    Отправить результат из кэша. True — результат отправлен, генерация не нужна.
+    Если URL из кэша уже недоступен, запись удаляется и возвращается False.
+    """
+    cached = await result_cache.get(cache_key)
+    if not cached:
+        return False
+
+    try:
+        await result_delivery.send_photo(
+            callback.message.bot,
+            callback.message.chat.id,
+            cached['url'],
+            file_id=cached.get('file_id'),
+            caption=caption,
+            parse_mode=parse_mode
+        )
+    except Exception as e:
+        logger.warning(f"Результат из кэша недоступен, генерируем заново: {e}")
+        await result_cache.invalidate(cache_key)
+        return False
+
+    await db.log_activity(callback.from_user.id, 'cache_hit')
+    await callback.answer()
+    return True
+
+
+def _design_caption(room: str, style: str) -> str:
+    # Безопасные строки для HTML
+    room_name = html.escape(room.replace('_', ' ').title(), quote=True)
+    style_name = html.escape(style.replace('_', ' ').title(), quote=True)
+    return f"✨ Ваш новый дизайн {room_name} в стиле <b>{style_name}</b>!"
+
+
+def _preview_caption(room: str, style: str) -> str:
+    room_name = html.escape(room.replace('_', ' ').title(), quote=True)
+    style_name = html.escape(style.replace('_', ' ').title(), quote=True)
+    return f"👀 Черновик: {room_name} в стиле <b>{style_name}</b>\n⏳ Улучшаю качество..."
+
+
+def fast_preview_enabled(room: str, style: str) -> bool:
+    """Двухфазный рендер для комнаты/стиля (настройка fast_preview: 'all' или ключи через запятую)"""
+    keys = {key.strip() for key in db.setting_str('fast_preview').split(',') if key.strip()}
+    return 'all' in keys or room in keys or style in keys
+
+
+async def show_preview(callback: CallbackQuery, job: GenerationJob, room: str, style: str,
+                       progress_msg_id: int | None) -> int | None:
+    """
+    Двухфазный рендер: если черновик готов раньше финального результата,
+    показать его вместо сообщения о прогрессе. Возвращает ID сообщения с черновиком.
+    """
+    await asyncio.wait({job.future, job.preview_future}, return_when=asyncio.FIRST_COMPLETED)
+    if job.future.done() or not job.preview_future.result():
+        return None
+
+    try:
+        sent = await result_delivery.send_photo(
+            callback.message.bot,
+            callback.message.chat.id,
+            job.preview_future.result(),
+            caption=_preview_caption(room, style),
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.debug(f"Не удалось отправить черновик: {e}")
+        return None
+
+    if progress_msg_id:
+        try:
+            await callback.message.bot.delete_message(
+                chat_id=callback.message.chat.id,
+                message_id=progress_msg_id
+            )
+        except Exception as e:
+            logger.debug(f"Не удалось удалить сообщение о прогрессе: {e}")
+    return sent.message_id
+
+
+async def charge_user(callback: CallbackQuery, state: FSMContext, amount: int = 1,
+                      reason: str = 'generation') -> bool:
+    """
+    Атомарно списать генерации перед постановкой задачи.
+    False — не списано, пользователю уже ответили: нет генераций — экран оплаты, ошибка БД — предупреждение.
+    """
+    user_id = callback.from_user.id
+    try:
+        balance = await db.debit_balance(user_id, amount=amount, reason=reason)
+    except Exception as e:
+        logger.error(f"Не удалось списать генерации у пользователя {user_id}: {e}")
+        await callback.answer(DEBIT_ERROR_TEXT, show_alert=True)
+        return False
+    if balance is None:
+        await state.clear()
+        await show_single_menu(callback.message, state, NO_BALANCE_TEXT, get_payment_keyboard())
+        return False
+    return True
+
+
+def grid_size() -> int:
+    """Стилей в одной превью-сетке"""
+    return min(config.PREVIEW_GRID_SIZE, len(STYLE_TYPES))
+
+
+def grid_charge(price: int, rendered: int, size: int) -> int:
+    """Цена сетки, из которой рендерится rendered стилей из size (остальные — из кэша): доля с округлением вверх"""
+    if not rendered or not size:
+        return 0
+    return min(price, -(-price * rendered // size))
+
+
+def grid_refund(charged: int, total: int, failed: int) -> int:
+    """Сколько генераций вернуть за превью-сетку: доля списанного за неудавшиеся стили (с округлением вверх)"""
+    if not failed or not total:
+        return 0
+    return min(charged, -(-charged * failed // total))
+
+
+async def deliver_recovered_grid(bot, job: GenerationJob, result_urls: list | None):
+    """Доставка восстановленной после перезапуска превью-сетки"""
+    styles = job.styles
+    result_urls = result_urls or [None] * len(styles)
+    failed = sum(1 for url in result_urls if not url)
+    if job.priority == PRIORITY_USER:
+        # В задаче только рендерившиеся стили; списано было за их долю сетки (как в preview_grid_handler)
+        charged = grid_charge(db.setting_int('preview_grid_price'), len(styles), grid_size())
+        refund = grid_refund(charged, len(styles), failed)
+        if refund:
+            await db.refund_balance(job.user_id, refund, ref_id=f"job:{job.id}")
+
+    for style, url in zip(styles, result_urls):
+        await db.log_generation(
+            user_id=job.user_id,
+            room_type=job.room_type,
+            style_type=style,
+            operation_type=OPERATION_GRID,
+            success=url is not None,
+            model_id=job.model_id,
+            duration_ms=job.duration_ms,
+            cost=job.cost / len(styles)
+        )
+
+    items = [(url, None, _design_caption(job.room_type, style))
+             for style, url in zip(styles, result_urls) if url]
+    try:
+        if items:
+            await result_delivery.send_media_group(bot, job.chat_id, items, parse_mode="HTML")
+        else:
+            await bot.send_message(
+                job.chat_id,
+                "Ошибка генерации. Попробуйте еще раз.",
+                reply_markup=get_main_menu_keyboard()
+            )
+    except Exception as e:
+        logger.error(f"Не удалось доставить восстановленную задачу {job.id}: {e}")
+
+
+async def deliver_recovered_job(bot, job: GenerationJob, result_image_url: str | None):
+    """
+    Доставка результата задачи, которая была в очереди во время перезапуска бота.
+    Хэндлер, ждавший результат, уже не существует — отправляем результат напрямую в чат.
+    """
+    if job.operation_type == OPERATION_GRID:
+        await deliver_recovered_grid(bot, job, result_image_url)
+        return
+
+    # Обычные пользователи платят при постановке задачи (админы — нет)
+    if result_image_url is None and job.priority == PRIORITY_USER:
+        await db.refund_balance(job.user_id, ref_id=f"job:{job.id}")
+
+    await db.log_generation(
+        user_id=job.user_id,
+        room_type=job.room_type or job.operation_type,
+        style_type=job.style_type or job.operation_type,
+        operation_type=job.operation_type,
+        success=result_image_url is not None,
+        model_id=job.model_id,
+        duration_ms=job.duration_ms,
+        cost=job.cost
+    )
+
+    try:
+        if not result_image_url:
+            await bot.send_message(
+                job.chat_id,
+                "Ошибка генерации. Попробуйте еще раз.",
+                reply_markup=get_main_menu_keyboard()
+            )
+        elif job.operation_type == 'clear_space':
+            await result_delivery.send_photo(
+                bot,
+                job.chat_id,
+                result_image_url,
+                caption="✨ Пространство очищено!",
+                reply_markup=get_main_menu_keyboard()
+            )
+        else:
+            await result_delivery.send_photo(
+                bot,
+                job.chat_id,
+                result_image_url,
+                caption=_design_caption(job.room_type, job.style_type),
+                parse_mode="HTML",
+                reply_markup=get_post_generation_keyboard()
+            )
+    except Exception as e:
+        logger.error(f"Не удалось доставить восстановленную задачу {job.id}: {e}")
+
+
 # ===== ГЛАВНЫЙ МЕНЮ И СТАРТ =====
 @router.callback_query(F.data == "main_menu")
 async def go_to_main_menu(callback: CallbackQuery, state: FSMContext):
@@ -131,6 +408,7 @@ async def photo_uploaded(message: Message, state: FSMContext, admins: list[int])
 
     await state.update_data(media_group_id=None)
     photo_file_id = message.photo[-1].file_id
+    photo_unique_id = message.photo[-1].file_unique_id
 
     # Проверка баланса
     if user_id not in admins:
@@ -141,7 +419,7 @@ async def photo_uploaded(message: Message, state: FSMContext, admins: list[int])
             return
 
     # Сохраняем фото и переходим к выбору комнаты
-    await state.update_data(photo_id=photo_file_id)
+    await state.update_data(photo_id=photo_file_id, photo_unique_id=photo_unique_id)
     await state.set_state(CreationStates.choose_room)
 
     # Удаляем старое меню "Отправь фото"
@@ -209,13 +487,6 @@ async def clear_space_execute_handler(callback: CallbackQuery, state: FSMContext
     user_id = callback.from_user.id
     await db.log_activity(user_id, 'clear_space')
 
-    if user_id not in admins:
-        balance = await db.get_balance(user_id)
-        if balance <= 0:
-            await state.clear()
-            await show_single_menu(callback.message, state, NO_BALANCE_TEXT, get_payment_keyboard())
-            return
-
     data = await state.get_data()
     photo_id = data.get('photo_id')
 
@@ -223,20 +494,37 @@ async def clear_space_execute_handler(callback: CallbackQuery, state: FSMContext
         await callback.answer("Ошибка: фото не найдено", show_alert=True)
         return
 
-    if user_id not in admins:
-        await db.decrease_balance(user_id)
+    primary_model = generation_router.primary_model_id()
+    cache_key = clear_space_cache_key(data.get('photo_unique_id'), primary_model)
+    if await send_cached_result(callback, cache_key, "✨ Пространство очищено!"):
+        await show_single_menu(callback.message, state, PHOTO_SAVED_TEXT, get_room_keyboard())
+        return
 
-    progress_msg_id = await show_single_menu(
-        callback.message,
-        state,
-        "⏳ Очищаю пространство...",
-        None,
-        show_balance=False
-    )
+    # Списание атомарное: двойной клик не уведет баланс в минус и не запустит два рендера
+    charged = user_id not in admins
+    if charged and not await charge_user(callback, state, reason='clear_space'):
+        return
+
+    try:
+        job = await generation_scheduler.submit(
+            user_id=user_id,
+            chat_id=callback.message.chat.id,
+            operation_type='clear_space',
+            photo_id=photo_id,
+            photo_unique_id=data.get('photo_unique_id'),
+            is_admin=user_id in admins
+        )
+    except GenerationQueueFull:
+        if charged:
+            await db.refund_balance(user_id)
+        await callback.answer(GENERATION_QUEUE_FULL_TEXT, show_alert=True)
+        return
+
+    progress_msg_id = await show_generation_progress(callback, state, job, "⏳ Очищаю пространство...")
     await callback.answer()
 
     try:
-        result_image_url = await clear_space_image(photo_id, bot_token)
+        result_image_url = await job.future
         success = result_image_url is not None
     except Exception as e:
         logger.error(f"Критическая ошибка очистки пространства: {e}")
@@ -259,12 +547,19 @@ async def clear_space_execute_handler(callback: CallbackQuery, state: FSMContext
         except Exception:
             pass
 
+    # Генерация не удалась — возвращаем списанный токен
+    if not success and charged:
+        await db.refund_balance(user_id, ref_id=f"job:{job.id}")
+
     await db.log_generation(
         user_id=user_id,
         room_type='clear_space',
         style_type='clear_space',
         operation_type='clear_space',
-        success=success
+        success=success,
+        model_id=job.model_id,
+        duration_ms=job.duration_ms,
+        cost=job.cost
     )
 
     if progress_msg_id:
@@ -277,11 +572,16 @@ async def clear_space_execute_handler(callback: CallbackQuery, state: FSMContext
             logger.debug(f"Не удалось удалить сообщение о прогрессе: {e}")
 
     if result_image_url:
-        await callback.message.answer_photo(
-            photo=result_image_url,
+        sent = await result_delivery.send_photo(
+            callback.message.bot,
+            callback.message.chat.id,
+            result_image_url,
             caption="✨ Пространство очищено!",
             parse_mode="Markdown"
         )
+        # Результат запасного провайдера под ключом основной модели не кэшируем
+        if job.model_id == primary_model:
+            await result_cache.put(cache_key, {'url': result_image_url, 'file_id': sent_file_id(sent)})
         await state.set_state(CreationStates.choose_room)
         await show_single_menu(
             callback.message,
@@ -319,31 +619,50 @@ async def style_chosen(callback: CallbackQuery, state: FSMContext, admins: list[
     user_id = callback.from_user.id
     await db.log_activity(user_id, f'style_{style}')
 
-    if user_id not in admins:
-        balance = await db.get_balance(user_id)
-        if balance <= 0:
-            await state.clear()
-            await show_single_menu(callback.message, state, NO_BALANCE_TEXT, get_payment_keyboard())
-            return
-
     data = await state.get_data()
     photo_id = data.get('photo_id')
     room = data.get('room')
 
-    if user_id not in admins:
-        await db.decrease_balance(user_id)
+    primary_model = generation_router.primary_model_id()
+    cache_key = design_cache_key(data.get('photo_unique_id'), room, style, primary_model)
+    if await send_cached_result(callback, cache_key, _design_caption(room, style), parse_mode="HTML"):
+        await show_single_menu(callback.message, state, "", get_post_generation_keyboard())
+        return
 
-    progress_msg_id = await show_single_menu(
-        callback.message,
-        state,
-        "⏳ Создаю новый дизайн...",
-        None,
-        show_balance=False
-    )
+    # Списание атомарное: двойной клик не уведет баланс в минус и не запустит два рендера
+    charged = user_id not in admins
+    if charged and not await charge_user(callback, state):
+        return
+
+    try:
+        job = await generation_scheduler.submit(
+            user_id=user_id,
+            chat_id=callback.message.chat.id,
+            operation_type='design',
+            photo_id=photo_id,
+            room_type=room,
+            style_type=style,
+            photo_unique_id=data.get('photo_unique_id'),
+            is_admin=user_id in admins,
+            fast_preview=fast_preview_enabled(room, style)
+        )
+    except GenerationQueueFull:
+        if charged:
+            await db.refund_balance(user_id)
+        await callback.answer(GENERATION_QUEUE_FULL_TEXT, show_alert=True)
+        return
+
+    progress_msg_id = await show_generation_progress(callback, state, job, "⏳ Создаю новый дизайн...")
     await callback.answer()
 
+    preview_msg_id = None
     try:
-        result_image_url = await generate_image_auto(photo_id, room, style, bot_token)
+        if job.preview_future:
+            preview_msg_id = await show_preview(callback, job, room, style, progress_msg_id)
+            if preview_msg_id:
+                # Сообщение о прогрессе заменено черновиком
+                progress_msg_id = None
+        result_image_url = await job.future
         success = result_image_url is not None
     except Exception as e:
         logger.error(f"Критическая ошибка генерации: {e}")
@@ -369,36 +688,57 @@ async def style_chosen(callback: CallbackQuery, state: FSMContext, admins: list[
         except Exception:
             pass
 
+    # Генерация не удалась — возвращаем списанный токен
+    if not success and charged:
+        await db.refund_balance(user_id, ref_id=f"job:{job.id}")
+
     await db.log_generation(
         user_id=user_id,
         room_type=room,
         style_type=style,
         operation_type='design',
-        success=success
+        success=success,
+        model_id=job.model_id,
+        duration_ms=job.duration_ms,
+        cost=job.cost,
+        preview_ms=job.preview_ms
     )
 
-    if progress_msg_id:
+    # Черновик без финального результата не оставляем: генерация не удалась (и возвращена)
+    stale_msg_ids = [progress_msg_id] + ([preview_msg_id] if not result_image_url else [])
+    for message_id in filter(None, stale_msg_ids):
         try:
             await callback.message.bot.delete_message(
                 chat_id=callback.message.chat.id,
-                message_id=progress_msg_id
+                message_id=message_id
             )
         except Exception as e:
             logger.debug(f"Не удалось удалить сообщение о прогрессе: {e}")
 
     if result_image_url:
         try:
-            # Безопасные строки для HTML
-            room_name = html.escape(room.replace('_', ' ').title(), quote=True)
-            style_name = html.escape(style.replace('_', ' ').title(), quote=True)
-
-            caption = f"✨ Ваш новый дизайн {room_name} в стиле <b>{style_name}</b>!"
-
-            await callback.message.answer_photo(
-                photo=URLInputFile(result_image_url),
-                caption=caption,
-                parse_mode="HTML"
-            )
+            sent = None
+            if preview_msg_id:
+                # Финальный результат заменяет черновик в том же сообщении
+                try:
+                    sent = await result_delivery.edit_photo(
+                        callback.message.bot,
+                        callback.message.chat.id,
+                        preview_msg_id,
+                        result_image_url,
+                        caption=_design_caption(room, style),
+                        parse_mode="HTML"
+                    )
+                except TelegramBadRequest as e:
+                    logger.debug(f"Не удалось заменить черновик, отправляем отдельно: {e}")
+            if sent is None:
+                sent = await result_delivery.send_photo(
+                    callback.message.bot,
+                    callback.message.chat.id,
+                    result_image_url,
+                    caption=_design_caption(room, style),
+                    parse_mode="HTML"
+                )
         except Exception as e:
             logger.error(f"Ошибка при отправке фото: {e}")
             await show_single_menu(
@@ -408,6 +748,9 @@ async def style_chosen(callback: CallbackQuery, state: FSMContext, admins: list[
                 get_main_menu_keyboard()
             )
             return
+        # Результат запасного провайдера под ключом основной модели не кэшируем
+        if job.model_id == primary_model:
+            await result_cache.put(cache_key, {'url': result_image_url, 'file_id': sent_file_id(sent)})
 # cообщение после генерации картинки
         await show_single_menu(
             callback.message,
@@ -424,6 +767,150 @@ async def style_chosen(callback: CallbackQuery, state: FSMContext, admins: list[
         )
 
 
+def next_grid_styles(offset: int) -> tuple[list[str], int]:
+    """Следующие PREVIEW_GRID_SIZE стилей по кругу и смещение для следующей сетки"""
+    size = grid_size()
+    offset %= len(STYLE_TYPES)
+    styles = [STYLE_TYPES[(offset + i) % len(STYLE_TYPES)][0] for i in range(size)]
+    return styles, (offset + size) % len(STYLE_TYPES)
+
+
+@router.callback_query(F.data == "preview_grid")
+async def preview_grid_handler(callback: CallbackQuery, state: FSMContext, admins: list[int]):
+    """
+    Превью-сетка: следующие PREVIEW_GRID_SIZE стилей для текущего фото и комнаты одним пакетом.
+    Стили рендерятся параллельно (одна задача в очереди, одно скачивание фото) и приходят альбомом.
+    Стили, которые уже есть в кэше, не рендерятся и не оплачиваются: списывается доля цены сетки
+    за рендерящиеся стили (grid_charge); если в кэше все — сетка бесплатна.
+    """
+    user_id = callback.from_user.id
+    await db.log_activity(user_id, 'preview_grid')
+
+    data = await state.get_data()
+    photo_id = data.get('photo_id')
+    photo_unique_id = data.get('photo_unique_id')
+    room = data.get('room')
+    if not photo_id or not room:
+        await callback.answer("Ошибка: фото не найдено", show_alert=True)
+        return
+
+    styles, next_offset = next_grid_styles(data.get('grid_offset', 0))
+    primary_model = generation_router.primary_model_id()
+    cache_keys = {style: design_cache_key(photo_unique_id, room, style, primary_model) for style in styles}
+    results = {style: await result_cache.get(cache_keys[style]) for style in styles}
+    missing = [style for style in styles if not results[style]]
+    price = db.setting_int('preview_grid_price')
+
+    if missing:
+        # Списание атомарное: двойной клик не уведет баланс в минус и не запустит два пакета
+        charge = grid_charge(price, len(missing), len(styles))
+        charged = user_id not in admins and charge > 0
+        if charged and not await charge_user(callback, state, amount=charge, reason='preview_grid'):
+            return
+
+        try:
+            job = await generation_scheduler.submit(
+                user_id=user_id,
+                chat_id=callback.message.chat.id,
+                operation_type=OPERATION_GRID,
+                photo_id=photo_id,
+                room_type=room,
+                style_type=','.join(missing),
+                photo_unique_id=photo_unique_id,
+                is_admin=user_id in admins
+            )
+        except GenerationQueueFull:
+            if charged:
+                await db.refund_balance(user_id, charge)
+            await callback.answer(GENERATION_QUEUE_FULL_TEXT, show_alert=True)
+            return
+
+        progress_msg_id = await show_generation_progress(
+            callback, state, job, PREVIEW_GRID_PROGRESS_TEXT.format(count=len(missing))
+        )
+        await callback.answer()
+
+        try:
+            result_urls = await job.future or [None] * len(missing)
+        except Exception as e:
+            logger.error(f"Критическая ошибка превью-сетки: {e}")
+            result_urls = [None] * len(missing)
+
+        # Не удавшиеся стили не оплачиваются: возвращаем их долю списанного
+        refund = grid_refund(charge, len(missing), sum(1 for url in result_urls if not url))
+        if charged and refund:
+            await db.refund_balance(user_id, refund, ref_id=f"job:{job.id}")
+
+        for style, url in zip(missing, result_urls):
+            await db.log_generation(
+                user_id=user_id,
+                room_type=room,
+                style_type=style,
+                operation_type=OPERATION_GRID,
+                success=url is not None,
+                model_id=job.model_id,
+                duration_ms=job.duration_ms,
+                cost=job.cost / len(missing)
+            )
+            if url:
+                results[style] = {'url': url}
+
+        if progress_msg_id:
+            try:
+                await callback.message.bot.delete_message(
+                    chat_id=callback.message.chat.id,
+                    message_id=progress_msg_id
+                )
+            except Exception as e:
+                logger.debug(f"Не удалось удалить сообщение о прогрессе: {e}")
+    else:
+        await db.log_activity(user_id, 'cache_hit')
+        await callback.answer()
+
+    ready = [style for style in styles if results[style]]
+    if not ready:
+        await show_single_menu(
+            callback.message,
+            state,
+            "Ошибка генерации. Попробуйте еще раз.",
+            get_main_menu_keyboard()
+        )
+        return
+
+    try:
+        sent = await result_delivery.send_media_group(
+            callback.message.bot,
+            callback.message.chat.id,
+            [(results[style]['url'], results[style].get('file_id'), _design_caption(room, style)) for style in ready],
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при отправке альбома: {e}")
+        await show_single_menu(
+            callback.message,
+            state,
+            "❌ Ошибка при отправке изображений. Попробуйте еще раз.",
+            get_main_menu_keyboard()
+        )
+        return
+
+    # Каждый стиль кэшируется отдельно: выбор его потом в меню стилей — без генерации и без списания.
+    # Стили, отрендеренные запасным провайдером, под ключом основной модели не кэшируем
+    served_by = dict(zip(missing, job.style_model_ids)) if missing else {}
+    for style, message in zip(ready, sent):
+        if served_by.get(style) == primary_model:
+            await result_cache.put(cache_keys[style], {'url': results[style]['url'], 'file_id': sent_file_id(message)})
+
+    await state.update_data(grid_offset=next_offset)
+    await state.set_state(CreationStates.choose_style)
+    await show_single_menu(
+        callback.message,
+        state,
+        PREVIEW_GRID_DONE_TEXT.format(size=len(styles), price=price),
+        get_preview_grid_keyboard()
+    )
+
+
 @router.callback_query(F.data == "change_style")
 async def change_style_after_gen(callback: CallbackQuery, state: FSMContext):
     await state.set_state(CreationStates.choose_style)
@@ -1,5 +1,6 @@
 # bot/handlers/payment.py
 # --- ОБНОВЛЕН: 2025-12-04 12:15 - Исправлены отступы уведомлений о платежах ---
+# [2025-12-08] Настройки рефералов берутся из снимка настроек db (без запроса к БД)
 
 import logging
 from aiogram import Router, F
@@ -71,8 +72,7 @@ async def _process_referral_commission(user_id: int, payment_id: str, amount: in
     """
     try:
         # 1. Проверяем включена ли реферальная программа
-        enabled = await db.get_setting('referral_enabled')
-        if str(enabled) != '1':
+        if not db.setting_bool('referral_enabled'):
             return
         
         # 2. Находим реферера
@@ -86,7 +86,7 @@ async def _process_referral_commission(user_id: int, payment_id: str, amount: in
             return
         
         # 3. Рассчитываем комиссию
-        commission_percent = int(await db.get_setting('referral_commission_percent') or '10')
+        commission_percent = db.setting_int('referral_commission_percent')
         earnings = int(amount * commission_percent / 100)
         
         logger.info(f"[REFERRAL] Расчет: {amount} руб * {commission_percent}% = {earnings} руб")
@@ -96,13 +96,13 @@ async def _process_referral_commission(user_id: int, payment_id: str, amount: in
         logger.info(f"[REFERRAL] Начислено {earnings} руб на реф. баланс реферера {referrer_id}")
         
         # 5. Конвертируем в генерации и начисляем на основной баланс
-        exchange_rate = int(await db.get_setting('referral_exchange_rate') or '29')
+        exchange_rate = db.setting_int('referral_exchange_rate')
         tokens_to_give = earnings // exchange_rate
         
         logger.info(f"[REFERRAL] Конвертация: {earnings} руб = {tokens_to_give} генераций")
         
         if tokens_to_give > 0:
-            await db.add_tokens(referrer_id, tokens_to_give)
+            await db.add_tokens(referrer_id, tokens_to_give, reason='referral_commission', ref_id=payment_id)
             logger.info(f"[REFERRAL] Начислено {tokens_to_give} генераций рефереру {referrer_id}")
         
         # 6. Логируем операцию
@@ -136,7 +136,9 @@ async def check_payment(callback: CallbackQuery, admins: list[int]):
         await db.set_payment_success(last_payment['yookassa_payment_id'])
         
         # 2. Начисляем токены покупателю
-        await db.add_tokens(user_id, last_payment['tokens'])
+        await db.add_tokens(
+            user_id, last_payment['tokens'], reason='payment', ref_id=last_payment['yookassa_payment_id']
+        )
         
         # 3. Начисляем реферальную комиссию (если есть реферер)
         await _process_referral_commission(
@@ -64,7 +64,7 @@ async def exchange_to_tokens(callback: CallbackQuery, state: FSMContext):
     """Начало обмена реферального баланса на генерации"""
     user_id = callback.from_user.id
     balance = await db.get_referral_balance(user_id)
-    exchange_rate = int(await db.get_setting('referral_exchange_rate') or '29')
+    exchange_rate = db.setting_int('referral_exchange_rate')
     max_tokens = balance // exchange_rate
 
     if balance < exchange_rate:
@@ -100,7 +100,7 @@ async def process_exchange_amount(message: Message, state: FSMContext):
         pass
 
     balance = await db.get_referral_balance(user_id)
-    exchange_rate = int(await db.get_setting('referral_exchange_rate') or '29')
+    exchange_rate = db.setting_int('referral_exchange_rate')
     max_tokens = balance // exchange_rate
 
     if message.text == "/all":
@@ -128,7 +128,7 @@ async def process_exchange_amount(message: Message, state: FSMContext):
 
     # Выполняем обмен
     await db.decrease_referral_balance(user_id, cost)
-    await db.add_tokens(user_id, tokens)
+    await db.add_tokens(user_id, tokens, reason='referral_exchange')
     await db.log_referral_exchange(user_id, cost, tokens, exchange_rate)
 
     new_balance = await db.get_balance(user_id)
@@ -170,7 +170,7 @@ async def request_payout(callback: CallbackQuery, state: FSMContext):
     """Запрос на выплату"""
     user_id = callback.from_user.id
     balance = await db.get_referral_balance(user_id)
-    min_payout = int(await db.get_setting('referral_min_payout') or '500')
+    min_payout = db.setting_int('referral_min_payout')
 
     if balance < min_payout:
         await callback.answer(
@@ -210,7 +210,7 @@ async def process_payout_amount(message: Message, state: FSMContext):
         pass
 
     balance = await db.get_referral_balance(user_id)
-    min_payout = int(await db.get_setting('referral_min_payout') or '500')
+    min_payout = db.setting_int('referral_min_payout')
 
     if message.text == "/all":
         amount = balance
@@ -4,6 +4,7 @@
 # [2025-11-23 19:00 MSK] Реализована система единого меню
 # [2025-12-03] Добавлена обработка реферальных ссылок и обновлен профиль
 # [2025-12-03 19:46] Добавлено отображение баланса в cmd_start
+# [2025-12-08] Процент комиссии берется из снимка настроек db
 
 import logging
 from aiogram import Router, F
@@ -272,7 +273,7 @@ async def show_referral_program(callback: CallbackQuery, state: FSMContext):
     referral_total_paid = user_data.get('referral_total_paid', 0) or 0
 
     # Получаем процент комиссии из настроек
-    commission_percent = await db.get_setting('referral_commission_percent') or '10'
+    commission_percent = db.setting_int('referral_commission_percent')
 
     # Формируем реферальную ссылку
     bot_username = config.BOT_USERNAME.replace('@', '')
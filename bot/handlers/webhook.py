@@ -27,6 +27,6 @@ async def yookassa_webhook(request: Request):
         await db.update_payment_status(payment_id, 'succeeded')
 
         # Добавляем токены юзеру
-        await db.add_tokens(user_id, tokens)
+        await db.add_tokens(user_id, tokens, reason='payment', ref_id=payment_id)
 
     return {"status": "ok"}
@@ -1,6 +1,8 @@
 # bot/keyboards/admin_kb.py
 # --- ОБНОВЛЕН: 2025-12-06 20:13 - Добавлены настройки с builder.adjust(2), убраны лишние проверки ---
 # Клавиатуры для админ-панели
+# [2025-12-08] Пагинация списка пользователей по курсору (created_at, user_id) в callback_data
+# [2025-12-08] Клавиатура результатов поиска пользователей
 
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -56,24 +58,39 @@ def get_back_to_settings():
     return builder.as_markup()
 
 
-def get_users_list_keyboard(current_page: int, total_pages: int) -> InlineKeyboardMarkup:
-    """Клавиатура списка пользователей с пагинацией"""
+def users_cursor(user: dict) -> str:
+    """
+    Курсор страницы пользователей для callback_data — user_id крайней строки
+    (created_at по нему берется из БД как есть, без разбора формата).
+    """
+    return str(user['user_id'])
+
+
+def get_users_list_keyboard(current_page: int, total_pages: int, first_user: dict, last_user: dict,
+                            has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    """Клавиатура списка пользователей с пагинацией (курсор — крайняя строка текущей страницы)"""
     buttons = []
 
     # Кнопки пагинации
     nav_buttons = []
-    if current_page > 1:
+    if has_prev:
         nav_buttons.append(
-            InlineKeyboardButton(text="⬅️", callback_data=f"admin_users_page_{current_page - 1}")
+            InlineKeyboardButton(
+                text="⬅️",
+                callback_data=f"admin_users_prev_{current_page - 1}_{users_cursor(first_user)}"
+            )
         )
 
     nav_buttons.append(
         InlineKeyboardButton(text=f"{current_page}/{total_pages}", callback_data="noop")
     )
 
-    if current_page < total_pages:
+    if has_next:
         nav_buttons.append(
-            InlineKeyboardButton(text="➡️", callback_data=f"admin_users_page_{current_page + 1}")
+            InlineKeyboardButton(
+                text="➡️",
+                callback_data=f"admin_users_next_{current_page + 1}_{users_cursor(last_user)}"
+            )
         )
 
     buttons.append(nav_buttons)
@@ -83,6 +100,33 @@ def get_users_list_keyboard(current_page: int, total_pages: int) -> InlineKeyboa
     return keyboard
 
 
+def get_search_results_keyboard(users: list[dict], current_page: int, has_prev: bool,
+                                has_next: bool) -> InlineKeyboardMarkup:
+    """Результаты поиска: кнопка на каждого пользователя + пагинация"""
+    buttons = []
+    for user in users:
+        username = (user['username'] or "").lstrip('@')
+        text = f"{user['user_id']} @{username}" if username else str(user['user_id'])
+        buttons.append([InlineKeyboardButton(text=text, callback_data=f"admin_user_{user['user_id']}")])
+
+    nav_buttons = []
+    if has_prev:
+        nav_buttons.append(
+            InlineKeyboardButton(text="⬅️", callback_data=f"admin_search_page_{current_page - 1}")
+        )
+    if has_next:
+        nav_buttons.append(
+            InlineKeyboardButton(text="➡️", callback_data=f"admin_search_page_{current_page + 1}")
+        )
+    if nav_buttons:
+        buttons.append(nav_buttons)
+    buttons.append([InlineKeyboardButton(text="🔍 Новый поиск", callback_data="admin_find_user")])
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад ", callback_data="admin_main")])
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    return keyboard
+
+
 def get_user_card_keyboard(user_id: int) -> InlineKeyboardMarkup:
     """Клавиатура карточки пользователя"""
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -114,6 +114,8 @@ def get_clear_space_confirm_keyboard() -> InlineKeyboardMarkup:
 
 def get_style_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
+    # Превью-сетка: несколько стилей одним пакетом
+    builder.row(InlineKeyboardButton(text="🖼 Сразу несколько стилей", callback_data="preview_grid"))
     # 16 стилей — 2 в ряд
     style_rows = [STYLE_TYPES[i:i+2] for i in range(0, len(STYLE_TYPES), 2)]
     for row in style_rows:
@@ -149,8 +151,20 @@ def get_payment_check_keyboard(url: str) -> InlineKeyboardMarkup:
 def get_post_generation_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="🔄 Другой стиль для этого фото", callback_data="change_style"))
+    builder.row(InlineKeyboardButton(text="🖼 Сразу несколько стилей", callback_data="preview_grid"))
     builder.row(InlineKeyboardButton(text="📸 Загрузить новое фото", callback_data="create_design"))
     builder.row(InlineKeyboardButton(text="👤 Перейти в профиль", callback_data="show_profile"))
     builder.row(InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu"))
     builder.adjust(1)
     return builder.as_markup()
+
+
+def get_preview_grid_keyboard() -> InlineKeyboardMarkup:
+    """Клавиатура после превью-сетки стилей"""
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text="🖼 Следующие стили", callback_data="preview_grid"))
+    builder.row(InlineKeyboardButton(text="🎨 Выбрать один стиль", callback_data="change_style"))
+    builder.row(InlineKeyboardButton(text="📸 Загрузить новое фото", callback_data="create_design"))
+    builder.row(InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu"))
+    builder.adjust(1)
+    return builder.as_markup()
@@ -1,10 +1,23 @@
 # --- ИСПРАВЛЕНИЯ ВЕРСИИ: bot/main.py ---
 # [2025-11-22 11:35 CET] Исправление: Уровень логирования изменен на DEBUG для детальной отладки срабатывания хэндлеров.
 # [2025-12-03] Добавлен роутер referral для реферальной системы
+# [2025-12-08] Используем общий экземпляр db (пул соединений), закрываем его при остановке
+# [2025-12-08] Профиль SQLite (WAL, synchronous, mmap/cache, busy_timeout) берется из config
+# [2025-12-08] Закрываем HTTP-сессию асинхронного клиента Replicate
+# [2025-12-08] Запуск/остановка очереди генераций generation_scheduler
+# [2025-12-08] Сервер вебхуков Replicate (если задан REPLICATE_WEBHOOK_URL)
+# [2025-12-08] Параметры кэша результатов генерации
+# [2025-12-08] Персистентное хранилище FSM (SQLite/Redis) вместо MemoryStorage
+# [2025-12-08] FSMBufferMiddleware: одно чтение и одна запись FSM на апдейт
+# [2025-12-08] Фоновая сверка балансов с журналом balance_ledger
+# [2025-12-08] Параметры кэша фото пользователей (image-to-image)
+# [2025-12-08] Провайдеры генерации и параметры роутера (фоллбэк, хеджирование)
+# [2025-12-08] Сервер вебхуков Replicate — только с REPLICATE_WEBHOOK_SECRET, иначе опрос
 # ----
 
 import asyncio
 import logging
+from functools import partial
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
@@ -12,8 +25,17 @@ from aiogram.enums import ParseMode
 from config import ADMIN_IDS
 # Импорты конфигурации (на уровне проекта)
 from config import config
-from database.db import Database
+from database.db import db, StorageProfile
+from database.fsm_storage import create_fsm_storage
+from middlewares.fsm_buffer import FSMBufferMiddleware
 from handlers import user_start, creation, payment, referral
+from services.replicate_api import replicate_client
+from services.generation_queue import generation_scheduler
+from services.replicate_webhook import start_webhook_server
+from services.result_cache import result_cache
+from services.photo_cache import photo_cache
+from services.providers import create_providers, generation_router
+from services.balance_verifier import balance_verifier, notify_admins_about_drift
 
 # Configure logging
 logging.basicConfig(
@@ -23,8 +45,48 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Инициализируем базу данных (теперь это класс, а не объект)
-db = Database(db_path=config.DB_PATH)
+# Общий экземпляр БД: тот же, что импортируют хэндлеры (один пул соединений на процесс)
+db.db_path = config.DB_PATH
+db.readers = config.DB_READERS
+db.balance_cache_ttl = config.BALANCE_CACHE_TTL
+db.activity_flush_interval = config.ACTIVITY_FLUSH_INTERVAL
+db.activity_batch_size = config.ACTIVITY_BATCH_SIZE
+db.analytics_sync = config.ANALYTICS_SYNC
+db.dashboard_cache_ttl = config.DASHBOARD_CACHE_TTL
+db.profile = StorageProfile(
+    journal_mode=config.SQLITE_JOURNAL_MODE,
+    synchronous=config.SQLITE_SYNCHRONOUS,
+    mmap_size=config.SQLITE_MMAP_SIZE,
+    cache_size=config.SQLITE_CACHE_SIZE,
+    busy_timeout=config.SQLITE_BUSY_TIMEOUT,
+)
+
+# Кэш результатов генерации
+result_cache.ttl = config.RESULT_CACHE_TTL
+result_cache.max_entries = config.RESULT_CACHE_MEMORY_ENTRIES
+result_cache.disk_dir = config.RESULT_CACHE_DIR
+result_cache.disk_max_entries = config.RESULT_CACHE_DISK_ENTRIES
+
+# Кэш фото пользователей
+photo_cache.memory_bytes = config.PHOTO_CACHE_MEMORY_MB * 1024 * 1024
+photo_cache.disk_dir = config.PHOTO_CACHE_DIR
+photo_cache.disk_max_bytes = config.PHOTO_CACHE_DISK_MB * 1024 * 1024
+
+# Провайдеры генерации
+generation_router.providers = create_providers(
+    config.GENERATION_PROVIDERS,
+    http_url=config.HTTP_PROVIDER_URL,
+    http_token=config.HTTP_PROVIDER_TOKEN,
+    http_model=config.HTTP_PROVIDER_MODEL,
+    http_cost=config.HTTP_PROVIDER_COST,
+    local_model=config.LOCAL_DIFFUSERS_MODEL,
+    local_dir=config.LOCAL_RENDER_DIR,
+)
+generation_router.hedge = config.GENERATION_HEDGE
+generation_router.hedge_min_samples = config.GENERATION_HEDGE_MIN_SAMPLES
+generation_router.slow_timeout = config.GENERATION_SLOW_TIMEOUT
+generation_router.failure_threshold = config.PROVIDER_FAILURE_THRESHOLD
+generation_router.cooldown = config.PROVIDER_COOLDOWN
 
 # Initialize bot
 bot = Bot(
@@ -39,8 +101,42 @@ async def main():
     await db.init_db()
     logger.info("База данных инициализирована")
 
+    # Очередь генераций (восстанавливает незавершенные задачи после перезапуска)
+    generation_scheduler.workers = config.GENERATION_WORKERS
+    generation_scheduler.per_user_limit = config.GENERATION_PER_USER_LIMIT
+    generation_scheduler.max_queue = config.GENERATION_MAX_QUEUE
+    generation_scheduler.max_in_flight = config.GENERATION_MAX_IN_FLIGHT
+    # Сверка users.balance с журналом проводок
+    balance_verifier.interval = config.BALANCE_VERIFY_INTERVAL
+    balance_verifier.batch_size = config.BALANCE_VERIFY_BATCH
+    await balance_verifier.start(on_drift=partial(notify_admins_about_drift, bot))
+
+    # Вебхуки Replicate поднимаем до очереди: восстановленные задачи сразу ждут завершения
+    webhook_runner = None
+    if config.REPLICATE_WEBHOOK_URL and not config.REPLICATE_WEBHOOK_SECRET:
+        # Без секрета подпись не проверить: кто угодно подменил бы результат предсказания
+        logger.error("REPLICATE_WEBHOOK_URL задан без REPLICATE_WEBHOOK_SECRET — вебхуки выключены, ждем опросом")
+        replicate_client.webhook_url = None
+    elif config.REPLICATE_WEBHOOK_URL:
+        webhook_runner = await start_webhook_server(
+            config.REPLICATE_WEBHOOK_HOST,
+            config.REPLICATE_WEBHOOK_PORT,
+            config.REPLICATE_WEBHOOK_PATH,
+            config.REPLICATE_WEBHOOK_SECRET,
+        )
+
+    await generation_scheduler.start(
+        bot=bot,
+        on_recovered=partial(creation.deliver_recovered_job, bot)
+    )
+
     # Initialize dispatcher
-    dp = Dispatcher()
+    # FSM хранится вне памяти процесса: меню и выбранное фото переживают перезапуск
+    dp = Dispatcher(storage=create_fsm_storage(
+        config.FSM_STORAGE, db, redis_url=config.REDIS_URL, flush_interval=config.FSM_FLUSH_INTERVAL
+    ))
+    # Регистрируется после встроенного FSMContextMiddleware и работает внутри него
+    dp.update.outer_middleware(FSMBufferMiddleware())
 
     # Register routers (Регистрируем роутеры)
     dp.include_routers(
@@ -64,7 +160,15 @@ async def main():
         # Start polling
         await dp.start_polling(bot)
     finally:
+        await generation_scheduler.stop()
+        await balance_verifier.stop()
+        if webhook_runner:
+            await webhook_runner.cleanup()
+        await dp.storage.close()
         await bot.session.close()
+        await generation_router.close()
+        await replicate_client.close()
+        await db.close()
 
 
 if __name__ == "__main__":
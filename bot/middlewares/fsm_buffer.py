@@ -0,0 +1,115 @@
+# bot/middlewares/fsm_buffer.py
+# --- СОЗДАН: 2025-12-08 - Буферизация FSM на время одного апдейта ---
+"""
+Хэндлеры вызывают state.get_data()/update_data() по нескольку раз за апдейт
+(photo_uploaded, show_single_menu, show_main_menu). С персистентным хранилищем
+каждый такой вызов — обращение к хранилищу.
+
+FSMBufferMiddleware подменяет FSMContext на BufferedFSMContext:
+- состояние берется из raw_state, который уже прочитал FSMContextMiddleware;
+- данные читаются из хранилища один раз, дальше хэндлер работает с локальной копией;
+- в конце апдейта изменения записываются одним вызовом.
+
+Записываются только измененные ключи (update_data), поэтому параллельные апдейты
+того же пользователя не затирают данные друг друга. Перед долгим ожиданием
+(например, генерацией) хэндлер может сбросить буфер сам: await state.flush().
+"""
+
+import logging
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType
+from aiogram.types import TelegramObject
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedFSMContext(FSMContext):
+    def __init__(self, context: FSMContext, raw_state: Optional[str]):
+        super().__init__(context.storage, context.key)
+        self._state = raw_state
+        self._state_changed = False
+        self._data: Optional[Dict[str, Any]] = None
+        self._changed: Dict[str, Any] = {}
+        self._replaced = False
+
+    async def _load(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = await self.storage.get_data(key=self.key)
+        return self._data
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_changed = True
+
+    async def get_state(self) -> Optional[str]:
+        return self._state
+
+    async def set_data(self, data: Mapping[str, Any]) -> None:
+        self._data = dict(data)
+        self._replaced = True
+        self._changed.clear()
+
+    async def get_data(self) -> Dict[str, Any]:
+        return (await self._load()).copy()
+
+    async def get_value(self, key: str, default: Any = None) -> Any:
+        return (await self._load()).get(key, default)
+
+    async def update_data(self, data: Optional[Mapping[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        current = await self._load()
+        current.update(kwargs)
+        if not self._replaced:
+            self._changed.update(kwargs)
+        return current.copy()
+
+    async def flush(self) -> None:
+        """Записать накопленные изменения в хранилище"""
+        if self._state_changed:
+            await self.storage.set_state(key=self.key, state=self._state)
+            self._state_changed = False
+
+        if self._replaced:
+            await self.storage.set_data(key=self.key, data=self._data)
+            self._replaced = False
+        elif self._changed:
+            await self.storage.update_data(key=self.key, data=self._changed)
+        self._changed = {}
+
+
+class FSMBufferMiddleware(BaseMiddleware):
+    """
+    Регистрируется как outer-middleware апдейтов после создания Dispatcher,
+    т.е. выполняется внутри встроенного FSMContextMiddleware.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = data.get("state")
+        if context is None:
+            return await handler(event, data)
+
+        buffered = BufferedFSMContext(context, data.get("raw_state"))
+        data["state"] = buffered
+        try:
+            return await handler(event, data)
+        finally:
+            try:
+                await buffered.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи FSM: {e}")
+
+
+async def flush_state(state: FSMContext) -> None:
+    """Сбросить буфер FSM, если контекст буферизован (иначе ничего не делает)"""
+    if isinstance(state, BufferedFSMContext):
+        await state.flush()
@@ -0,0 +1,91 @@
+# bot/services/balance_verifier.py
+# --- СОЗДАН: 2025-12-08 - Фоновая сверка users.balance с журналом balance_ledger ---
+"""
+users.balance — материализованная сумма проводок balance_ledger, обе записи делаются
+в одной транзакции. Сверка периодически пересчитывает балансы пачками (чтобы не держать
+читателя и не грузить БД одним большим запросом) и сообщает о расхождениях.
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from database.db import db
+
+logger = logging.getLogger(__name__)
+
+
+class BalanceVerifier:
+    def __init__(self, interval: float = 3600, batch_size: int = 500, batch_pause: float = 0.05):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.last_report: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+        self._on_drift: Optional[Callable[[List[Dict[str, int]]], Awaitable[None]]] = None
+
+    async def start(self, on_drift: Optional[Callable[[List[Dict[str, int]]], Awaitable[None]]] = None):
+        self._on_drift = on_drift
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка сверки балансов: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> List[Dict[str, int]]:
+        """Полный проход по пользователям. Возвращает найденные расхождения."""
+        checked = 0
+        drifts: List[Dict[str, int]] = []
+        after_user_id = 0
+        while True:
+            batch_drifts, last_user_id, batch_checked = await db.verify_balances(after_user_id, self.batch_size)
+            if last_user_id is None:
+                break
+            drifts.extend(batch_drifts)
+            checked += batch_checked
+            after_user_id = last_user_id
+            await asyncio.sleep(self.batch_pause)
+
+        self.last_report = {
+            'finished_at': datetime.now(),
+            'checked': checked,
+            'drift': len(drifts),
+        }
+        if drifts:
+            logger.warning(f"Расхождение баланса и журнала у {len(drifts)} пользователей: {drifts[:10]}")
+            if self._on_drift:
+                await self._on_drift(drifts)
+        else:
+            logger.info("Сверка балансов: расхождений нет")
+        return drifts
+
+
+async def notify_admins_about_drift(bot, drifts: List[Dict[str, int]]):
+    """Сообщить админам (notify_critical_errors) о расхождениях"""
+    lines = [
+        f"`{d['user_id']}`: баланс {d['balance']}, по журналу {d['ledger_balance']}"
+        for d in drifts[:20]
+    ]
+    text = f"⚠️ Расхождение баланса и журнала у {len(drifts)} пользователей:\n" + "\n".join(lines)
+    for admin_id in await db.get_admins_for_notification("notify_critical_errors"):
+        try:
+            await bot.send_message(admin_id, text, parse_mode="Markdown")
+        except Exception as e:
+            logger.debug(f"Не удалось уведомить админа {admin_id}: {e}")
+
+
+# Создаем глобальный экземпляр (параметры выставляются в main.py)
+balance_verifier = BalanceVerifier()
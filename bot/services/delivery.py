@@ -0,0 +1,176 @@
+# bot/services/delivery.py
+# --- СОЗДАН: 2025-12-08 - Доставка результатов с повторным использованием Telegram file_id ---
+# [2025-12-08] send_media_group: несколько результатов (превью-сетка) одним альбомом
+# [2025-12-08] edit_photo: замена черновика финальным результатом в том же сообщении
+# [2025-12-08] Результаты локального провайдера (file://) отправляются из файла
+"""
+Доставка изображений-результатов пользователю.
+
+Первая отправка результата идет через URLInputFile: aiogram читает файл с Replicate
+потоком (кусками по chunk_size) и сразу передает в Telegram, не держа картинку в памяти целиком.
+Telegram возвращает file_id — он запоминается (url -> file_id), и все повторные отправки
+того же результата (попадания в кэш, пересылка, восстановленные задачи) идут по file_id:
+без скачивания с Replicate и без повторной загрузки в Telegram.
+"""
+
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputFile, InputMediaPhoto, Message, URLInputFile
+
+logger = logging.getLogger(__name__)
+
+# Размер куска при потоковой загрузке результата в Telegram
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def result_input_file(url: str) -> InputFile:
+    """Файл результата для Telegram: локальный (file://, локальный провайдер) или потоком по URL"""
+    if url.startswith("file://"):
+        return FSInputFile(url2pathname(urlparse(url).path))
+    return URLInputFile(url, chunk_size=UPLOAD_CHUNK_SIZE)
+
+
+class ResultDelivery:
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max_entries
+        # url -> file_id
+        self._file_ids: "OrderedDict[str, str]" = OrderedDict()
+        self._metrics = {'uploads': 0, 'reused': 0, 'stale': 0}
+
+    def file_id_for(self, url: str) -> Optional[str]:
+        file_id = self._file_ids.get(url)
+        if file_id:
+            self._file_ids.move_to_end(url)
+        return file_id
+
+    def remember(self, url: str, file_id: str):
+        self._file_ids[url] = file_id
+        self._file_ids.move_to_end(url)
+        while len(self._file_ids) > self.max_entries:
+            self._file_ids.popitem(last=False)
+
+    async def send_photo(self, bot: Bot, chat_id: int, url: str, file_id: Optional[str] = None,
+                         **kwargs: Any) -> Message:
+        """
+        Отправить результат: по file_id, если он уже известен (явно или по url),
+        иначе потоковой загрузкой по url. kwargs — caption, parse_mode, reply_markup.
+        """
+        file_id = file_id or self.file_id_for(url)
+        if file_id:
+            try:
+                message = await bot.send_photo(chat_id, photo=file_id, **kwargs)
+                self._metrics['reused'] += 1
+                return message
+            except TelegramBadRequest as e:
+                # file_id от другого бота или устарел — загрузим заново
+                logger.debug(f"file_id недействителен, загружаем заново: {e}")
+                self._file_ids.pop(url, None)
+                self._metrics['stale'] += 1
+
+        message = await bot.send_photo(
+            chat_id,
+            photo=result_input_file(url),
+            **kwargs
+        )
+        self._metrics['uploads'] += 1
+        if message.photo:
+            self.remember(url, message.photo[-1].file_id)
+        return message
+
+    async def edit_photo(self, bot: Bot, chat_id: int, message_id: int, url: str,
+                         file_id: Optional[str] = None, caption: Optional[str] = None,
+                         parse_mode: Optional[str] = None) -> Optional[Message]:
+        """
+        Заменить фото в уже отправленном сообщении (черновик -> финальный результат).
+        Источник фото — как в send_photo: file_id, если известен, иначе потоковая загрузка по url.
+        """
+        file_id = file_id or self.file_id_for(url)
+        if file_id:
+            try:
+                message = await bot.edit_message_media(
+                    media=InputMediaPhoto(media=file_id, caption=caption, parse_mode=parse_mode),
+                    chat_id=chat_id,
+                    message_id=message_id
+                )
+                self._metrics['reused'] += 1
+                return message if isinstance(message, Message) else None
+            except TelegramBadRequest as e:
+                logger.debug(f"file_id недействителен, загружаем заново: {e}")
+                self._file_ids.pop(url, None)
+                self._metrics['stale'] += 1
+
+        message = await bot.edit_message_media(
+            media=InputMediaPhoto(
+                media=result_input_file(url),
+                caption=caption,
+                parse_mode=parse_mode
+            ),
+            chat_id=chat_id,
+            message_id=message_id
+        )
+        self._metrics['uploads'] += 1
+        if not isinstance(message, Message):
+            return None
+        if message.photo:
+            self.remember(url, message.photo[-1].file_id)
+        return message
+
+    async def send_media_group(self, bot: Bot, chat_id: int,
+                               items: List[Tuple[str, Optional[str], str]],
+                               parse_mode: Optional[str] = None) -> List[Message]:
+        """
+        Отправить несколько результатов одним альбомом. items — (url, file_id, подпись).
+        Альбом Telegram — от 2 до 10 фото; один результат отправляется обычным фото.
+        Возвращает сообщения в порядке items.
+        """
+        if len(items) == 1:
+            url, file_id, caption = items[0]
+            return [await self.send_photo(bot, chat_id, url, file_id=file_id,
+                                          caption=caption, parse_mode=parse_mode)]
+
+        def media(use_file_ids: bool) -> List[InputMediaPhoto]:
+            group = []
+            for url, file_id, caption in items:
+                file_id = (file_id or self.file_id_for(url)) if use_file_ids else None
+                group.append(InputMediaPhoto(
+                    media=file_id or result_input_file(url),
+                    caption=caption,
+                    parse_mode=parse_mode
+                ))
+            return group
+
+        reused = sum(1 for url, file_id, _ in items if file_id or self.file_id_for(url))
+        try:
+            messages = await bot.send_media_group(chat_id, media=media(use_file_ids=True))
+        except TelegramBadRequest as e:
+            # Какой-то file_id недействителен — загрузим весь альбом заново
+            logger.debug(f"file_id в альбоме недействителен, загружаем заново: {e}")
+            self._metrics['stale'] += 1
+            reused = 0
+            messages = await bot.send_media_group(chat_id, media=media(use_file_ids=False))
+
+        for (url, _, _), message in zip(items, messages):
+            file_id = sent_file_id(message)
+            if file_id:
+                self.remember(url, file_id)
+        self._metrics['reused'] += reused
+        self._metrics['uploads'] += len(items) - reused
+        return messages
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._metrics, 'known_file_ids': len(self._file_ids)}
+
+
+def sent_file_id(message: Message) -> Optional[str]:
+    """file_id самой большой версии фото в отправленном сообщении"""
+    return message.photo[-1].file_id if message and message.photo else None
+
+
+# Создаем глобальный экземпляр
+result_delivery = ResultDelivery()
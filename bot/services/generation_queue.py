@@ -0,0 +1,491 @@
+# bot/services/generation_queue.py
+# --- СОЗДАН: 2025-12-08 - Очередь генераций: пул воркеров, лимит на пользователя, приоритет админов ---
+# [2025-12-08] Воркер только создает предсказание; ожидание рендера — отдельной задачей (max_in_flight)
+# [2025-12-08] Задача хранит модель, стоимость и время рендера (для generations)
+# [2025-12-08] Воркерам передается Bot: фото пользователя скачивается для image-to-image
+# [2025-12-08] Задача хранит photo_unique_id — ключ кэша фото
+# [2025-12-08] Пакетная задача design_grid: несколько стилей одного фото одним запуском
+# [2025-12-08] Двухфазный рендер: черновик (preview_future) параллельно с финальным, задержки фаз — render_latency
+# [2025-12-08] Рендер через generation_router: выбор провайдера, фоллбэк, хеджирование
+# [2025-12-08] future задачи всегда завершается: None при ошибке завершения, отмена при остановке
+# [2025-12-08] design_grid: модель результата по стилям (style_model_ids) — для ключа кэша результатов
+"""
+Планировщик генераций.
+
+Хэндлер не вызывает модель сам, а ставит задачу в очередь и ждет ее future.
+- Ограниченное число воркеров = ограниченное число одновременных запусков предсказаний.
+  Воркер освобождается сразу после создания предсказания, а ожидание рендера
+  (вебхук или опрос) идет отдельной задачей. Число предсказаний в рендере
+  ограничено max_in_flight.
+- Не больше per_user_limit задач одного пользователя выполняются одновременно,
+  пользователи внутри полосы обслуживаются по кругу (round-robin).
+- Две полосы: админы (ADMIN_IDS) обслуживаются раньше обычных пользователей.
+- Задачи хранятся в таблице generation_jobs: после перезапуска незавершенные
+  задачи снова ставятся в очередь, а результат доставляется через on_recovered.
+  Если предсказание уже было создано (prediction_id), оно не создается повторно.
+- Пакетная задача design_grid (превью-сетка) — несколько стилей одной комнаты:
+  style_type хранит стили через запятую, prediction_id — id предсказаний через запятую,
+  результат future — список URL по порядку стилей. Пакет идет в очереди как одна задача
+  (один слот воркера и рендера), поэтому стили рендерятся параллельно даже при per_user_limit=1.
+- Двухфазный рендер (fast_preview у задачи design): вместе с финальным предсказанием
+  создается быстрый черновик. Его URL приходит в job.preview_future (None — черновик
+  не удался или не успел раньше финального). Задержки обеих фаз пишутся в render_latency.
+  Черновик живет только в памяти: восстановленная после перезапуска задача ждет только финальный рендер.
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from aiogram import Bot
+
+from database.db import db
+from services.latency import render_latency
+from services.providers import RenderAttempt, RenderRequest, generation_router
+from services.replicate_api import clear_space_prompt, get_prompt
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_ADMIN = 0
+PRIORITY_USER = 1
+
+# Пакет стилей одного фото (превью-сетка)
+OPERATION_GRID = 'design_grid'
+
+
+class GenerationQueueFull(Exception):
+    """Очередь генераций заполнена — новая задача не принята"""
+
+
+@dataclass
+class GenerationJob:
+    """Задача генерации (строка generation_jobs + рантайм-поля)"""
+    id: int
+    user_id: int
+    chat_id: int
+    operation_type: str
+    photo_id: str
+    photo_unique_id: Optional[str] = None
+    room_type: Optional[str] = None
+    style_type: Optional[str] = None
+    priority: int = PRIORITY_USER
+    prediction_id: Optional[str] = None
+    seq: int = 0
+    started: bool = False
+    # Для аналитики: модель и стоимость рендера (None/0 у заглушки), моменты старта и завершения
+    model_id: Optional[str] = None
+    cost: float = 0.0
+    # design_grid: модель, давшая результат, по стилям пакета (None — стиль не получился)
+    style_model_ids: List[Optional[str]] = field(default_factory=list)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # Двухфазный рендер: черновик до финального результата (URL черновика — в preview_future)
+    fast_preview: bool = False
+    preview_at: Optional[float] = None
+    preview_future: Optional[asyncio.Future] = None
+    # Результат (URL или None; у design_grid — список URL); у восстановленных после перезапуска задач future нет
+    future: Optional[asyncio.Future] = None
+    # Вызывается, когда воркер взял задачу (например, чтобы обновить сообщение о прогрессе)
+    on_start: Optional[Callable[[], Awaitable[None]]] = field(default=None, repr=False)
+
+    @property
+    def duration_ms(self) -> Optional[int]:
+        """Время от взятия задачи воркером до результата, мс"""
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return int((self.finished_at - self.started_at) * 1000)
+
+    @property
+    def preview_ms(self) -> Optional[int]:
+        """Время от взятия задачи воркером до черновика, мс"""
+        if self.started_at is None or self.preview_at is None:
+            return None
+        return int((self.preview_at - self.started_at) * 1000)
+
+    @property
+    def styles(self) -> List[str]:
+        """Стили задачи (у design_grid — несколько)"""
+        return self.style_type.split(',') if self.style_type else []
+
+
+class GenerationScheduler:
+    def __init__(self, workers: int = 4, per_user_limit: int = 1, max_queue: int = 100,
+                 max_in_flight: int = 16):
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.per_user_limit = per_user_limit
+        self.max_queue = max_queue
+
+        # Полосы по приоритету: {priority: OrderedDict[user_id, deque[GenerationJob]]}
+        self._lanes: Dict[int, "OrderedDict[int, Deque[GenerationJob]]"] = {
+            PRIORITY_ADMIN: OrderedDict(),
+            PRIORITY_USER: OrderedDict(),
+        }
+        self._running: Dict[int, int] = {}
+        self._queued = 0
+        self._seq = itertools.count()
+        self._cond: Optional[asyncio.Condition] = None
+        self._tasks: List[asyncio.Task] = []
+        self._in_flight: Set[asyncio.Task] = set()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._bot: Optional[Bot] = None
+        self._on_recovered: Optional[Callable[[GenerationJob, Optional[str]], Awaitable[None]]] = None
+
+    # ===== ЗАПУСК / ОСТАНОВКА =====
+
+    async def start(self, bot: Bot,
+                    on_recovered: Optional[Callable[[GenerationJob, Optional[str]], Awaitable[None]]] = None):
+        """Поднять воркеры и вернуть в очередь задачи, не завершенные до перезапуска"""
+        self._bot = bot
+        self._on_recovered = on_recovered
+        self._cond = asyncio.Condition()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+
+        recovered = await db.get_unfinished_generation_jobs()
+        async with self._cond:
+            for row in recovered:
+                self._enqueue(GenerationJob(
+                    id=row['id'],
+                    user_id=row['user_id'],
+                    chat_id=row['chat_id'],
+                    operation_type=row['operation_type'],
+                    photo_id=row['photo_id'],
+                    photo_unique_id=row.get('photo_unique_id'),
+                    room_type=row['room_type'],
+                    style_type=row['style_type'],
+                    priority=row['priority'],
+                    prediction_id=row.get('prediction_id'),
+                ))
+        if recovered:
+            logger.info(f"Восстановлено задач генерации после перезапуска: {len(recovered)}")
+
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Очередь генераций запущена: воркеров={self.workers}, "
+                    f"в рендере до {self.max_in_flight}, "
+                    f"лимит на пользователя={self.per_user_limit}, размер={self.max_queue}")
+
+    async def stop(self):
+        """
+        Остановить воркеры. Невыполненные задачи остаются в БД и будут восстановлены,
+        а их future отменяются: хэндлеры не ждут вечно (результат после перезапуска — через on_recovered).
+        """
+        tasks = self._tasks + list(self._in_flight)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._in_flight.clear()
+        # Задачи, которые так и не взял воркер
+        for lane in self._lanes.values():
+            for jobs in lane.values():
+                for job in jobs:
+                    self._cancel_futures(job)
+
+    # ===== ПОСТАНОВКА В ОЧЕРЕДЬ =====
+
+    async def submit(self, user_id: int, chat_id: int, operation_type: str, photo_id: str,
+                     room_type: Optional[str] = None, style_type: Optional[str] = None,
+                     is_admin: bool = False, photo_unique_id: Optional[str] = None,
+                     fast_preview: bool = False,
+                     on_start: Optional[Callable[[], Awaitable[None]]] = None) -> GenerationJob:
+        """
+        Поставить задачу в очередь. Результат — await job.future (URL или None).
+        fast_preview (только design) — сначала быстрый черновик в job.preview_future.
+        Бросает GenerationQueueFull, если очередь заполнена.
+        """
+        if self._queued >= self.max_queue:
+            raise GenerationQueueFull()
+
+        priority = PRIORITY_ADMIN if is_admin else PRIORITY_USER
+        fast_preview = fast_preview and operation_type == 'design'
+        job_id = await db.create_generation_job(
+            user_id, chat_id, operation_type, photo_id, room_type, style_type, priority, photo_unique_id
+        )
+        job = GenerationJob(
+            id=job_id,
+            user_id=user_id,
+            chat_id=chat_id,
+            operation_type=operation_type,
+            photo_id=photo_id,
+            photo_unique_id=photo_unique_id,
+            room_type=room_type,
+            style_type=style_type,
+            priority=priority,
+            future=asyncio.get_running_loop().create_future(),
+            fast_preview=fast_preview,
+            preview_future=asyncio.get_running_loop().create_future() if fast_preview else None,
+            on_start=on_start,
+        )
+        async with self._cond:
+            self._enqueue(job)
+        return job
+
+    def _enqueue(self, job: GenerationJob):
+        """Добавить задачу в свою полосу (вызывается под self._cond)"""
+        job.seq = next(self._seq)
+        self._lanes[job.priority].setdefault(job.user_id, deque()).append(job)
+        self._queued += 1
+        self._cond.notify()
+
+    def position(self, job: GenerationJob) -> int:
+        """
+        Примерная позиция в очереди (0 — задача уже выполняется или будет взята первой).
+        Считаем задачи более приоритетных полос и задачи своей полосы, поставленные раньше.
+        """
+        ahead = 0
+        for priority, lane in self._lanes.items():
+            for jobs in lane.values():
+                for queued in jobs:
+                    if queued is job:
+                        continue
+                    if priority < job.priority or (priority == job.priority and queued.seq < job.seq):
+                        ahead += 1
+        return ahead
+
+    def stats(self) -> Dict[str, int]:
+        """Состояние очереди для админки"""
+        return {
+            'queued': self._queued,
+            'running': sum(self._running.values()),
+            'in_flight': len(self._in_flight),
+            'workers': self.workers,
+        }
+
+    # ===== ВОРКЕРЫ =====
+
+    def _pick(self) -> Optional[GenerationJob]:
+        """
+        Выбрать следующую задачу: сначала полоса админов, внутри полосы —
+        первый по кругу пользователь, у которого не исчерпан лимит одновременных задач.
+        """
+        for priority in sorted(self._lanes):
+            lane = self._lanes[priority]
+            for user_id in list(lane):
+                if self._running.get(user_id, 0) >= self.per_user_limit:
+                    continue
+                jobs = lane.pop(user_id)
+                job = jobs.popleft()
+                if jobs:
+                    # Пользователь уходит в конец круга
+                    lane[user_id] = jobs
+                self._queued -= 1
+                self._running[user_id] = self._running.get(user_id, 0) + 1
+                return job
+        return None
+
+    async def _worker(self, index: int):
+        while True:
+            # Слот рендера занимаем до выбора задачи: пока слотов нет, задачи ждут в очереди
+            await self._slots.acquire()
+            try:
+                async with self._cond:
+                    job = self._pick()
+                    while job is None:
+                        await self._cond.wait()
+                        job = self._pick()
+            except asyncio.CancelledError:
+                self._slots.release()
+                raise
+
+            try:
+                prediction = await self._start(job)
+            except asyncio.CancelledError:
+                self._cancel_futures(job)
+                raise
+            except Exception as e:
+                logger.error(f"Воркер {index}: ошибка запуска задачи {job.id}: {e}")
+                await self._complete(job, error=e)
+                continue
+
+            # Дальше только ожидание рендера — воркер свободен для следующей задачи
+            task = asyncio.create_task(self._complete(job, prediction))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    def _request(self, job: GenerationJob, style: Optional[str] = None, preview: bool = False) -> RenderRequest:
+        """Что рендерить для задачи (style — один стиль пакета design_grid)"""
+        if job.operation_type == 'clear_space':
+            prompt = clear_space_prompt()
+        else:
+            prompt = get_prompt(style or job.style_type, job.room_type)
+        return RenderRequest(prompt, job.photo_id, job.photo_unique_id, preview)
+
+    async def _start(self, job: GenerationJob) -> Dict[str, Any]:
+        """
+        Отметить задачу и запустить рендер (без ожидания результата).
+        Возвращает {"attempt": RenderAttempt, "preview": RenderAttempt | None}
+        или для design_grid — {"batch": [RenderAttempt | None по стилям]}.
+        """
+        job.started = True
+        job.started_at = time.monotonic()
+        await db.start_generation_job(job.id)
+        if job.on_start:
+            try:
+                await job.on_start()
+            except Exception as e:
+                logger.debug(f"on_start задачи {job.id}: {e}")
+
+        if job.prediction_id:
+            # Восстановленная задача: рендер уже оплачен и идет у провайдера — просто дождемся его
+            if job.operation_type == OPERATION_GRID:
+                batch = [
+                    generation_router.resume(prediction_id, self._request(job, style), self._bot)
+                    if prediction_id else None
+                    for style, prediction_id in zip(job.styles, job.prediction_id.split(','))
+                ]
+                self._account(job, [attempt for attempt in batch if attempt])
+                return {"batch": batch}
+            attempt = generation_router.resume(job.prediction_id, self._request(job), self._bot)
+            self._account(job, [attempt])
+            return {"attempt": attempt, "preview": None}
+
+        logger.info(f"🎨 Рендер задачи {job.id}: {job.operation_type} {job.room_type or ''} → {job.style_type or ''}")
+        if job.operation_type == OPERATION_GRID:
+            # Стили пакета стартуют параллельно; фото готовится один раз (кэш фото) для всех
+            started = await asyncio.gather(
+                *(generation_router.start(self._request(job, style), self._bot) for style in job.styles),
+                return_exceptions=True
+            )
+            batch = [None if isinstance(attempt, BaseException) else attempt for attempt in started]
+            self._account(job, [attempt for attempt in batch if attempt])
+            if any(attempt and attempt.prediction_id for attempt in batch):
+                job.prediction_id = ','.join((attempt and attempt.prediction_id) or '' for attempt in batch)
+                await db.set_generation_job_prediction(job.id, job.prediction_id)
+            return {"batch": batch}
+
+        preview = None
+        if job.fast_preview:
+            # Черновик и финальный рендер стартуют одновременно; ошибка черновика не мешает финальному
+            attempt, preview = await asyncio.gather(
+                generation_router.start(self._request(job), self._bot),
+                generation_router.start(self._request(job, preview=True), self._bot),
+                return_exceptions=True
+            )
+            if isinstance(attempt, BaseException):
+                raise attempt
+            if isinstance(preview, BaseException):
+                logger.warning(f"Черновик задачи {job.id} не запущен: {preview}")
+                preview = None
+        else:
+            attempt = await generation_router.start(self._request(job), self._bot)
+
+        self._account(job, [attempt, preview] if preview else [attempt])
+        if attempt.prediction_id:
+            job.prediction_id = attempt.prediction_id
+            await db.set_generation_job_prediction(job.id, job.prediction_id)
+        return {"attempt": attempt, "preview": preview}
+
+    @staticmethod
+    def _account(job: GenerationJob, attempts: List[RenderAttempt]):
+        """Модель и стоимость запущенных рендеров (фоллбэк/хеджирование доплачиваются по итогу)"""
+        if attempts:
+            job.model_id = attempts[0].model_id
+        job.cost = sum(attempt.cost for attempt in attempts)
+
+    async def _render_result(self, job: GenerationJob, attempt: Optional[RenderAttempt],
+                             style_index: Optional[int] = None) -> Optional[str]:
+        """
+        Дождаться рендера через роутер (фоллбэк, хеджирование) и учесть итоговую модель и стоимость.
+        style_index — номер стиля пакета design_grid (модель записывается в job.style_model_ids).
+        """
+        if attempt is None:
+            return None
+        result = await generation_router.result(attempt)
+        job.cost += result.cost - attempt.cost
+        if result.url and result.model_id and not attempt.request.preview:
+            job.model_id = result.model_id
+            if style_index is not None:
+                job.style_model_ids[style_index] = result.model_id
+        return result.url
+
+    async def _complete(self, job: GenerationJob, prediction: Optional[Dict[str, Any]] = None,
+                        error: Optional[Exception] = None):
+        """Дождаться рендера, сохранить итог и освободить слоты"""
+        try:
+            result_url = None
+            preview_task = None
+            if error is None and prediction.get("preview"):
+                preview_task = asyncio.create_task(self._wait_preview(job, prediction["preview"]))
+            try:
+                if error is None:
+                    if job.operation_type == OPERATION_GRID:
+                        job.style_model_ids = [None] * len(prediction["batch"])
+                        result_url = list(await asyncio.gather(*(
+                            self._render_result(job, attempt, index)
+                            for index, attempt in enumerate(prediction["batch"])
+                        )))
+                    else:
+                        result_url = await self._render_result(job, prediction["attempt"])
+            finally:
+                # Черновик, не успевший раньше финального рендера, уже не нужен
+                if preview_task:
+                    preview_task.cancel()
+                self._resolve_preview(job, None)
+            await self._finish(job, result_url, error)
+        except asyncio.CancelledError:
+            self._cancel_futures(job)
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка завершения задачи {job.id}: {e}")
+            # Хэндлер ждет future: без результата он не вернет пользователю списание
+            self._resolve_preview(job, None)
+            if job.future and not job.future.done():
+                job.future.set_result(None)
+        finally:
+            self._slots.release()
+            async with self._cond:
+                self._running[job.user_id] -= 1
+                if not self._running[job.user_id]:
+                    del self._running[job.user_id]
+                self._cond.notify_all()
+
+    async def _wait_preview(self, job: GenerationJob, preview: RenderAttempt):
+        url = await self._render_result(job, preview)
+        if url:
+            job.preview_at = time.monotonic()
+            render_latency.record('preview', job.preview_ms)
+        self._resolve_preview(job, url)
+
+    @staticmethod
+    def _cancel_futures(job: GenerationJob):
+        """Остановка бота: задача остается в БД для восстановления, ожидающий ее хэндлер прерывается"""
+        for future in (job.future, job.preview_future):
+            if future and not future.done():
+                future.cancel()
+
+    @staticmethod
+    def _resolve_preview(job: GenerationJob, url: Optional[str]):
+        if job.preview_future and not job.preview_future.done():
+            job.preview_future.set_result(url)
+
+    async def _finish(self, job: GenerationJob, result_url: Any, error: Optional[Exception]):
+        job.finished_at = time.monotonic()
+        if result_url and job.operation_type != OPERATION_GRID:
+            render_latency.record('full', job.duration_ms)
+        if error is not None:
+            # Ошибка запуска предсказания — для пользователя это неуспешная генерация (результат None)
+            await db.finish_generation_job(job.id, 'failed', error=str(error)[:500])
+        elif job.operation_type == OPERATION_GRID:
+            # Пакет удался, если получился хотя бы один стиль; URL — через запятую по порядку стилей
+            await db.finish_generation_job(
+                job.id, 'done' if any(result_url) else 'failed', ','.join(url or '' for url in result_url)
+            )
+        else:
+            await db.finish_generation_job(job.id, 'done' if result_url else 'failed', result_url)
+
+        if job.future:
+            if not job.future.done():
+                job.future.set_result(result_url)
+            return
+
+        # Задача восстановлена после перезапуска: хэндлер, который ее ждал, уже не существует
+        if self._on_recovered:
+            await self._on_recovered(job, result_url)
+
+
+# Создаем глобальный экземпляр (параметры выставляются в main.py)
+generation_scheduler = GenerationScheduler()
@@ -0,0 +1,56 @@
+# bot/services/latency.py
+# --- СОЗДАН: 2025-12-08 - Перцентили задержек рендера (скользящее окно в памяти) ---
+"""
+Задержки рендера по фазам: черновик (preview) и финальный результат (full).
+
+Для каждой фазы хранятся последние window замеров (мс); перцентили считаются
+по окну при запросе — это дешево для сотен значений и не требует БД.
+Долгосрочная история — в generations.duration_ms / preview_ms.
+"""
+
+import math
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._samples: Dict[str, Deque[int]] = {}
+
+    def record(self, name: str, ms: Optional[int]):
+        """Добавить замер фазы name (None — замера нет, игнорируется)"""
+        if ms is None:
+            return
+        samples = self._samples.get(name)
+        if samples is None:
+            samples = self._samples[name] = deque(maxlen=self.window)
+        samples.append(ms)
+
+    def count(self, name: str) -> int:
+        samples = self._samples.get(name)
+        return len(samples) if samples else 0
+
+    def percentile(self, name: str, p: float) -> Optional[int]:
+        """p-й перцентиль по окну; None, если замеров нет"""
+        samples = self._samples.get(name)
+        return _nearest_rank(sorted(samples), p) if samples else None
+
+    def stats(self, name: str) -> Dict[str, Optional[int]]:
+        """{'count': N, 'p50': ..., 'p90': ..., 'p95': ..., 'p99': ...} для фазы name"""
+        ordered = sorted(self._samples.get(name) or ())
+        return {
+            'count': len(ordered),
+            **{f'p{p}': _nearest_rank(ordered, p) if ordered else None for p in PERCENTILES},
+        }
+
+
+def _nearest_rank(ordered: List[int], p: float) -> int:
+    """Перцентиль методом nearest-rank по отсортированному списку"""
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+# Создаем глобальный экземпляр
+render_latency = LatencyTracker()
@@ -0,0 +1,144 @@
+# bot/services/photo_cache.py
+# --- СОЗДАН: 2025-12-08 - Кэш фото пользователей (ключ — Telegram file_unique_id) ---
+# [2025-12-08] Дисковый уровень под threading.Lock: запись, подсчет размера и вытеснение из параллельных потоков
+"""
+Кэш подготовленных фото пользователей для image-to-image.
+
+Повторные генерации по одному фото (другой стиль, другая комната, очистка, затем стиль)
+берут фото отсюда: файл скачивается из Telegram и масштабируется один раз.
+Ключ — file_unique_id (одинаков у одного файла для всех ботов и не меняется со временем).
+
+Два уровня:
+- память: LRU с бюджетом memory_bytes;
+- диск: вытесненные из памяти фото сохраняются файлами в disk_dir, суммарно не больше
+  disk_max_bytes (самые старые удаляются). Диск переживает перезапуск бота.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoCache:
+    def __init__(self, memory_bytes: int = 64 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 512 * 1024 * 1024):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+
+        # key -> данные; _memory_used — сумма размеров
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_used = 0
+        # Размер дискового уровня считается один раз (при первом обращении), дальше ведется в памяти
+        self._disk_used: Optional[int] = None
+        # Вытеснения на диск идут из разных потоков (asyncio.to_thread): подсчет размера, запись
+        # и удаление старых файлов выполняются под одной блокировкой
+        self._disk_lock = threading.Lock()
+        self._metrics = {'hits_memory': 0, 'hits_disk': 0, 'misses': 0, 'spilled': 0}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self._metrics['hits_memory'] += 1
+            return data
+
+        if self.disk_dir:
+            data = await asyncio.to_thread(self._disk_read, key)
+            if data is not None:
+                self._metrics['hits_disk'] += 1
+                await self.put(key, data)
+                return data
+
+        self._metrics['misses'] += 1
+        return None
+
+    async def put(self, key: str, data: bytes):
+        """Положить в память; не поместившееся в бюджет вытесняется на диск"""
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_used -= len(old)
+        self._memory[key] = data
+        self._memory_used += len(data)
+
+        evicted = []
+        while self._memory_used > self.memory_bytes and len(self._memory) > 1:
+            old_key, old_data = self._memory.popitem(last=False)
+            self._memory_used -= len(old_data)
+            evicted.append((old_key, old_data))
+
+        if evicted and self.disk_dir:
+            await asyncio.to_thread(self._disk_spill, evicted)
+            self._metrics['spilled'] += len(evicted)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **self._metrics,
+            'memory_entries': len(self._memory),
+            'memory_bytes': self._memory_used,
+        }
+
+    # ===== ДИСКОВЫЙ УРОВЕНЬ (выполняется в потоке) =====
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.jpg")
+
+    def _disk_read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.debug(f"Кэш фото: ошибка чтения {key}: {e}")
+            return None
+
+    def _disk_spill(self, items):
+        with self._disk_lock:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                if self._disk_used is None:
+                    self._disk_used = self._disk_scan_size()
+                for key, data in items:
+                    path = self._disk_path(key)
+                    if os.path.exists(path):
+                        # Уже на диске (было поднято в память с диска) — только освежим mtime
+                        os.utime(path)
+                        continue
+                    tmp_path = path + '.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp_path, path)
+                    self._disk_used += len(data)
+                if self._disk_used > self.disk_max_bytes:
+                    self._disk_evict()
+            except OSError as e:
+                logger.error(f"Кэш фото: ошибка записи на диск: {e}")
+
+    def _disk_scan_size(self) -> int:
+        with os.scandir(self.disk_dir) as entries:
+            return sum(entry.stat().st_size for entry in entries if entry.name.endswith('.jpg'))
+
+    def _disk_evict(self):
+        """Удалять самые старые файлы, пока размер больше disk_max_bytes (под _disk_lock)"""
+        with os.scandir(self.disk_dir) as entries:
+            files = [entry for entry in entries if entry.name.endswith('.jpg')]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files:
+            if self._disk_used <= self.disk_max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._disk_used -= size
+            except OSError:
+                pass
+
+
+# Создаем глобальный экземпляр (параметры выставляются в main.py)
+photo_cache = PhotoCache()
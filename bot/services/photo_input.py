@@ -0,0 +1,112 @@
+# bot/services/photo_input.py
+# --- СОЗДАН: 2025-12-08 - Фото пользователя как вход image-to-image модели ---
+# [2025-12-08] Подготовленные фото кэшируются по file_unique_id (photo_cache), загрузки одного фото объединяются
+# [2025-12-08] photo_bytes — подготовленное фото байтами (для провайдеров, которым не нужен data URI)
+"""
+Подготовка фото пользователя для модели.
+
+Файл скачивается из Telegram через bot.download прямо в память, уменьшается
+до IMAGE_INPUT_MAX_SIDE по длинной стороне и перекодируется в JPEG (Pillow, в потоке —
+не блокирует event loop). Результат передается Replicate как data URI в поле input —
+без временных файлов и без отдельной загрузки в хранилище.
+
+Подготовленное фото кэшируется по file_unique_id (services/photo_cache.py): повторные
+генерации по тому же фото не скачивают его заново, а одновременные — ждут одну загрузку.
+"""
+
+import asyncio
+import base64
+import io
+import logging
+from typing import Dict, Optional
+
+from aiogram import Bot
+from PIL import Image, ImageOps
+
+from config import config
+from services.photo_cache import photo_cache
+
+logger = logging.getLogger(__name__)
+
+# Одновременно подготавливаемых фото: работа в потоках конкурирует с event loop за CPU/GIL
+PREPARE_CONCURRENCY = 2
+_prepare_slots: Optional[asyncio.Semaphore] = None
+# Загрузки в процессе: ключ кэша -> задача (одно фото скачивается один раз)
+_loading: Dict[str, asyncio.Task] = {}
+
+
+def prepare_image(data: bytes, max_side: int, quality: int) -> bytes:
+    """Повернуть по EXIF, уменьшить до max_side по длинной стороне и сохранить в JPEG"""
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG сразу декодируется в уменьшенном масштабе (1/2, 1/4, 1/8) — в разы быстрее полного
+        image.draft("RGB", (max_side, max_side))
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality)
+        return output.getvalue()
+
+
+def to_data_uri(data: bytes, mime: str = "image/jpeg") -> str:
+    return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+
+async def download_photo(bot: Bot, file_id: str) -> bytes:
+    """Скачать файл Telegram в память"""
+    buffer = await bot.download(file_id)
+    return buffer.getvalue()
+
+
+def _cache_key(file_unique_id: str) -> str:
+    # Параметры подготовки — часть ключа: смена настроек не отдаст фото старого размера
+    return f"{file_unique_id}_{config.IMAGE_INPUT_MAX_SIDE}_{config.IMAGE_INPUT_QUALITY}"
+
+
+async def _load_photo(bot: Bot, file_id: str) -> bytes:
+    """Скачать и подготовить фото (JPEG, не больше IMAGE_INPUT_MAX_SIDE)"""
+    global _prepare_slots
+    if _prepare_slots is None:
+        _prepare_slots = asyncio.Semaphore(PREPARE_CONCURRENCY)
+
+    data = await download_photo(bot, file_id)
+    # Декодирование и масштабирование — в потоке, чтобы не задерживать кнопки
+    async with _prepare_slots:
+        prepared = await asyncio.to_thread(
+            prepare_image, data, config.IMAGE_INPUT_MAX_SIDE, config.IMAGE_INPUT_QUALITY
+        )
+    logger.debug(f"Фото {file_id}: {len(data)} -> {len(prepared)} байт")
+    return prepared
+
+
+async def _load_and_cache(bot: Bot, file_id: str, key: str) -> bytes:
+    prepared = await _load_photo(bot, file_id)
+    await photo_cache.put(key, prepared)
+    return prepared
+
+
+async def photo_bytes(bot: Bot, file_id: str, file_unique_id: Optional[str] = None) -> bytes:
+    """
+    Подготовленное фото пользователя (JPEG).
+    С file_unique_id фото берется из кэша (или скачивается один раз на все параллельные запросы).
+    """
+    if not file_unique_id:
+        return await _load_photo(bot, file_id)
+
+    key = _cache_key(file_unique_id)
+    prepared = await photo_cache.get(key)
+    if prepared is None:
+        task = _loading.get(key)
+        if task is None:
+            task = asyncio.create_task(_load_and_cache(bot, file_id, key))
+            _loading[key] = task
+            task.add_done_callback(lambda _: _loading.pop(key, None))
+        prepared = await asyncio.shield(task)
+    return prepared
+
+
+async def photo_data_uri(bot: Bot, file_id: str, file_unique_id: Optional[str] = None) -> str:
+    """Фото пользователя в виде data URI, готовое для input модели"""
+    return to_data_uri(await photo_bytes(bot, file_id, file_unique_id))
@@ -0,0 +1,510 @@
+# bot/services/providers.py
+# --- СОЗДАН: 2025-12-08 - Провайдеры генерации (Replicate, HTTP, локальный diffusers), фоллбэк и хеджирование ---
+# [2025-12-08] ImageProvider — abc.ABC: start() и result() абстрактные
+# [2025-12-08] primary_model_id: модель основного провайдера — часть ключа кэша результатов
+"""
+Провайдеры генерации изображений и маршрутизатор между ними.
+
+Провайдер (ImageProvider) рендерит RenderRequest в два шага, как и очередь генераций:
+start() — запустить рендер (быстро, в воркере очереди), result() — дождаться URL результата.
+- ReplicateProvider — Replicate Predictions API (services/replicate_api.py: вебхуки, опрос, отмена);
+- HttpProvider — любой HTTP-сервис: POST JSON {prompt, image, preview} -> {"url": ...};
+- LocalDiffusersProvider — локальная модель diffusers (нужны пакеты diffusers и torch),
+  результат сохраняется файлом и отправляется в Telegram из файла (URL file://).
+
+ProviderRouter перебирает провайдеров в порядке GENERATION_PROVIDERS:
+- здоровье: failure_threshold ошибок подряд открывают «предохранитель» провайдера на cooldown
+  секунд — пока он открыт, провайдер пропускается (если закрыты все — пробуем всех по порядку);
+- фоллбэк: ошибка запуска, ошибка или пустой результат, рендер дольше slow_timeout —
+  рендер запускается у следующего провайдера;
+- хеджирование (hedge): если рендер не готов к p95 задержки своего провайдера, параллельно
+  запускается следующий живой провайдер; берется первый результат, остальные отменяются.
+  p95 — по последним успешным рендерам провайдера; пока их меньше hedge_min_samples,
+  хеджирования нет.
+"""
+
+import asyncio
+import io
+import logging
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+import aiohttp
+from aiogram import Bot
+
+from config import config
+from services.latency import LatencyTracker
+from services.photo_input import photo_bytes, photo_data_uri
+from services.replicate_api import (
+    IMAGE_PARAMS, MODEL_COSTS, ReplicateClient, extract_output_url, render_model, replicate_client, start_render
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderError(Exception):
+    """Провайдер не смог выполнить рендер"""
+
+
+@dataclass
+class RenderRequest:
+    """Что рендерить: промпт и фото пользователя; preview — быстрый черновик"""
+    prompt: str
+    photo_file_id: str
+    photo_unique_id: Optional[str] = None
+    preview: bool = False
+
+
+class ImageProvider(ABC):
+    """Базовый провайдер генерации: наследник обязан реализовать start() и result()"""
+    name = 'base'
+    # Рендер переживает перезапуск бота: его можно дождаться по сохраненному ID (handle['id'])
+    resumable = False
+
+    def model_id(self, request: RenderRequest) -> str:
+        return self.name
+
+    def cost(self, request: RenderRequest) -> float:
+        """Цена одного рендера, $ (для аналитики generations.cost)"""
+        return 0.0
+
+    @abstractmethod
+    async def start(self, request: RenderRequest, bot: Bot) -> Dict[str, Any]:
+        """Запустить рендер; возвращает handle для result()"""
+
+    @abstractmethod
+    async def result(self, handle: Dict[str, Any]) -> Optional[str]:
+        """Дождаться рендера и вернуть URL результата (ошибка — исключение)"""
+
+    async def cancel(self, handle: Dict[str, Any]):
+        """Отменить рендер, результат которого больше не нужен"""
+
+    def resume(self, prediction_id: str) -> Dict[str, Any]:
+        """handle рендера, запущенного до перезапуска бота"""
+        raise ProviderError(f"Провайдер {self.name} не восстанавливает рендеры")
+
+    async def close(self):
+        """Освободить ресурсы (при остановке бота)"""
+
+
+@dataclass
+class RenderAttempt:
+    """Рендер, запущенный у конкретного провайдера"""
+    provider: ImageProvider
+    request: RenderRequest
+    handle: Dict[str, Any]
+    bot: Optional[Bot] = field(default=None, repr=False)
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def model_id(self) -> str:
+        return self.handle.get("model") or self.provider.model_id(self.request)
+
+    @property
+    def cost(self) -> float:
+        return self.provider.cost(self.request)
+
+    @property
+    def prediction_id(self) -> Optional[str]:
+        """ID для восстановления после перезапуска (только у resumable-провайдеров)"""
+        return self.handle.get("id") if self.provider.resumable else None
+
+
+@dataclass
+class RenderResult:
+    """Итог рендера; cost — все запущенные попытки (включая неудачные и хеджированные)"""
+    url: Optional[str]
+    provider: Optional[str] = None
+    model_id: Optional[str] = None
+    cost: float = 0.0
+
+
+# ===== ПРОВАЙДЕРЫ =====
+
+class ReplicateProvider(ImageProvider):
+    name = 'replicate'
+    resumable = True
+
+    def __init__(self, client: ReplicateClient = replicate_client):
+        self.client = client
+
+    def model_id(self, request: RenderRequest) -> str:
+        return render_model(request.preview)[0]
+
+    def cost(self, request: RenderRequest) -> float:
+        # Без токена рендер — заглушка, он бесплатный
+        return MODEL_COSTS.get(self.model_id(request), 0.0) if self.client.api_token else 0.0
+
+    async def start(self, request: RenderRequest, bot: Bot) -> Dict[str, Any]:
+        return await start_render(request.prompt, request.photo_file_id, bot, request.photo_unique_id,
+                                  request.preview)
+
+    async def result(self, handle: Dict[str, Any]) -> Optional[str]:
+        return await self.client.result(handle)
+
+    async def cancel(self, handle: Dict[str, Any]):
+        if handle.get("id") and handle.get("status") not in self.client.TERMINAL_STATUSES:
+            await self.client.cancel(handle["id"])
+
+    def resume(self, prediction_id: str) -> Dict[str, Any]:
+        return {"id": prediction_id, "status": "starting"}
+
+    async def close(self):
+        await self.client.close()
+
+
+class HttpProvider(ImageProvider):
+    """
+    Любой HTTP-сервис генерации. Протокол:
+    POST url, JSON {"prompt": ..., "preview": bool, "image": data URI (в режиме image-to-image)}
+    -> 200, JSON {"url": "..."} или {"output": "..." | ["...", ...]}.
+    Токен (если задан) передается в заголовке Authorization: Bearer.
+    """
+    name = 'http'
+
+    def __init__(self, url: str, token: Optional[str] = None, model: str = 'http',
+                 cost_per_image: float = 0.0, timeout: float = 180):
+        self.url = url
+        self.token = token
+        self.model = model
+        self.cost_per_image = cost_per_image
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def model_id(self, request: RenderRequest) -> str:
+        return self.model
+
+    def cost(self, request: RenderRequest) -> float:
+        return self.cost_per_image
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+            self._session = aiohttp.ClientSession(
+                headers=headers, timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def start(self, request: RenderRequest, bot: Bot) -> Dict[str, Any]:
+        # Сервис синхронный: здесь только готовим тело запроса (фото — из кэша), запрос — в result()
+        payload: Dict[str, Any] = {"prompt": request.prompt, "preview": request.preview}
+        if config.REPLICATE_IMG2IMG:
+            payload["image"] = await photo_data_uri(bot, request.photo_file_id, request.photo_unique_id)
+        return {"payload": payload}
+
+    async def result(self, handle: Dict[str, Any]) -> Optional[str]:
+        async with self._get_session().post(self.url, json=handle["payload"]) as response:
+            if response.status >= 400:
+                raise ProviderError(f"HTTP {response.status}: {(await response.text())[:300]}")
+            data = await response.json()
+        return data.get("url") or extract_output_url(data.get("output"))
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+class LocalDiffusersProvider(ImageProvider):
+    """
+    Локальная модель diffusers (image-to-image), например для собственного GPU-сервера.
+    Пакеты diffusers и torch необязательны: без них рендер завершается ошибкой
+    и роутер переходит к следующему провайдеру. Модель загружается при первом рендере.
+    Рендеры идут по одному (одна видеокарта) в потоке — event loop не блокируется.
+    """
+    name = 'local'
+
+    def __init__(self, model: str = 'stabilityai/sdxl-turbo', output_dir: str = 'cache/local_renders',
+                 steps: int = 4, preview_steps: int = 2, device: Optional[str] = None):
+        self.model = model
+        self.output_dir = output_dir
+        self.steps = steps
+        self.preview_steps = preview_steps
+        self.device = device
+        self._pipeline = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def model_id(self, request: RenderRequest) -> str:
+        return f"local:{self.model}"
+
+    async def start(self, request: RenderRequest, bot: Bot) -> Dict[str, Any]:
+        image = await photo_bytes(bot, request.photo_file_id, request.photo_unique_id)
+        return {"request": request, "image": image}
+
+    async def result(self, handle: Dict[str, Any]) -> Optional[str]:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            return await asyncio.to_thread(self._render, handle["request"], handle["image"])
+
+    def _load_pipeline(self):
+        try:
+            # Тяжелые необязательные зависимости — импортируем только когда провайдер реально нужен
+            import torch
+            from diffusers import AutoPipelineForImage2Image
+        except ImportError as e:
+            raise ProviderError(f"Для локального провайдера нужны пакеты diffusers и torch: {e}")
+        device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
+        return AutoPipelineForImage2Image.from_pretrained(self.model).to(device)
+
+    def _render(self, request: RenderRequest, image_data: bytes) -> str:
+        from PIL import Image
+
+        if self._pipeline is None:
+            self._pipeline = self._load_pipeline()
+        image = Image.open(io.BytesIO(image_data)).convert("RGB")
+        output = self._pipeline(
+            prompt=request.prompt,
+            image=image,
+            num_inference_steps=self.preview_steps if request.preview else self.steps,
+            strength=IMAGE_PARAMS["prompt_strength"],
+        ).images[0]
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"{uuid.uuid4().hex}.webp")
+        output.save(path, format="WEBP", quality=85)
+        return Path(path).resolve().as_uri()
+
+
+def create_providers(names: str, http_url: Optional[str] = None, http_token: Optional[str] = None,
+                     http_model: str = 'http', http_cost: float = 0.0, local_model: Optional[str] = None,
+                     local_dir: str = 'cache/local_renders') -> List[ImageProvider]:
+    """
+    Провайдеры по списку имен из конфига (порядок = приоритет): replicate, http, local.
+    http без адреса пропускается.
+    """
+    providers: List[ImageProvider] = []
+    for name in (part.strip() for part in names.split(',')):
+        if name == 'replicate':
+            providers.append(ReplicateProvider())
+        elif name == 'http':
+            if not http_url:
+                logger.warning("Провайдер http пропущен: не задан HTTP_PROVIDER_URL")
+                continue
+            providers.append(HttpProvider(http_url, http_token, http_model, http_cost))
+        elif name == 'local':
+            providers.append(LocalDiffusersProvider(local_model or 'stabilityai/sdxl-turbo', local_dir))
+        elif name:
+            logger.warning(f"Неизвестный провайдер генерации: {name}")
+    return providers or [ReplicateProvider()]
+
+
+# ===== ЗДОРОВЬЕ И МАРШРУТИЗАЦИЯ =====
+
+class ProviderHealth:
+    """Счетчики провайдера и «предохранитель»: после failure_threshold ошибок подряд — пауза cooldown"""
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        # После паузы провайдер снова пробуется; новая ошибка сразу открывает предохранитель опять
+        return time.monotonic() >= self.open_until
+
+    def record_success(self):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.open_until = time.monotonic() + self.cooldown
+
+
+class ProviderRouter:
+    def __init__(self, providers: Optional[List[ImageProvider]] = None, hedge: bool = False,
+                 hedge_min_samples: int = 20, slow_timeout: float = 150.0,
+                 failure_threshold: int = 3, cooldown: float = 60.0):
+        self.providers: List[ImageProvider] = providers or [ReplicateProvider()]
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.slow_timeout = slow_timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        # Задержки успешных рендеров по провайдерам (отдельно черновики) — для p95 хеджирования
+        self.latency = LatencyTracker()
+        self._health: Dict[str, ProviderHealth] = {}
+        # Отмены проигравших рендеров идут в фоне; держим ссылки, чтобы задачи не собрал GC
+        self._background: Set[asyncio.Task] = set()
+        self._metrics = {'fallbacks': 0, 'hedged': 0, 'hedge_wins': 0}
+
+    def health(self, provider: ImageProvider) -> ProviderHealth:
+        health = self._health.get(provider.name)
+        if health is None:
+            health = self._health[provider.name] = ProviderHealth(self.failure_threshold, self.cooldown)
+        return health
+
+    def primary_model_id(self) -> str:
+        """Модель финального рендера у основного (первого) провайдера — для ключа кэша результатов"""
+        return self.providers[0].model_id(RenderRequest('', ''))
+
+    def _candidates(self, tried: Set[str], healthy_only: bool = False) -> List[ImageProvider]:
+        rest = [provider for provider in self.providers if provider.name not in tried]
+        available = [provider for provider in rest if self.health(provider).available]
+        return available if available or healthy_only else rest
+
+    @staticmethod
+    def _latency_key(attempt: RenderAttempt) -> str:
+        return f"{attempt.provider.name}:preview" if attempt.request.preview else attempt.provider.name
+
+    # ===== ЗАПУСК =====
+
+    async def start(self, request: RenderRequest, bot: Bot) -> RenderAttempt:
+        """Запустить рендер у первого живого провайдера (ошибка запуска — у следующего)"""
+        attempt = await self._start_next(request, bot, set())
+        if attempt is None:
+            raise ProviderError("Ни один провайдер не запустил рендер")
+        return attempt
+
+    def resume(self, prediction_id: str, request: RenderRequest, bot: Bot) -> RenderAttempt:
+        """Рендер, запущенный до перезапуска бота (ID сохраняют только resumable-провайдеры)"""
+        provider = next((p for p in self.providers if p.resumable), None) or ReplicateProvider()
+        return RenderAttempt(provider, request, provider.resume(prediction_id), bot)
+
+    async def _start_next(self, request: RenderRequest, bot: Bot, tried: Set[str],
+                          healthy_only: bool = False) -> Optional[RenderAttempt]:
+        for provider in self._candidates(tried, healthy_only):
+            tried.add(provider.name)
+            try:
+                handle = await provider.start(request, bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.health(provider).record_failure()
+                logger.warning(f"Провайдер {provider.name}: ошибка запуска рендера: {e}")
+                continue
+            return RenderAttempt(provider, request, handle, bot)
+        return None
+
+    # ===== ОЖИДАНИЕ =====
+
+    async def result(self, attempt: RenderAttempt) -> RenderResult:
+        """
+        Дождаться рендера. Ошибка или рендер дольше slow_timeout — фоллбэк на следующего провайдера;
+        с hedge — следующий провайдер подключается параллельно, когда рендер не успел к своему p95.
+        """
+        tried = {attempt.provider.name}
+        hedges: Set[int] = set()
+        cost = attempt.cost
+        running: Dict[asyncio.Task, RenderAttempt] = {asyncio.create_task(self._wait(attempt)): attempt}
+        hedge_at = self._hedge_deadline(attempt)
+        try:
+            while running:
+                timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Рендер не успел к p95 своего провайдера — подключаем следующий параллельно
+                    hedge_at = None
+                    hedge = await self._start_next(attempt.request, attempt.bot, tried, healthy_only=True)
+                    if hedge:
+                        self._metrics['hedged'] += 1
+                        hedges.add(id(hedge))
+                        cost += hedge.cost
+                        running[asyncio.create_task(self._wait(hedge))] = hedge
+                    continue
+
+                for task in done:
+                    finished = running.pop(task)
+                    url = task.result()
+                    if url:
+                        if id(finished) in hedges:
+                            self._metrics['hedge_wins'] += 1
+                        # Остальные рендеры больше не нужны — отменяем и у провайдера
+                        self._abandon(running, cancel_remote=True)
+                        return RenderResult(url, finished.provider.name, finished.model_id, cost)
+
+                if not running:
+                    fallback = await self._start_next(attempt.request, attempt.bot, tried)
+                    if fallback:
+                        logger.info(f"Фоллбэк рендера на провайдера {fallback.provider.name}")
+                        self._metrics['fallbacks'] += 1
+                        cost += fallback.cost
+                        running[asyncio.create_task(self._wait(fallback))] = fallback
+                        hedge_at = self._hedge_deadline(fallback)
+        finally:
+            # Отмена снаружи (остановка бота): рендеры у провайдера не трогаем — задача восстановится
+            self._abandon(running, cancel_remote=False)
+        return RenderResult(None, cost=cost)
+
+    def _hedge_deadline(self, attempt: RenderAttempt) -> Optional[float]:
+        """Момент хеджирования: старт + p95 провайдера (None — хеджирование выключено или мало данных)"""
+        if not self.hedge:
+            return None
+        key = self._latency_key(attempt)
+        if self.latency.count(key) < self.hedge_min_samples:
+            return None
+        return attempt.started_at + self.latency.percentile(key, 95) / 1000
+
+    async def _wait(self, attempt: RenderAttempt) -> Optional[str]:
+        """URL рендера; ошибка, пустой результат или рендер дольше slow_timeout — None"""
+        provider = attempt.provider
+        try:
+            url = await asyncio.wait_for(provider.result(attempt.handle), self.slow_timeout)
+            if not url:
+                raise ProviderError("пустой результат")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.health(provider).record_failure()
+            if isinstance(e, asyncio.TimeoutError):
+                logger.warning(f"Провайдер {provider.name}: рендер дольше {self.slow_timeout} c")
+                self._cancel_remote(attempt)
+            else:
+                logger.warning(f"Провайдер {provider.name}: ошибка рендера: {e}")
+            return None
+
+        self.health(provider).record_success()
+        self.latency.record(self._latency_key(attempt), int((time.monotonic() - attempt.started_at) * 1000))
+        return url
+
+    def _abandon(self, running: Dict[asyncio.Task, RenderAttempt], cancel_remote: bool):
+        for task, attempt in running.items():
+            task.cancel()
+            if cancel_remote:
+                self._cancel_remote(attempt)
+        running.clear()
+
+    def _cancel_remote(self, attempt: RenderAttempt):
+        task = asyncio.create_task(attempt.provider.cancel(attempt.handle))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    # ===== СОСТОЯНИЕ =====
+
+    def stats(self) -> Dict[str, Any]:
+        """Здоровье и задержки провайдеров для админки"""
+        return {
+            **self._metrics,
+            'providers': [
+                {
+                    'name': provider.name,
+                    'available': self.health(provider).available,
+                    'successes': self.health(provider).successes,
+                    'failures': self.health(provider).failures,
+                    'p95': self.latency.percentile(provider.name, 95),
+                }
+                for provider in self.providers
+            ],
+        }
+
+    async def close(self):
+        for provider in self.providers:
+            await provider.close()
+
+
+# Создаем глобальный экземпляр (параметры выставляются в main.py)
+generation_router = ProviderRouter()
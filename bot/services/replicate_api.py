@@ -1,14 +1,48 @@
+# bot/services/replicate_api.py
+# --- ОБНОВЛЕН: 2025-12-08 - Асинхронный HTTP-клиент Replicate вместо блокирующего replicate.run ---
+# [2025-12-08] Предсказания создаются без ожидания; завершение — по вебхуку или опросом с backoff
+# [2025-12-08] Image-to-image: фото пользователя (уменьшенное в памяти) передается модели как data URI
+# [2025-12-08] Фото берется из кэша по file_unique_id: повторные генерации не скачивают его заново
+# [2025-12-08] Пакет стилей (превью-сетка): одно фото, предсказания по всем стилям создаются параллельно
+# [2025-12-08] Быстрый черновик (двухфазный рендер): мало шагов и ~0.25 Мп, render_model(preview=True)
+# [2025-12-08] start_render и cancel — для ReplicateProvider; выбор провайдера — services/providers.py
+# [2025-12-08] 5xx повторяется только для GET (POST мог создать предсказание); Retry-After — и в виде HTTP-даты
+# [2025-12-08] Ключи кэша результатов включают модель, давшую результат (model_id)
 # https://www.perplexity.ai/search/izuchi-moi-kod-na-git-khab-i-p-iLN8v2F.Rkqx2s4l9WxSOw#102
 
 
-import os
+import asyncio
 import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+import aiohttp
 from aiogram import Bot
 from config import config
+from services.photo_input import photo_data_uri
+from services.result_cache import make_cache_key
 
 logger = logging.getLogger(__name__)
 
+# Text-to-image (фото пользователя не используется) — при REPLICATE_IMG2IMG=false
 MODEL_ID = "black-forest-labs/flux-1.1-pro"
+# Image-to-image: рендер по фото пользователя, пропорции результата — как у фото
+IMAGE_MODEL_ID = "black-forest-labs/flux-dev"
+
+# Быстрый черновик text-to-image (двухфазный рендер)
+PREVIEW_MODEL_ID = "black-forest-labs/flux-schnell"
+
+# Цена одного изображения на Replicate, $ (для аналитики generations.cost)
+MODEL_COSTS = {
+    MODEL_ID: 0.04,
+    IMAGE_MODEL_ID: 0.025,
+    PREVIEW_MODEL_ID: 0.003,
+}
+
+# Заглушка, если токен Replicate не задан (локальная разработка)
+PLACEHOLDER_URL = "https://i.imgur.com/K1x5d1H.png"
 
 STYLE_PROMPTS = {
     'modern': 'modern minimalist interior design, clean lines, neutral colors, professional photography, 4K',
@@ -32,89 +66,367 @@ ROOM_PROMPTS = {
     'dining_room': 'dining room',
 }
 
+# Параметры модели для всех рендеров FLUX
+FLUX_PARAMS = {
+    "steps": 25,
+    "width": 1024,
+    "height": 1024,
+    "guidance": 3,
+    "aspect_ratio": "1:1",
+    "output_format": "webp",
+    "output_quality": 85,
+}
+
+# Параметры image-to-image: prompt_strength — насколько сильно модель меняет исходное фото
+IMAGE_PARAMS = {
+    "prompt_strength": 0.8,
+    "num_inference_steps": 28,
+    "guidance": 3.5,
+    "output_format": "webp",
+    "output_quality": 85,
+}
+
+# Черновики: несколько шагов и ~0.25 Мп — готовы за секунды, затем их заменяет финальный рендер
+PREVIEW_PARAMS = {
+    "num_inference_steps": 4,
+    "megapixels": "0.25",
+    "aspect_ratio": "1:1",
+    "go_fast": True,
+    "output_format": "webp",
+    "output_quality": 80,
+}
+IMAGE_PREVIEW_PARAMS = {
+    **IMAGE_PARAMS,
+    "num_inference_steps": 10,
+    "megapixels": "0.25",
+    "go_fast": True,
+    "output_quality": 80,
+}
+
+
+class ReplicateError(Exception):
+    """Ошибка Replicate API (HTTP-ошибка или неуспешный статус предсказания)"""
+
+
+def _retry_after(value: Optional[str], default: float) -> float:
+    """Пауза из Retry-After: секунды или HTTP-дата; нечитаемое значение — default (backoff)"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class ReplicateClient:
+    """
+    Асинхронный клиент Replicate Predictions API на aiohttp.
+    Не блокирует event loop: пока идет рендер, бот продолжает обрабатывать кнопки.
+
+    Предсказание создается без ожидания результата (start), а завершение (result) приходит:
+    - по вебхуку (если задан webhook_url) — через resolve() из services/replicate_webhook.py;
+    - опросом GET /predictions/{id} с экспоненциально растущей паузой (без вебхука или как страховка).
+    """
+
+    TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+    def __init__(self, api_token: Optional[str], base_url: str, max_concurrency: int = 8,
+                 timeout: float = 180, poll_interval: float = 1.0, max_poll_interval: float = 10.0,
+                 webhook_url: Optional[str] = None, webhook_poll_interval: float = 30.0):
+        self.api_token = api_token
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.webhook_url = webhook_url
+        self.webhook_poll_interval = webhook_poll_interval
+        self._max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        # Ожидающие вебхука предсказания и вебхуки, пришедшие раньше, чем их начали ждать
+        self._waiters: Dict[str, asyncio.Future] = {}
+        self._early: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={
+                    "Authorization": f"Bearer {self.api_token}",
+                    "Content-Type": "application/json",
+                },
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        """Закрыть HTTP-сессию (вызывается при остановке бота)"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    async def _request(self, method: str, url: str, **kwargs) -> Dict[str, Any]:
+        """
+        HTTP-запрос с повтором на 429 (запрос не принят — повтор безопасен) и на 5xx только для GET:
+        POST после 5xx мог уже создать предсказание, повтор создал бы второе (платное).
+        """
+        for attempt in range(3):
+            async with self._get_session().request(method, url, **kwargs) as response:
+                if response.status == 429 or (response.status >= 500 and method == "GET"):
+                    retry_after = _retry_after(response.headers.get("Retry-After"), 2 ** attempt)
+                    logger.warning(f"Replicate {response.status}, повтор через {retry_after} c")
+                    await asyncio.sleep(retry_after)
+                    continue
+                if response.status >= 400:
+                    raise ReplicateError(f"HTTP {response.status}: {(await response.text())[:300]}")
+                return await response.json()
+        raise ReplicateError(f"Replicate недоступен: {method} {url}")
+
+    async def create_prediction(self, model_id: str, model_input: Dict[str, Any],
+                                wait: int = 0) -> Dict[str, Any]:
+        """
+        Создать предсказание для официальной модели.
+        wait > 0 — Replicate держит соединение до результата (не дольше wait секунд).
+        """
+        payload: Dict[str, Any] = {"input": model_input}
+        if self.webhook_url:
+            payload["webhook"] = self.webhook_url
+            payload["webhook_events_filter"] = ["completed"]
+
+        headers = {"Prefer": f"wait={wait}"} if wait else {}
+        return await self._request(
+            "POST",
+            f"{self.base_url}/models/{model_id}/predictions",
+            json=payload,
+            headers=headers,
+        )
+
+    async def get_prediction(self, prediction_id: str) -> Dict[str, Any]:
+        return await self._request("GET", f"{self.base_url}/predictions/{prediction_id}")
+
+    async def cancel(self, prediction_id: str):
+        """Отменить предсказание (результат больше не нужен — не платим за оставшийся рендер)"""
+        try:
+            await self._request("POST", f"{self.base_url}/predictions/{prediction_id}/cancel")
+        except Exception as e:
+            logger.debug(f"Не удалось отменить предсказание {prediction_id}: {e}")
+
+    def resolve(self, prediction: Dict[str, Any]) -> bool:
+        """
+        Завершить ожидание предсказания данными из вебхука.
+        Возвращает True, если предсказание кто-то ждал.
+        """
+        prediction_id = prediction.get("id")
+        if not prediction_id or prediction.get("status") not in self.TERMINAL_STATUSES:
+            return False
+
+        future = self._waiters.get(prediction_id)
+        if future and not future.done():
+            future.set_result(prediction)
+            return True
+
+        # Вебхук обогнал ожидание — запомним (ограниченно), чтобы не ждать страховочного опроса
+        self._early[prediction_id] = prediction
+        while len(self._early) > 256:
+            self._early.popitem(last=False)
+        return False
+
+    async def wait_prediction(self, prediction: Dict[str, Any]) -> Dict[str, Any]:
+        """Дождаться терминального статуса предсказания: вебхук или опрос с backoff"""
+        prediction_id = prediction.get("id")
+        if prediction.get("status") in self.TERMINAL_STATUSES:
+            return prediction
+        if prediction_id in self._early:
+            return self._early.pop(prediction_id)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        future: Optional[asyncio.Future] = None
+        delay = self.poll_interval
+        if self.webhook_url:
+            future = loop.create_future()
+            self._waiters[prediction_id] = future
+            delay = self.webhook_poll_interval  # с вебхуком опрос — только редкая страховка
+
+        try:
+            while prediction.get("status") not in self.TERMINAL_STATUSES:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise ReplicateError(f"Таймаут предсказания {prediction_id}")
+
+                if future is not None:
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(future), min(delay, remaining))
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await asyncio.sleep(min(delay, remaining))
+
+                prediction = await self.get_prediction(prediction_id)
+                delay = min(delay * 1.5, max(self.max_poll_interval, delay))
+        finally:
+            self._waiters.pop(prediction_id, None)
+
+        return prediction
+
+    async def start(self, model_id: str, model_input: Dict[str, Any]) -> Dict[str, Any]:
+        """Создать предсказание, не дожидаясь результата"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+
+        async with self._semaphore:
+            return await self.create_prediction(model_id, model_input)
+
+    async def result(self, prediction: Dict[str, Any]) -> Optional[str]:
+        """Дождаться предсказания и вернуть URL изображения"""
+        prediction = await self.wait_prediction(prediction)
+        if prediction["status"] != "succeeded":
+            raise ReplicateError(f"Предсказание {prediction.get('id')}: {prediction['status']} "
+                                 f"({prediction.get('error')})")
+        return extract_output_url(prediction.get("output"))
+
+    async def run(self, model_id: str, model_input: Dict[str, Any]) -> Optional[str]:
+        """Запустить модель и дождаться результата. Возвращает URL изображения."""
+        return await self.result(await self.start(model_id, model_input))
+
+
+def extract_output_url(output: Any) -> Optional[str]:
+    """Output модели — строка-URL или список URL; берем первый"""
+    if isinstance(output, list):
+        output = output[0] if output else None
+    return str(output) if output else None
+
+
+replicate_client = ReplicateClient(
+    api_token=config.REPLICATE_API_TOKEN,
+    base_url=config.REPLICATE_API_BASE,
+    max_concurrency=config.REPLICATE_MAX_CONCURRENCY,
+    timeout=config.REPLICATE_TIMEOUT,
+    webhook_url=config.REPLICATE_WEBHOOK_URL,
+)
+
+
 def get_prompt(style: str, room: str) -> str:
     style_desc = STYLE_PROMPTS.get(style, 'modern')
     room_name = ROOM_PROMPTS.get(room, room.replace('_', ' '))
     return f"A beautiful {room_name} with {style_desc}, interior design magazine quality"
 
-async def generate_image(photo_file_id: str, room: str, style: str, bot_token: str) -> str | None:
+def render_model(preview: bool = False) -> tuple[str, Dict[str, Any]]:
+    """Модель и ее параметры для текущего режима (image-to-image или text-to-image); preview — черновик"""
+    if config.REPLICATE_IMG2IMG:
+        return IMAGE_MODEL_ID, IMAGE_PREVIEW_PARAMS if preview else IMAGE_PARAMS
+    if preview:
+        return PREVIEW_MODEL_ID, PREVIEW_PARAMS
+    return MODEL_ID, FLUX_PARAMS
+
+
+def design_cache_key(photo_unique_id: Optional[str], room: str, style: str, model_id: str) -> Optional[str]:
+    """
+    Ключ кэша результата дизайна: фото + комната + стиль + промпт + модель + параметры модели.
+    model_id — модель, давшая результат (у поиска в кэше — модель основного провайдера)
+    """
+    if not photo_unique_id:
+        return None
+    _, params = render_model()
+    return make_cache_key(
+        operation='design', photo=photo_unique_id, room=room, style=style,
+        prompt=get_prompt(style, room), model=model_id, params=params,
+    )
+
+
+def clear_space_cache_key(photo_unique_id: Optional[str], model_id: str) -> Optional[str]:
+    """Ключ кэша результата очистки пространства (model_id — как в design_cache_key)"""
+    if not photo_unique_id:
+        return None
+    _, params = render_model()
+    return make_cache_key(
+        operation='clear_space', photo=photo_unique_id,
+        prompt=clear_space_prompt(), model=model_id, params=params,
+    )
+
+
+def _placeholder_prediction() -> Dict[str, Any]:
+    return {"id": None, "status": "succeeded", "output": PLACEHOLDER_URL}
+
+
+def clear_space_prompt() -> str:
+    # Промпт для очистки пространства - без стилей и дополнительных вводных
+    return (
+        "Empty room interior with clean walls, floor and ceiling only, "
+        "no furniture, no objects, no decorations, bare space, "
+        "architectural photography, 4K, high quality"
+    )
+
+
+async def _image_input(photo_file_id: str, bot: Bot, photo_unique_id: Optional[str] = None) -> Dict[str, Any]:
+    """Поле image для image-to-image (пусто в режиме text-to-image)"""
+    if not config.REPLICATE_IMG2IMG:
+        return {}
+    return {"image": await photo_data_uri(bot, photo_file_id, photo_unique_id)}
+
+
+async def start_render(prompt: str, photo_file_id: str, bot: Bot,
+                       photo_unique_id: Optional[str] = None, preview: bool = False) -> Dict[str, Any]:
+    """Создать предсказание: по фото пользователя (image-to-image) или только по промпту"""
     if not config.REPLICATE_API_TOKEN:
-        return "https://i.imgur.com/K1x5d1H.png"
+        return _placeholder_prediction()
 
-    try:
-        import replicate
-        os.environ["REPLICATE_API_TOKEN"] = config.REPLICATE_API_TOKEN
-
-        prompt = get_prompt(style, room)
-        logger.info(f"🎨 FLUX PRO: {room} → {style}")
-
-        output = replicate.run(
-            MODEL_ID,
-            input={
-                "prompt": prompt,
-                "steps": 25,
-                "width": 1024,
-                "height": 1024,
-                "guidance": 3,
-                "aspect_ratio": "1:1",
-                "output_format": "webp",
-                "output_quality": 85,
-            }
-        )
+    model_id, params = render_model(preview)
+    model_input = {"prompt": prompt, **params, **await _image_input(photo_file_id, bot, photo_unique_id)}
+    return await replicate_client.start(model_id, model_input)
+
+
+async def start_design_prediction(photo_file_id: str, room: str, style: str, bot: Bot,
+                                  photo_unique_id: Optional[str] = None, preview: bool = False) -> Dict[str, Any]:
+    """Создать предсказание дизайна (без ожидания результата); preview — быстрый черновик"""
+    logger.info(f"🎨 FLUX{' (черновик)' if preview else ''}: {room} → {style}")
+    return await start_render(get_prompt(style, room), photo_file_id, bot, photo_unique_id, preview)
 
-        if output:
-            try:
-                return output.url()
-            except:
-                return str(output)
+
+async def start_clear_space_prediction(photo_file_id: str, bot: Bot,
+                                       photo_unique_id: Optional[str] = None) -> Dict[str, Any]:
+    """Создать предсказание очистки пространства (без ожидания результата)"""
+    logger.info("🧽 Очистка пространства...")
+    return await start_render(clear_space_prompt(), photo_file_id, bot, photo_unique_id)
+
+
+async def get_prediction_result(prediction: Dict[str, Any]) -> str | None:
+    """Дождаться завершения предсказания (вебхук/опрос). URL или None при ошибке."""
+    try:
+        return await replicate_client.result(prediction)
+    except Exception as e:
+        logger.error(f"❌ Ошибка предсказания {prediction.get('id')}: {e}")
         return None
 
+
+async def generate_image(photo_file_id: str, room: str, style: str, bot: Bot) -> str | None:
+    try:
+        prediction = await start_design_prediction(photo_file_id, room, style, bot)
     except Exception as e:
         logger.error(f"❌ Ошибка: {e}")
         return None
+    return await get_prediction_result(prediction)
+
 
+async def generate_image_auto(photo_file_id: str, room: str, style: str, bot: Bot) -> str | None:
+    """Точка входа генерации дизайна для хэндлеров"""
+    return await generate_image(photo_file_id, room, style, bot)
 
-async def clear_space_image(photo_file_id: str, bot_token: str) -> str | None:
+
+async def clear_space_image(photo_file_id: str, bot: Bot) -> str | None:
     """
     Очистка пространства от мебели и предметов.
     Использует промпт без стилей для удаления всех объектов.
     """
-    if not config.REPLICATE_API_TOKEN:
-        return "https://i.imgur.com/K1x5d1H.png"
-
     try:
-        import replicate
-        os.environ["REPLICATE_API_TOKEN"] = config.REPLICATE_API_TOKEN
-
-        # Промпт для очистки пространства - без стилей и дополнительных вводных
-        prompt = (
-            "Empty room interior with clean walls, floor and ceiling only, "
-            "no furniture, no objects, no decorations, bare space, "
-            "architectural photography, 4K, high quality"
-        )
-        logger.info("🧽 Очистка пространства...")
-
-        output = replicate.run(
-            MODEL_ID,
-            input={
-                "prompt": prompt,
-                "steps": 25,
-                "width": 1024,
-                "height": 1024,
-                "guidance": 3,
-                "aspect_ratio": "1:1",
-                "output_format": "webp",
-                "output_quality": 85,
-            }
-        )
-
-        if output:
-            try:
-                return output.url()
-            except:
-                return str(output)
-        return None
-
+        prediction = await start_clear_space_prediction(photo_file_id, bot)
     except Exception as e:
         logger.error(f"❌ Ошибка очистки: {e}")
         return None
+    return await get_prediction_result(prediction)
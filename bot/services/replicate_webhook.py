@@ -0,0 +1,90 @@
+# bot/services/replicate_webhook.py
+# --- СОЗДАН: 2025-12-08 - HTTP-эндпоинт для вебхуков Replicate о завершении предсказаний ---
+# [2025-12-08] Подпись проверяется всегда: без REPLICATE_WEBHOOK_SECRET сервер не запускается
+"""
+Небольшой aiohttp-сервер, принимающий вебхуки Replicate (webhook_events_filter=["completed"]).
+Полученное предсказание передается в replicate_client.resolve(), который будит ожидающую задачу.
+
+Подпись каждого запроса проверяется по заголовкам webhook-id / webhook-timestamp /
+webhook-signature (HMAC-SHA256, секрет REPLICATE_WEBHOOK_SECRET). Без секрета сервер не запускается:
+вебхук завершает ожидающее предсказание, и неподписанный запрос подменил бы URL результата.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import time
+from aiohttp import web
+
+from services.replicate_api import replicate_client
+
+logger = logging.getLogger(__name__)
+
+# Допустимое расхождение времени подписи (защита от повторной отправки)
+SIGNATURE_TOLERANCE = 300
+
+
+def sign(secret: str, webhook_id: str, timestamp: str, body: bytes) -> str:
+    """Подпись вебхука (base64 HMAC-SHA256 от "id.timestamp.body"); ValueError — секрет не base64"""
+    key = base64.b64decode(secret.split("_", 1)[1] if secret.startswith("whsec_") else secret)
+    signed_content = f"{webhook_id}.{timestamp}.".encode() + body
+    return base64.b64encode(hmac.new(key, signed_content, hashlib.sha256).digest()).decode()
+
+
+def verify_signature(secret: str, headers, body: bytes) -> bool:
+    """Проверить подпись вебхука Replicate"""
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature")
+    if not webhook_id or not timestamp or not signatures:
+        return False
+
+    try:
+        if abs(time.time() - int(timestamp)) > SIGNATURE_TOLERANCE:
+            return False
+        expected = sign(secret, webhook_id, timestamp, body)
+    except ValueError:
+        return False
+
+    # В заголовке может быть несколько подписей: "v1,<sig> v1,<sig2>"
+    for item in signatures.split():
+        _, _, signature = item.partition(",")
+        if hmac.compare_digest(signature, expected):
+            return True
+    return False
+
+
+def make_app(path: str, secret: str) -> web.Application:
+    """Приложение с единственным маршрутом POST {path}; запросы без верной подписи отклоняются"""
+    if not secret:
+        raise ValueError("Для вебхуков Replicate нужен REPLICATE_WEBHOOK_SECRET")
+
+    async def handle(request: web.Request) -> web.Response:
+        body = await request.read()
+        if not verify_signature(secret, request.headers, body):
+            logger.warning("Вебхук Replicate с неверной подписью отклонен")
+            return web.Response(status=401)
+
+        try:
+            prediction = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+
+        waited = replicate_client.resolve(prediction)
+        logger.debug(f"Вебхук Replicate: {prediction.get('id')} {prediction.get('status')} (ожидали: {waited})")
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    return app
+
+
+async def start_webhook_server(host: str, port: int, path: str, secret: str) -> web.AppRunner:
+    """Запустить сервер вебхуков. Остановка — await runner.cleanup()"""
+    runner = web.AppRunner(make_app(path, secret))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Вебхуки Replicate принимаются на {host}:{port}{path}")
+    return runner
@@ -0,0 +1,180 @@
+# bot/services/result_cache.py
+# --- СОЗДАН: 2025-12-08 - Кэш результатов генерации (фото + комната + стиль + параметры модели) ---
+# [2025-12-08] Битая или чужая запись на диске — промах (файл удаляется), а не исключение из get()
+"""
+Контентно-адресуемый кэш результатов генерации.
+
+Ключ — хэш от file_unique_id исходного фото, комнаты, стиля, промпта, модели и ее параметров
+(см. replicate_api.design_cache_key / clear_space_cache_key): повторный клик того же стиля
+на том же фото отдается сразу, без вызова модели и без списания токена.
+
+Два уровня:
+- память: LRU на max_entries записей;
+- диск: по JSON-файлу на ключ в disk_dir (переживает перезапуск), не больше disk_max_entries.
+Запись живет ttl секунд (по умолчанию меньше часа — столько Replicate хранит выходные файлы).
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(**parts: Any) -> str:
+    """Стабильный ключ из произвольных JSON-сериализуемых частей"""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, ttl: float = 3000, max_entries: int = 1000,
+                 disk_dir: Optional[str] = None, disk_max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+
+        # key -> (expires_at, value)
+        self._memory: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._metrics = {'hits_memory': 0, 'hits_disk': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._disk_writes = 0
+
+    # ===== ЧТЕНИЕ / ЗАПИСЬ =====
+
+    async def get(self, key: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Запись кэша (dict) или None"""
+        if not key:
+            return None
+
+        now = time.time()
+        item = self._memory.get(key)
+        if item:
+            expires_at, value = item
+            if expires_at > now:
+                self._memory.move_to_end(key)
+                self._metrics['hits_memory'] += 1
+                return value
+            del self._memory[key]
+
+        if self.disk_dir:
+            item = await asyncio.to_thread(self._disk_read, key)
+            if item and item[0] > now:
+                self._remember(key, *item)
+                self._metrics['hits_disk'] += 1
+                return item[1]
+
+        self._metrics['misses'] += 1
+        return None
+
+    async def put(self, key: Optional[str], value: Dict[str, Any]):
+        """Сохранить результат (например {'url': ...}) на ttl секунд"""
+        if not key:
+            return
+
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, value)
+        self._metrics['stores'] += 1
+        if self.disk_dir:
+            await asyncio.to_thread(self._disk_write, key, expires_at, value)
+
+    async def invalidate(self, key: Optional[str]):
+        """Удалить запись (например, если URL результата уже недоступен)"""
+        if not key:
+            return
+
+        self._memory.pop(key, None)
+        if self.disk_dir:
+            await asyncio.to_thread(self._disk_remove, key)
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики для админки"""
+        hits = self._metrics['hits_memory'] + self._metrics['hits_disk']
+        total = hits + self._metrics['misses']
+        return {
+            **self._metrics,
+            'hits': hits,
+            'hit_rate': round(hits / total * 100, 1) if total else 0.0,
+            'memory_entries': len(self._memory),
+        }
+
+    def _remember(self, key: str, expires_at: float, value: Dict[str, Any]):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._metrics['evictions'] += 1
+
+    # ===== ДИСКОВЫЙ УРОВЕНЬ (выполняется в потоке) =====
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_read(self, key: str) -> Optional[tuple[float, Dict[str, Any]]]:
+        """(expires_at, value) с диска; битая или чужая запись — промах, файл удаляется"""
+        path = self._disk_path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                item = json.load(f)
+            expires_at, value = float(item['expires_at']), item['value']
+            if not isinstance(value, dict):
+                raise TypeError(f"value — {type(value).__name__}, а не объект")
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.debug(f"Кэш результатов: не прочитать запись {key}: {e}")
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Кэш результатов: битая запись {key} удалена: {e!r}")
+            self._disk_remove(key)
+            return None
+
+        if expires_at <= time.time():
+            self._disk_remove(key)
+            return None
+        return expires_at, value
+
+    def _disk_write(self, key: str, expires_at: float, value: Dict[str, Any]):
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            tmp_path = self._disk_path(key) + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'expires_at': expires_at, 'value': value}, f, ensure_ascii=False)
+            os.replace(tmp_path, self._disk_path(key))
+
+            # Каталог сканируем не на каждую запись
+            self._disk_writes += 1
+            if self._disk_writes % 100 == 0:
+                self._disk_evict()
+        except OSError as e:
+            logger.error(f"Кэш результатов: ошибка записи на диск: {e}")
+
+    def _disk_remove(self, key: str):
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _disk_evict(self):
+        """Оставить на диске не больше disk_max_entries самых свежих записей"""
+        with os.scandir(self.disk_dir) as entries:
+            files = [entry for entry in entries if entry.name.endswith('.json')]
+        if len(files) <= self.disk_max_entries:
+            return
+
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - self.disk_max_entries]:
+            try:
+                os.remove(entry.path)
+                self._metrics['evictions'] += 1
+            except OSError:
+                pass
+
+
+# Создаем глобальный экземпляр (параметры выставляются в main.py)
+result_cache = ResultCache()
@@ -40,6 +40,17 @@ NO_BALANCE_TEXT = (
     "⚠️ У вас закончились бесплатные генерации.\n"
     "Пожалуйста, пополните баланс, чтобы продолжить работу."
 )
+GENERATION_QUEUE_TEXT = (
+    "⏳ Вы в очереди на генерацию: **{position}**\n"
+    "Начнем автоматически, как только освободится место."
+)
+GENERATION_QUEUE_FULL_TEXT = "⚠️ Сейчас слишком много генераций. Попробуйте через минуту."
+DEBIT_ERROR_TEXT = "⚠️ Не удалось списать генерацию. Баланс не изменился, попробуйте через минуту."
+PREVIEW_GRID_PROGRESS_TEXT = "⏳ Создаю варианты дизайна сразу в нескольких стилях ({count})..."
+PREVIEW_GRID_DONE_TEXT = (
+    "🖼 Готово! Варианты дизайна — выше.\n"
+    "Следующие стили ({size} шт.) — {price} ген."
+)
 TOO_MANY_PHOTOS_TEXT = (
     "⚠️ Вы отправили сразу несколько фотографий (альбомом). "
     "Пожалуйста, отправьте **только одно фото** комнаты за раз."
@@ -0,0 +1,23 @@
+"""Общие фикстуры тестов: временная БД со всеми миграциями"""
+import asyncio
+
+import pytest
+
+from database.db import Database
+
+
+def init_database(path: str):
+    """Создать БД как при запуске бота: таблицы, миграции, дефолтные настройки"""
+    async def init():
+        db = Database(path, readers=1)
+        await db.init_db()
+        await db.close()
+
+    asyncio.run(init())
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "test.db")
+    init_database(path)
+    return path
@@ -0,0 +1,42 @@
+"""Локальные фейковые провайдеры генерации для тестов роутера и очереди"""
+import asyncio
+from typing import List, Optional
+
+from services.providers import ImageProvider, ProviderError, RenderRequest
+
+
+class FakeProvider(ImageProvider):
+    """
+    Рендер за delay секунд. outcomes — сценарий по запускам: 'ok', 'fail' или 'slow' (slow_delay секунд);
+    когда сценарий кончился, повторяется последний исход.
+    """
+
+    def __init__(self, name: str, outcomes: Optional[List[str]] = None, delay: float = 0.01,
+                 slow_delay: float = 1.0, cost: float = 0.01):
+        self.name = name
+        self.outcomes = outcomes or ['ok']
+        self.delay = delay
+        self.slow_delay = slow_delay
+        self.price = cost
+        self.started = 0
+        self.cancelled = 0
+
+    def model_id(self, request: RenderRequest) -> str:
+        return f"{self.name}-model"
+
+    def cost(self, request: RenderRequest) -> float:
+        return self.price
+
+    async def start(self, request, bot):
+        outcome = self.outcomes[min(self.started, len(self.outcomes) - 1)]
+        self.started += 1
+        return {"n": self.started, "outcome": outcome}
+
+    async def result(self, handle):
+        await asyncio.sleep(self.slow_delay if handle["outcome"] == 'slow' else self.delay)
+        if handle["outcome"] == 'fail':
+            raise ProviderError("fake failure")
+        return f"https://{self.name}.example/{handle['n']}.png"
+
+    async def cancel(self, handle):
+        self.cancelled += 1
@@ -0,0 +1,85 @@
+"""Буфер аналитики: ошибка записи пачки не теряет события — они пишутся следующим сбросом"""
+import asyncio
+import sqlite3
+from contextlib import contextmanager
+
+from database.db import Database
+
+USER_ID = 7
+
+
+@contextmanager
+def failing_inserts(db_path, table):
+    """Пока контекст открыт, любая вставка в table падает (как сбой записи БД)"""
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(f"CREATE TRIGGER fail_{table} BEFORE INSERT ON {table} BEGIN SELECT RAISE(ABORT, 'disk I/O error'); END")
+    try:
+        yield
+    finally:
+        with sqlite3.connect(db_path) as conn:
+            conn.execute(f"DROP TRIGGER fail_{table}")
+
+
+def query(db_path, sql):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(sql).fetchall()
+
+
+def test_activity_survives_write_error(db_path):
+    async def scenario():
+        database = Database(db_path, analytics_sync=True)
+        await database.create_user(USER_ID, "user")
+        with failing_inserts(db_path, "user_activity"):
+            assert not await database.log_activity(USER_ID, "start")
+            failed = query(db_path, "SELECT COUNT(*) FROM user_activity")[0][0]
+        assert await database.log_activity(USER_ID, "menu")
+        await database.close()
+        return failed
+
+    assert asyncio.run(scenario()) == 0
+    assert query(db_path, f"SELECT action_type FROM user_activity WHERE user_id = {USER_ID} ORDER BY id") == [
+        ("start",), ("menu",)
+    ]
+    assert query(db_path, f"SELECT last_activity IS NOT NULL FROM users WHERE user_id = {USER_ID}") == [(1,)]
+
+
+def test_background_flush_retries(db_path):
+    async def scenario():
+        database = Database(db_path, activity_flush_interval=0.05)
+        await database.create_user(USER_ID, "user")
+        with failing_inserts(db_path, "user_activity"):
+            await database.log_activity(USER_ID, "start")
+            await asyncio.sleep(0.08)
+        # Повторный сброс запланирован сам, без новых событий
+        await asyncio.sleep(0.1)
+        rows = query(db_path, "SELECT COUNT(*) FROM user_activity")[0][0]
+        await database.close()
+        return rows
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_generations_survive_write_error(db_path):
+    async def scenario():
+        database = Database(db_path, analytics_sync=True)
+        await database.create_user(USER_ID, "user")
+        with failing_inserts(db_path, "generations"):
+            assert not await database.log_generation(USER_ID, "kitchen", "modern", model_id="m", duration_ms=900)
+            assert not await database.log_generation(USER_ID, "kitchen", "loft", success=False)
+            # Ничего не записано наполовину: транзакция откачена целиком
+            failed = query(db_path, f"SELECT total_generations FROM users WHERE user_id = {USER_ID}")[0][0]
+            failed_stats = query(db_path, "SELECT COUNT(*) FROM daily_stats WHERE metric LIKE 'generat%'")[0][0]
+        assert await database.flush_activity()
+        await database.close()
+        return failed, failed_stats
+
+    assert asyncio.run(scenario()) == (0, 0)
+    assert query(db_path, "SELECT style_type, success, model_id, duration_ms FROM generations ORDER BY id") == [
+        ("modern", 1, "m", 900), ("loft", 0, None, None)
+    ]
+    assert query(db_path, f"SELECT total_generations FROM users WHERE user_id = {USER_ID}") == [(2,)]
+    stats = dict(query(db_path, "SELECT metric || ':' || dim, value FROM daily_stats WHERE metric != 'new_users'"))
+    assert stats == {
+        "generations:": 2, "generations_failed:": 1, "generating_users:": 1,
+        "room:kitchen": 2, "style:modern": 1, "style:loft": 1,
+    }
@@ -0,0 +1,127 @@
+"""Списание генераций: атомарность при одновременных списаниях и возврат при неудачной генерации"""
+import asyncio
+import sqlite3
+from unittest.mock import AsyncMock, MagicMock
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from database.db import Database, db
+from fakes import FakeProvider
+
+USER_ID = 42
+
+
+def ledger(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute(
+            "SELECT reason, delta FROM balance_ledger WHERE user_id = ? AND reason != 'opening' ORDER BY id",
+            (USER_ID,)
+        ).fetchall()
+
+
+def test_concurrent_debits(db_path):
+    async def scenario():
+        database = Database(db_path)
+        await database.create_user(USER_ID, "debit")
+        await database.add_tokens(USER_ID, 10 - await database.get_balance(USER_ID))
+
+        results = await asyncio.gather(*(database.debit_balance(USER_ID) for _ in range(100)))
+
+        database.invalidate_balance(USER_ID)
+        final = await database.get_balance(USER_ID)
+        await database.close()
+        return results, final
+
+    results, final = asyncio.run(scenario())
+    assert sum(1 for r in results if r is not None) == 10
+    assert sorted(r for r in results if r is not None) == list(range(10))
+    assert final == 0
+    assert sum(delta for _, delta in ledger(db_path)) == 0
+
+
+def test_failed_generation_refunds(db_path, monkeypatch):
+    from handlers import creation
+    from services.generation_queue import generation_scheduler
+    from services.providers import generation_router
+
+    monkeypatch.setattr(db, "db_path", db_path)
+    monkeypatch.setattr(db, "analytics_sync", True)
+    monkeypatch.setattr(generation_router, "providers", [FakeProvider("a", ['fail']), FakeProvider("b", ['fail'])])
+
+    callback = MagicMock()
+    callback.data = "style_modern"
+    callback.from_user.id = USER_ID
+    callback.message.chat.id = USER_ID
+    callback.message.bot = AsyncMock()
+    callback.message.answer = AsyncMock(return_value=MagicMock(message_id=1))
+    callback.answer = AsyncMock()
+
+    async def scenario():
+        try:
+            await db.create_user(USER_ID, "render")
+            balance = await db.get_balance(USER_ID)
+            await generation_scheduler.start(bot=None)
+            state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=USER_ID, user_id=USER_ID))
+            await state.update_data(photo_id="file_1", room="living_room")
+            try:
+                await creation.style_chosen(callback, state, admins=[], bot_token="1:a")
+            finally:
+                await generation_scheduler.stop()
+            db.invalidate_balance(USER_ID)
+            return balance, await db.get_balance(USER_ID)
+        finally:
+            await db.close()
+
+    balance, after = asyncio.run(scenario())
+    assert after == balance
+    assert ledger(db_path)[-2:] == [("generation", -1), ("refund", 1)]
+
+
+def test_debit_error_is_not_no_balance(db_path, monkeypatch):
+    """Ошибка БД при списании — исключение и предупреждение, а не экран «нет генераций»"""
+    from handlers import creation
+    from services.providers import generation_router
+    from utils.texts import DEBIT_ERROR_TEXT
+
+    provider = FakeProvider("a")
+    monkeypatch.setattr(db, "db_path", db_path)
+    monkeypatch.setattr(generation_router, "providers", [provider])
+
+    callback = MagicMock()
+    callback.data = "style_modern"
+    callback.from_user.id = USER_ID
+    callback.message.chat.id = USER_ID
+    callback.message.answer = AsyncMock(return_value=MagicMock(message_id=1))
+    callback.answer = AsyncMock()
+
+    async def scenario():
+        try:
+            await db.create_user(USER_ID, "locked")
+            balance = await db.get_balance(USER_ID)
+            with sqlite3.connect(db_path) as conn:
+                conn.execute(
+                    "CREATE TRIGGER fail_ledger BEFORE INSERT ON balance_ledger "
+                    "BEGIN SELECT RAISE(ABORT, 'database is locked'); END"
+                )
+            try:
+                await db.debit_balance(USER_ID)
+            except Exception as e:
+                raised = e
+            else:
+                raised = None
+            state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=USER_ID, user_id=USER_ID))
+            await state.update_data(photo_id="file_1", room="living_room")
+            await creation.style_chosen(callback, state, admins=[], bot_token="1:a")
+            db.invalidate_balance(USER_ID)
+            return raised, balance, await db.get_balance(USER_ID)
+        finally:
+            await db.close()
+
+    raised, balance, after = asyncio.run(scenario())
+    assert raised is not None
+    assert after == balance
+    callback.answer.assert_awaited_once_with(DEBIT_ERROR_TEXT, show_alert=True)
+    callback.message.answer.assert_not_called()
+    assert provider.started == 0
@@ -0,0 +1,84 @@
+"""Суточные агрегаты дашборда: пересчет generating_users и активные пользователи"""
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+
+from database.db import Database
+
+
+def test_generating_users_by_first_generation_day(db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("INSERT INTO users (user_id, total_generations, created_at) VALUES (1, 2, '2025-01-01 10:00:00')")
+        conn.executemany(
+            "INSERT INTO generations (user_id, room_type, style_type, created_at) VALUES (1, 'kitchen', 'loft', ?)",
+            [('2025-01-05 09:00:00',), ('2025-01-07 09:00:00',)]
+        )
+        # Как после миграции 7: пользователь учтен в день регистрации
+        conn.execute("INSERT INTO daily_stats (day, metric, value) VALUES ('2025-01-01', 'generating_users', 1)")
+        conn.execute("DELETE FROM schema_version WHERE version = 11")
+
+    async def migrate():
+        database = Database(db_path, readers=1)
+        await database.init_db()
+        await database.close()
+
+    asyncio.run(migrate())
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute("SELECT day, value FROM daily_stats WHERE metric = 'generating_users'").fetchall()
+    assert rows == [('2025-01-05', 1)]
+
+
+def test_active_users(db_path):
+    now = datetime.utcnow()
+    with sqlite3.connect(db_path) as conn:
+        conn.executemany("INSERT INTO users (user_id, last_activity) VALUES (?, ?)", [
+            (1, now.strftime('%Y-%m-%d %H:%M:%S')),
+            (2, (now - timedelta(days=3)).strftime('%Y-%m-%d %H:%M:%S')),
+            (3, (now - timedelta(days=30)).strftime('%Y-%m-%d %H:%M:%S')),
+        ])
+
+    async def stats():
+        database = Database(db_path, readers=1)
+        try:
+            return await database.get_daily_stats()
+        finally:
+            await database.close()
+
+    active = asyncio.run(stats())['active_users']
+    assert active == {'total': 0, 'today': 1, 'week': 2}
+
+
+def test_backfill_skips_rows_without_date(tmp_path):
+    """Миграции 7 и 11 на старой БД: строки без created_at или с мусорной датой не ломают пересчет"""
+    from conftest import init_database
+    from database.models import CREATE_GENERATIONS_TABLE, CREATE_PAYMENTS_TABLE, CREATE_USERS_TABLE
+
+    path = str(tmp_path / "legacy.db")
+    with sqlite3.connect(path) as conn:
+        for statement in (CREATE_USERS_TABLE, CREATE_GENERATIONS_TABLE, CREATE_PAYMENTS_TABLE):
+            conn.execute(statement)
+        conn.executemany("INSERT INTO users (user_id, total_generations, created_at) VALUES (?, 1, ?)", [
+            (1, None), (2, 'not a date'), (3, '2025-01-02 10:00:00'),
+        ])
+        conn.executemany(
+            "INSERT INTO generations (user_id, room_type, style_type, created_at) VALUES (?, 'kitchen', 'loft', ?)",
+            [(1, None), (2, 'not a date'), (3, '2025-01-03 10:00:00')]
+        )
+        conn.executemany(
+            "INSERT INTO payments (user_id, yookassa_payment_id, amount, tokens, status, created_at) "
+            "VALUES (?, ?, 100, 10, 'succeeded', ?)",
+            [(1, 'p1', None), (3, 'p3', '2025-01-04 10:00:00')]
+        )
+
+    init_database(path)
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute(
+            "SELECT day, metric, value FROM daily_stats WHERE dim = '' ORDER BY day, metric"
+        ).fetchall()
+    assert rows == [
+        ('2025-01-02', 'new_users', 1),
+        ('2025-01-03', 'generating_users', 1),
+        ('2025-01-03', 'generations', 1),
+        ('2025-01-04', 'payments', 1),
+        ('2025-01-04', 'revenue', 100),
+    ]
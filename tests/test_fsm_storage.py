@@ -0,0 +1,128 @@
+"""Хранилища FSM: SQLite (персистентность, объединение записей) и Redis (если доступен локальный сервер)"""
+import asyncio
+import os
+import uuid
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from database.db import Database
+from database.fsm_storage import SQLiteStorage, create_fsm_storage
+
+KEY = StorageKey(bot_id=1, chat_id=100, user_id=100)
+
+
+def test_sqlite_round_trip(db_path):
+    async def write():
+        database = Database(db_path, readers=1)
+        storage = SQLiteStorage(database, flush_interval=10)
+        await storage.set_state(KEY, "CreationStates:choose_style")
+        await storage.set_data(KEY, {"photo_id": "file_1"})
+        await storage.update_data(KEY, {"room": "kitchen"})
+        # close сбрасывает накопленное, не дожидаясь flush_interval
+        await storage.close()
+        await database.close()
+
+    async def read():
+        database = Database(db_path, readers=1)
+        storage = SQLiteStorage(database)
+        try:
+            return await storage.get_state(KEY), await storage.get_data(KEY)
+        finally:
+            await storage.close()
+            await database.close()
+
+    asyncio.run(write())
+    state, data = asyncio.run(read())
+    assert state == "CreationStates:choose_style"
+    assert data == {"photo_id": "file_1", "room": "kitchen"}
+
+
+def test_sqlite_coalesces_writes(db_path):
+    async def scenario():
+        database = Database(db_path, readers=1)
+        saved = []
+        save = database.save_fsm_records
+
+        async def spy(records):
+            saved.append(list(records))
+            return await save(records)
+
+        database.save_fsm_records = spy
+        storage = SQLiteStorage(database, flush_interval=0.05)
+        other = StorageKey(bot_id=1, chat_id=200, user_id=200)
+        for i in range(20):
+            await storage.update_data(KEY, {"step": i})
+        await storage.set_state(other, "CreationStates:choose_room")
+        await asyncio.sleep(0.2)
+        await storage.close()
+        record = await database.get_fsm_record(storage.key_builder.build(KEY))
+        await database.close()
+        return saved, record
+
+    saved, record = asyncio.run(scenario())
+    # 21 изменение двух ключей — одна запись в БД
+    assert len(saved) == 1
+    assert len(saved[0]) == 2
+    assert record[1] == '{"step": 19}'
+
+
+def test_eviction_during_failed_flush(db_path):
+    """Ключ, который пишется в БД, не вытесняется; после неудачного сброса следующий его сохраняет"""
+    async def scenario():
+        database = Database(db_path, readers=1)
+        storage = SQLiteStorage(database, flush_interval=10, max_entries=1)
+        other = StorageKey(bot_id=1, chat_id=200, user_id=200)
+        save = database.save_fsm_records
+        calls = []
+
+        async def failing_once(records):
+            calls.append(records)
+            if len(calls) == 1:
+                # Пока сброс ждет БД, другой апдейт загружает новый ключ и запускает вытеснение
+                await storage.get_state(other)
+                return False
+            return await save(records)
+
+        database.save_fsm_records = failing_once
+        try:
+            await storage.update_data(KEY, {"photo_id": "file_1"})
+            await storage.flush()
+            await storage.flush()
+            return calls, await database.get_fsm_record(storage.key_builder.build(KEY))
+        finally:
+            await storage.close()
+            await database.close()
+
+    calls, record = asyncio.run(scenario())
+    assert len(calls) == 2 and [r[0] for r in calls[1]] == [r[0] for r in calls[0]]
+    assert record[1] == '{"photo_id": "file_1"}'
+
+
+def test_redis_round_trip():
+    redis = pytest.importorskip("redis.asyncio")
+    url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+    async def scenario():
+        client = redis.from_url(url)
+        try:
+            await client.ping()
+        except Exception:
+            pytest.skip(f"нет локального Redis ({url})")
+        finally:
+            await client.aclose()
+
+        storage = create_fsm_storage("redis", None, redis_url=url)
+        key = StorageKey(bot_id=1, chat_id=uuid.uuid4().int % 10 ** 9, user_id=1)
+        try:
+            await storage.set_state(key, "CreationStates:choose_style")
+            await storage.update_data(key, {"photo_id": "file_1"})
+            return await storage.get_state(key), await storage.get_data(key)
+        finally:
+            await storage.set_state(key, None)
+            await storage.set_data(key, {})
+            await storage.close()
+
+    state, data = asyncio.run(scenario())
+    assert state == "CreationStates:choose_style"
+    assert data == {"photo_id": "file_1"}
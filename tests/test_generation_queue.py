@@ -0,0 +1,75 @@
+"""Очередь генераций: future задачи завершается при любом исходе"""
+import asyncio
+
+import pytest
+
+from database.db import db
+from fakes import FakeProvider
+from services.generation_queue import GenerationScheduler
+from services.providers import generation_router
+
+
+@pytest.fixture
+def scheduler_env(db_path, monkeypatch):
+    monkeypatch.setattr(db, "db_path", db_path)
+    monkeypatch.setattr(db, "analytics_sync", True)
+    monkeypatch.setattr(generation_router, "providers", [FakeProvider("fake", delay=0.05)])
+
+
+def run(scenario):
+    async def wrapper():
+        try:
+            return await scenario()
+        finally:
+            await db.close()
+
+    return asyncio.run(wrapper())
+
+
+def test_job_result(scheduler_env):
+    async def scenario():
+        scheduler = GenerationScheduler(workers=1)
+        await scheduler.start(bot=None)
+        job = await scheduler.submit(1, 1, "design", "file_id", "living_room", "modern")
+        url = await asyncio.wait_for(job.future, 5)
+        await scheduler.stop()
+        return url, job
+
+    url, job = run(scenario)
+    assert url.startswith("https://fake.example/")
+    assert job.model_id == "fake-model"
+
+
+def test_finish_error_resolves_future(scheduler_env, monkeypatch):
+    async def broken_finish(*args, **kwargs):
+        raise RuntimeError("database is locked")
+
+    async def scenario():
+        scheduler = GenerationScheduler(workers=1)
+        await scheduler.start(bot=None)
+        monkeypatch.setattr(db, "finish_generation_job", broken_finish)
+        job = await scheduler.submit(1, 1, "design", "file_id", "living_room", "modern", fast_preview=True)
+        # Хэндлер получает None (и возвращает списание), а не ждет вечно
+        result = await asyncio.wait_for(job.future, 5)
+        await scheduler.stop()
+        return result, job
+
+    result, job = run(scenario)
+    assert result is None
+    assert job.preview_future.done()
+
+
+def test_stop_cancels_pending_futures(scheduler_env):
+    async def scenario():
+        generation_router.providers[0].delay = 10
+        scheduler = GenerationScheduler(workers=1)
+        await scheduler.start(bot=None)
+        running = await scheduler.submit(1, 1, "design", "file_id", "living_room", "modern")
+        queued = await scheduler.submit(1, 1, "design", "file_id", "living_room", "scandinavian")
+        await asyncio.sleep(0.1)
+        await scheduler.stop()
+        return running, queued
+
+    running, queued = run(scenario)
+    assert running.future.cancelled()
+    assert queued.future.cancelled()
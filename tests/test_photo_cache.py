@@ -0,0 +1,50 @@
+"""Кэш фото: учет размера дискового уровня при параллельных вытеснениях"""
+import asyncio
+import os
+
+from services.photo_cache import PhotoCache
+
+PHOTO = b"x" * 1000
+
+
+def disk_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if name.endswith('.jpg'))
+
+
+def test_concurrent_spills_keep_disk_accounting(tmp_path):
+    # Память — одно фото: каждый put вытесняет предыдущее на диск в отдельном потоке
+    cache = PhotoCache(memory_bytes=len(PHOTO), disk_dir=str(tmp_path), disk_max_bytes=50 * len(PHOTO))
+
+    async def scenario():
+        for _ in range(5):
+            await asyncio.gather(*(cache.put(f"photo{i}", PHOTO) for i in range(200)))
+
+    asyncio.run(scenario())
+    assert cache._disk_used == disk_size(tmp_path)
+    assert cache._disk_used <= cache.disk_max_bytes
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_concurrent_first_spills_count_disk_once(tmp_path):
+    # Размер диска считается при первом вытеснении; параллельные вытеснения не должны его затереть
+    for i in range(3000):
+        (tmp_path / f"old{i}.jpg").write_bytes(PHOTO)
+    cache = PhotoCache(memory_bytes=len(PHOTO), disk_dir=str(tmp_path), disk_max_bytes=10 ** 9)
+
+    async def scenario():
+        await asyncio.gather(*(cache.put(f"photo{i}", PHOTO) for i in range(200)))
+
+    asyncio.run(scenario())
+    assert cache._disk_used == disk_size(tmp_path)
+
+
+def test_disk_hit_after_eviction_from_memory(tmp_path):
+    cache = PhotoCache(memory_bytes=len(PHOTO), disk_dir=str(tmp_path))
+
+    async def scenario():
+        await cache.put("a", PHOTO)
+        await cache.put("b", b"y" * 1000)
+        return await cache.get("a")
+
+    assert asyncio.run(scenario()) == PHOTO
+    assert cache.stats()['hits_disk'] == 1
@@ -0,0 +1,92 @@
+"""Превью-сетка: оплачиваются только стили без кэша, возврат — от списанного"""
+import asyncio
+import sqlite3
+from unittest.mock import AsyncMock, MagicMock
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from database.db import db
+from fakes import FakeProvider
+
+USER_ID = 42
+
+
+def test_grid_charge_and_refund():
+    from handlers.creation import grid_charge, grid_refund
+
+    assert grid_charge(3, 4, 4) == 3
+    assert grid_charge(3, 1, 4) == 1
+    assert grid_charge(3, 3, 4) == 3
+    assert grid_charge(3, 0, 4) == 0
+    assert grid_refund(1, 1, 1) == 1
+    assert grid_refund(3, 4, 1) == 1
+    assert grid_refund(3, 4, 4) == 3
+    assert grid_refund(2, 2, 0) == 0
+
+
+def run_grid(db_path, monkeypatch, cached_styles, outcomes):
+    from handlers import creation
+    from services.generation_queue import generation_scheduler
+    from services.providers import generation_router
+    from services.replicate_api import design_cache_key
+    from services.result_cache import ResultCache
+
+    cache = ResultCache()
+    provider = FakeProvider("main", outcomes)
+    monkeypatch.setattr(db, "db_path", db_path)
+    monkeypatch.setattr(db, "analytics_sync", True)
+    monkeypatch.setattr(generation_router, "providers", [provider])
+    monkeypatch.setattr(creation, "result_cache", cache)
+    monkeypatch.setattr(creation.result_delivery, "send_media_group",
+                        AsyncMock(side_effect=lambda bot, chat_id, items, **kw: [None] * len(items)))
+
+    callback = MagicMock()
+    callback.data = "preview_grid"
+    callback.from_user.id = USER_ID
+    callback.message.chat.id = USER_ID
+    callback.message.bot = AsyncMock()
+    callback.message.answer = AsyncMock(return_value=MagicMock(message_id=1))
+    callback.answer = AsyncMock()
+
+    async def scenario():
+        try:
+            await db.create_user(USER_ID, "grid")
+            await db.add_tokens(USER_ID, 10)
+            styles, _ = creation.next_grid_styles(0)
+            for style in styles[:cached_styles]:
+                key = design_cache_key("unique_1", "living_room", style, provider.model_id(None))
+                await cache.put(key, {'url': f"https://cached.example/{style}.png"})
+            await generation_scheduler.start(bot=None)
+            state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=USER_ID, user_id=USER_ID))
+            await state.update_data(photo_id="file_1", photo_unique_id="unique_1", room="living_room")
+            try:
+                await creation.preview_grid_handler(callback, state, admins=[])
+            finally:
+                await generation_scheduler.stop()
+            return provider.started
+        finally:
+            await db.close()
+
+    started = asyncio.run(scenario())
+    with sqlite3.connect(db_path) as conn:
+        ledger = conn.execute(
+            "SELECT reason, delta FROM balance_ledger WHERE user_id = ? AND reason IN ('preview_grid', 'refund')"
+            " ORDER BY id", (USER_ID,)
+        ).fetchall()
+    return started, ledger
+
+
+def test_partially_cached_grid_charges_missing_share(db_path, monkeypatch):
+    # Сетка из 4 стилей по цене 3: три в кэше — рендерится и оплачивается один (ceil(3 * 1 / 4) = 1)
+    started, ledger = run_grid(db_path, monkeypatch, cached_styles=3, outcomes=['ok'])
+    assert started == 1
+    assert ledger == [('preview_grid', -1)]
+
+
+def test_failed_styles_refund_from_charged(db_path, monkeypatch):
+    # Два стиля рендерятся (списано ceil(3 * 2 / 4) = 2), один не удался — возврат 1, а не ceil(3 / 2) = 2
+    started, ledger = run_grid(db_path, monkeypatch, cached_styles=2, outcomes=['ok', 'fail'])
+    assert started == 2
+    assert ledger == [('preview_grid', -2), ('refund', 1)]
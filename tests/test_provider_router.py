@@ -0,0 +1,104 @@
+"""Роутер провайдеров: фоллбэк, предохранитель, медленный рендер, хеджирование после p95"""
+import asyncio
+import time
+
+from fakes import FakeProvider
+from services.providers import ProviderRouter, RenderRequest
+
+REQUEST = RenderRequest("modern living room", "file_id")
+
+
+def render(router: ProviderRouter):
+    """Один рендер через роутер; (результат, секунды)"""
+    async def scenario():
+        start = time.monotonic()
+        result = await router.result(await router.start(REQUEST, None))
+        await asyncio.sleep(0)  # фоновые отмены у провайдеров
+        return result, time.monotonic() - start
+
+    return asyncio.run(scenario())
+
+
+def warm_up(router: ProviderRouter, name: str, ms: int, samples: int = 20):
+    for _ in range(samples):
+        router.latency.record(name, ms)
+
+
+def test_fallback_on_error():
+    broken, spare = FakeProvider("broken", ['fail']), FakeProvider("spare")
+    router = ProviderRouter([broken, spare])
+    result, _ = render(router)
+    assert (result.provider, result.model_id) == ("spare", "spare-model")
+    assert abs(result.cost - 0.02) < 1e-9
+    assert router.stats()['fallbacks'] == 1
+
+
+def test_all_failed():
+    router = ProviderRouter([FakeProvider("a", ['fail']), FakeProvider("b", ['fail'])])
+    result, _ = render(router)
+    assert result.url is None and abs(result.cost - 0.02) < 1e-9
+
+
+def test_breaker_opens_and_closes():
+    flaky, spare = FakeProvider("flaky", ['fail', 'fail', 'fail', 'ok']), FakeProvider("spare")
+    router = ProviderRouter([flaky, spare], failure_threshold=3, cooldown=0.2)
+    for _ in range(5):
+        assert render(router)[0].provider == "spare"
+    # Три ошибки подряд открыли предохранитель: еще два рендера обошли провайдера
+    assert flaky.started == 3 and not router.health(flaky).available
+
+    time.sleep(0.2)
+    assert router.health(flaky).available
+    assert render(router)[0].provider == "flaky"
+    assert router.health(flaky).available and router.health(flaky).consecutive_failures == 0
+
+
+def test_breaker_reopens_after_failed_probe():
+    broken, spare = FakeProvider("broken", ['fail']), FakeProvider("spare")
+    router = ProviderRouter([broken, spare], failure_threshold=3, cooldown=0.2)
+    for _ in range(3):
+        render(router)
+    time.sleep(0.2)
+    render(router)
+    assert broken.started == 4 and not router.health(broken).available
+
+
+def test_slow_render_falls_back_and_is_cancelled():
+    stuck, spare = FakeProvider("stuck", ['slow'], slow_delay=5.0), FakeProvider("spare")
+    router = ProviderRouter([stuck, spare], slow_timeout=0.1)
+    result, elapsed = render(router)
+    assert result.provider == "spare" and elapsed < 1.0
+    assert stuck.cancelled == 1
+
+
+def test_hedge_fires_after_p95():
+    main, spare = FakeProvider("main", ['slow'], slow_delay=2.0), FakeProvider("spare")
+    router = ProviderRouter([main, spare], hedge=True, hedge_min_samples=20)
+    warm_up(router, "main", 100)
+
+    result, elapsed = render(router)
+    assert result.provider == "spare"
+    # Второй провайдер подключился не раньше p95 (100 мс) и задолго до конца медленного рендера
+    assert 0.1 <= elapsed < 1.0
+    assert router.stats()['hedged'] == 1 and router.stats()['hedge_wins'] == 1
+    assert main.cancelled == 1
+    assert abs(result.cost - 0.02) < 1e-9
+
+
+def test_no_hedge_before_p95():
+    main, spare = FakeProvider("main", delay=0.01), FakeProvider("spare")
+    router = ProviderRouter([main, spare], hedge=True, hedge_min_samples=20)
+    warm_up(router, "main", 500)
+
+    result, _ = render(router)
+    assert result.provider == "main" and spare.started == 0
+    assert router.stats()['hedged'] == 0
+
+
+def test_no_hedge_without_enough_samples():
+    main, spare = FakeProvider("main", ['slow'], slow_delay=0.3), FakeProvider("spare")
+    router = ProviderRouter([main, spare], hedge=True, hedge_min_samples=20)
+    warm_up(router, "main", 10, samples=19)
+
+    result, _ = render(router)
+    assert result.provider == "main" and spare.started == 0
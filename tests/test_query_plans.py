@@ -0,0 +1,46 @@
+"""EXPLAIN QUERY PLAN для каждого SQL-запроса из models.py: без полного сканирования таблиц"""
+import re
+import sqlite3
+
+import pytest
+
+from conftest import init_database
+from database import models
+
+# Полный проход здесь и есть смысл запроса; таблицы маленькие
+FULL_SCAN_ALLOWED = {
+    'GET_ALL_SETTINGS': 'снимок всех настроек (десятки строк)',
+    'GET_DAILY_STATS_SUMMARY': 'итоги по всем суточным агрегатам (строк — дни x метрики, не события)',
+}
+
+QUERIES = sorted(
+    name for name, value in vars(models).items()
+    if name.isupper() and isinstance(value, str)
+    and re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE)\b', value, re.IGNORECASE)
+)
+
+# «SCAN users» / «SCAN TABLE users» (старые SQLite) — без индекса; «SCAN ... USING INDEX» и
+# поиск по виртуальной таблице FTS (VIRTUAL TABLE INDEX) — с индексом
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?\w+( AS \w+)?$')
+
+
+@pytest.fixture(scope="module")
+def conn(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("plans") / "plans.db")
+    init_database(path)
+    connection = sqlite3.connect(path)
+    yield connection
+    connection.close()
+
+
+def test_queries_found():
+    assert len(QUERIES) > 40
+
+
+@pytest.mark.parametrize("name", QUERIES)
+def test_query_uses_index(conn, name):
+    sql = getattr(models, name)
+    plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count("?"))]
+    scans = [step for step in plan if FULL_SCAN.match(step)]
+    if name not in FULL_SCAN_ALLOWED:
+        assert not scans, f"{name}: полное сканирование {scans}, план: {plan}"
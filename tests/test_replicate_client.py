@@ -0,0 +1,75 @@
+"""ReplicateClient._request: какие ответы повторяются и как читается Retry-After"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from services.replicate_api import ReplicateClient, ReplicateError, _retry_after
+
+
+def run_against(responses):
+    """Поднять локальный сервер, отдающий responses по очереди; вернуть (результат/ошибку, число запросов)"""
+    calls = []
+
+    async def handler(request: web.Request):
+        status, headers = responses[min(len(calls), len(responses) - 1)]
+        calls.append(request.method)
+        if status == 200:
+            return web.json_response({"id": "p1", "status": "starting"})
+        return web.Response(status=status, headers=headers, text="error")
+
+    async def scenario(method):
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", handler)
+        server = TestServer(app)
+        await server.start_server()
+        client = ReplicateClient("token", str(server.make_url("/v1")))
+        try:
+            if method == "POST":
+                return await client.create_prediction("owner/model", {"prompt": "room"})
+            return await client.get_prediction("p1")
+        except ReplicateError as e:
+            return e
+        finally:
+            await client.close()
+            await server.close()
+
+    return lambda method: (asyncio.run(scenario(method)), calls)
+
+
+def test_post_not_retried_on_5xx():
+    result, calls = run_against([(502, {}), (200, {})])("POST")
+    assert isinstance(result, ReplicateError)
+    assert calls == ["POST"]
+
+
+def test_post_retried_on_429_with_http_date():
+    past = format_datetime(datetime.now(timezone.utc) - timedelta(seconds=5), usegmt=True)
+    result, calls = run_against([(429, {"Retry-After": past}), (200, {})])("POST")
+    assert result["id"] == "p1"
+    assert calls == ["POST", "POST"]
+
+
+def test_get_retried_on_5xx():
+    result, calls = run_against([(503, {"Retry-After": "0"}), (200, {})])("GET")
+    assert result["id"] == "p1"
+    assert calls == ["GET", "GET"]
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, 4.0),
+    ("3", 3.0),
+    ("-1", 0.0),
+    ("soon", 4.0),
+    ("Wed, 21 Oct 2015 07:28:00 GMT", 0.0),
+])
+def test_retry_after(value, expected):
+    assert _retry_after(value, 4.0) == expected
+
+
+def test_retry_after_future_date():
+    future = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < _retry_after(future, 4.0) <= 30
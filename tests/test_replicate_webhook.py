@@ -0,0 +1,65 @@
+"""Вебхуки Replicate: без верной подписи предсказание не завершается, без секрета сервер не создается"""
+import asyncio
+import base64
+import json
+import time
+
+import pytest
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+
+from services import replicate_webhook
+from services.replicate_webhook import make_app, sign
+
+SECRET = "whsec_" + base64.b64encode(b"test-secret").decode()
+PATH = "/replicate/webhook"
+BODY = json.dumps({"id": "p1", "status": "succeeded", "output": "https://evil.example/x.png"}).encode()
+
+
+def signed_headers(secret=SECRET, body=BODY, timestamp=None):
+    timestamp = timestamp or str(int(time.time()))
+    return {
+        "webhook-id": "msg_1",
+        "webhook-timestamp": timestamp,
+        "webhook-signature": f"v1,{sign(secret, 'msg_1', timestamp, body)}",
+    }
+
+
+def post(monkeypatch, headers):
+    """POST вебхука на локальный сервер; (статус, предсказания, переданные в resolve)"""
+    resolved = []
+    monkeypatch.setattr(replicate_webhook.replicate_client, "resolve", lambda p: resolved.append(p) or True)
+
+    async def scenario():
+        server = TestServer(make_app(PATH, SECRET))
+        await server.start_server()
+        try:
+            async with ClientSession() as session:
+                async with session.post(server.make_url(PATH), data=BODY, headers=headers) as response:
+                    return response.status
+        finally:
+            await server.close()
+
+    return asyncio.run(scenario()), resolved
+
+
+def test_signed_webhook_resolves(monkeypatch):
+    status, resolved = post(monkeypatch, signed_headers())
+    assert status == 200 and [p["id"] for p in resolved] == ["p1"]
+
+
+@pytest.mark.parametrize("headers", [
+    {},
+    signed_headers(secret="whsec_" + base64.b64encode(b"other").decode()),
+    signed_headers(body=b"{}"),
+    signed_headers(timestamp=str(int(time.time()) - 3600)),
+], ids=["unsigned", "wrong-secret", "other-body", "stale"])
+def test_bad_signature_rejected(monkeypatch, headers):
+    status, resolved = post(monkeypatch, headers)
+    assert status == 401 and resolved == []
+
+
+@pytest.mark.parametrize("secret", [None, ""])
+def test_no_secret_no_server(secret):
+    with pytest.raises(ValueError):
+        make_app(PATH, secret)
@@ -0,0 +1,45 @@
+"""Кэш результатов: битые файлы дискового уровня — промах, а не исключение"""
+import asyncio
+import json
+import time
+
+import pytest
+
+from services.result_cache import ResultCache
+
+KEY = "a" * 64
+
+
+@pytest.mark.parametrize("content", [
+    "{}",
+    "[]",
+    "null",
+    '{"expires_at": "soon", "value": {}}',
+    '{"expires_at": 1e12}',
+    '{"expires_at": 1e12, "value": ["url"]}',
+    '{"expires_at": 1e12, "val',
+    "\udcff",
+], ids=["empty", "list", "null", "bad-expiry", "no-value", "value-list", "truncated", "not-utf8"])
+def test_bad_disk_entry_is_miss(tmp_path, content):
+    path = tmp_path / f"{KEY}.json"
+    path.write_bytes(content.encode('utf-8', 'surrogateescape'))
+    cache = ResultCache(disk_dir=str(tmp_path))
+
+    assert asyncio.run(cache.get(KEY)) is None
+    assert cache.stats()['misses'] == 1
+    assert not path.exists()
+
+
+def test_disk_round_trip(tmp_path):
+    async def scenario():
+        await ResultCache(disk_dir=str(tmp_path)).put(KEY, {'url': 'https://example.com/1.png'})
+        return await ResultCache(disk_dir=str(tmp_path)).get(KEY)
+
+    assert asyncio.run(scenario()) == {'url': 'https://example.com/1.png'}
+
+
+def test_expired_disk_entry_removed(tmp_path):
+    path = tmp_path / f"{KEY}.json"
+    path.write_text(json.dumps({'expires_at': time.time() - 1, 'value': {'url': 'x'}}))
+    assert asyncio.run(ResultCache(disk_dir=str(tmp_path)).get(KEY)) is None
+    assert not path.exists()
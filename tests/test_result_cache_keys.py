@@ -0,0 +1,75 @@
+"""Кэш результатов: результат кэшируется под моделью основного провайдера, результат запасного — нет"""
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from database.db import db
+from fakes import FakeProvider
+
+USER_ID = 42
+
+
+def run_style_chosen(db_path, monkeypatch, providers):
+    from handlers import creation
+    from services.generation_queue import generation_scheduler
+    from services.providers import generation_router
+    from services.replicate_api import design_cache_key
+    from services.result_cache import ResultCache
+
+    cache = ResultCache()
+    monkeypatch.setattr(db, "db_path", db_path)
+    monkeypatch.setattr(db, "analytics_sync", True)
+    monkeypatch.setattr(generation_router, "providers", providers)
+    monkeypatch.setattr(creation, "result_cache", cache)
+    monkeypatch.setattr(creation.result_delivery, "send_photo", AsyncMock(return_value=None))
+
+    callback = MagicMock()
+    callback.data = "style_modern"
+    callback.from_user.id = USER_ID
+    callback.message.chat.id = USER_ID
+    callback.message.bot = AsyncMock()
+    callback.message.answer = AsyncMock(return_value=MagicMock(message_id=1))
+    callback.answer = AsyncMock()
+
+    async def scenario():
+        try:
+            await db.create_user(USER_ID, "render")
+            await generation_scheduler.start(bot=None)
+            state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=USER_ID, user_id=USER_ID))
+            await state.update_data(photo_id="file_1", photo_unique_id="unique_1", room="living_room")
+            try:
+                await creation.style_chosen(callback, state, admins=[USER_ID], bot_token="1:a")
+            finally:
+                await generation_scheduler.stop()
+            return {
+                provider.name: await cache.get(
+                    design_cache_key("unique_1", "living_room", "modern", provider.model_id(None))
+                )
+                for provider in providers
+            }
+        finally:
+            await db.close()
+
+    return asyncio.run(scenario())
+
+
+def test_primary_result_cached(db_path, monkeypatch):
+    cached = run_style_chosen(db_path, monkeypatch, [FakeProvider("main"), FakeProvider("spare")])
+    assert cached["main"]["url"].startswith("https://main.")
+    assert cached["spare"] is None
+
+
+def test_fallback_result_not_cached(db_path, monkeypatch):
+    cached = run_style_chosen(db_path, monkeypatch, [FakeProvider("main", ['fail']), FakeProvider("spare")])
+    assert cached == {"main": None, "spare": None}
+
+
+def test_key_depends_on_model():
+    from services.replicate_api import design_cache_key
+
+    assert design_cache_key("unique_1", "living_room", "modern", "a") != \
+        design_cache_key("unique_1", "living_room", "modern", "b")
+    assert design_cache_key(None, "living_room", "modern", "a") is None
@@ -0,0 +1,70 @@
+"""Поиск пользователей: точные совпадения первыми, подстроки через users_fts, страницы, короткие запросы"""
+import asyncio
+import sqlite3
+
+import pytest
+
+from database.db import Database
+
+USERS = [
+    (1001, "ivan", "REFIVAN"),
+    (1002, "ivan_petrov", "REF1002"),
+    (1003, "petrov", "REF1003"),
+    (1004, "maria", "REF1004"),
+    (1005, "ivanova", "REF1005"),
+    (2001, "iv", "REF2001"),
+]
+
+
+@pytest.fixture
+def users(db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.executemany("INSERT INTO users (user_id, username, referral_code) VALUES (?, ?, ?)", USERS)
+    return db_path
+
+
+def search(db_path, *calls):
+    async def scenario():
+        database = Database(db_path, readers=1)
+        try:
+            results = []
+            for query, kwargs in calls:
+                rows, has_more = await database.search_users(query, **kwargs)
+                results.append(([row['user_id'] for row in rows], has_more))
+            return results
+        finally:
+            await database.close()
+
+    return asyncio.run(scenario())
+
+
+def test_exact_username_first(users):
+    [(ids, has_more)] = search(users, ("@ivan", {}))
+    assert ids == [1001, 1002, 1005] and not has_more
+
+
+def test_substring(users):
+    [(ids, _)] = search(users, ("petr", {}))
+    assert ids == [1002, 1003]
+
+
+def test_unique_identifier_hit_skips_substrings(users):
+    # 1002 — подстрока REF1002, но точное совпадение ID уникально
+    [(by_id, _), (by_code, _)] = search(users, ("1002", {}), ("REF1004", {}))
+    assert by_id == [1002] and by_code == [1004]
+
+
+def test_short_query_exact_only(users):
+    [(ids, _)] = search(users, ("iv", {}))
+    assert ids == [2001]
+
+
+def test_pages(users):
+    first, second = search(users, ("iva", {"limit": 2}), ("iva", {"limit": 2, "offset": 2}))
+    assert first == ([1001, 1002], True)
+    assert second == ([1005], False)
+
+
+def test_quotes_in_query(users):
+    [(ids, has_more)] = search(users, ('iv"an', {}))
+    assert ids == [] and not has_more
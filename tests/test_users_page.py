@@ -0,0 +1,69 @@
+"""Keyset-пагинация списка пользователей: обход вперед и назад без пропусков и повторов"""
+import asyncio
+import sqlite3
+
+import pytest
+
+from database.db import Database
+
+PER_PAGE = 3
+
+# Разные форматы created_at (дробные секунды, часовой пояс) и пользователи без даты
+CREATED_AT = [
+    '2025-12-08 09:30:00', '2025-12-08 09:30:00', '2025-12-08 09:30:00.250',
+    '2025-12-08T09:30:01+03:00', '2025-12-07 23:59:59', '2025-12-01 00:00:00', None, None,
+]
+
+
+@pytest.fixture
+def users(db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, created_at) VALUES (?, ?, ?)",
+            [(100 + i, f"user{i}", created_at) for i, created_at in enumerate(CREATED_AT)]
+        )
+        return [row[0] for row in conn.execute(
+            "SELECT user_id FROM users ORDER BY created_at DESC, user_id DESC"
+        )]
+
+
+def walk(db_path):
+    async def scenario():
+        database = Database(db_path, readers=1)
+        pages = []
+        rows, has_prev, has_next = await database.get_users_page(None, per_page=PER_PAGE)
+        pages.append([r['user_id'] for r in rows])
+        while has_next:
+            rows, has_prev, has_next = await database.get_users_page(rows[-1]['user_id'], per_page=PER_PAGE)
+            pages.append([r['user_id'] for r in rows])
+        back = [pages[-1]]
+        while has_prev:
+            rows, has_prev, has_next = await database.get_users_page(
+                rows[0]['user_id'], backward=True, per_page=PER_PAGE
+            )
+            back.append([r['user_id'] for r in rows])
+        await database.close()
+        return pages, back[::-1]
+
+    return asyncio.run(scenario())
+
+
+def test_forward_and_backward(db_path, users):
+    pages, back = walk(db_path)
+    assert [user_id for page in pages for user_id in page] == users
+    assert back == pages
+    # Пользователи без даты — последними
+    assert pages[-1][-2:] == [107, 106]
+
+
+def test_missing_cursor_user(db_path, users):
+    async def scenario():
+        database = Database(db_path, readers=1)
+        try:
+            return await database.get_users_page(999, per_page=PER_PAGE)
+        finally:
+            await database.close()
+
+    rows, has_prev, has_next = asyncio.run(scenario())
+    assert [r['user_id'] for r in rows] == users[:PER_PAGE]
+    assert not has_prev and has_next